@@ -31,14 +31,27 @@ without making the whole application unusable/slow in production.
 
 # pylint: disable=too-many-lines
 
+import contextvars
+import functools
+import hashlib
 import os
+import random
 import re
+import sys
 import time
 import traceback
+from collections import deque
 
 # pylint: disable-next=import-error
 from django.db import connections
 
+from .django__query_wrapper__histogram import (
+    PERCENTILES,
+    add_to_duration_histogram_v1,
+    get_duration_histogram_v1,
+    set_percentiles_of_extra_data_dict_v1,
+)
+
 # Remind that you can modify the constants below during execution:
 # from django_monkey_patches import django__query_wrapper
 # django__query_wrapper.COUNT_QUERIES = True
@@ -78,10 +91,68 @@ COUNT_QUERIES = False
 TIME_QUERIES = False
 # Activate the dump of the call stack to process or log it.
 COMPUTE_CALL_STACK = False
+# With COMPUTE_CALL_STACK, get a LazyCallStack instead of
+# the list of strings of traceback.format_stack().
+# Frames are not formatted, and identical call stacks
+# are the same object, until you format them for a report.
+LAZY_CALL_STACK = False
 # Execute a callback before executing the query on the DBMS.
 PRE_EXECUTION_CALLBACK = None
 # Execute a callback after executing the query on the DBMS.
 POST_EXECUTION_CALLBACK = None
+# Why you may want to sample queries?
+# To leave the wrapper activated in production
+# where you cannot pay for COMPUTE_CALL_STACK, TIME_QUERIES, etc.
+# on every query.
+# When a query is not sampled, only THROTTLE_QUERIES and COUNT_QUERIES
+# apply to it, counts stay exact.
+# The sampling weight of a sampled query (1 / its probability)
+# is given to POST_EXECUTION_CALLBACK in context["sampling_weight"],
+# and insert_in_extra_data_dict_v1() uses it to fill
+# the "estimated_*" fields of the extra data dicts.
+SAMPLE_QUERIES = False
+# Probability that a query of a sampled request is sampled.
+QUERY_SAMPLING_PROBABILITY = 1.0
+# Probability that a request is sampled, see sample_request_v1().
+REQUEST_SAMPLING_PROBABILITY = 1.0
+# None or the max number of sampled requests per second per process.
+# /!\ The requests dropped by this rate limit are not taken
+# into account in the sampling weight,
+# "estimated_*" fields are then lower bounds.
+MAX_SAMPLED_REQUESTS_PER_SECOND = None
+# None or a duration in seconds above which a query is always
+# given to POST_EXECUTION_CALLBACK, even if it is not sampled.
+# It cannot have a call stack since it is computed before execution.
+# The slow queries are then a stratum observed exhaustively:
+# they all have a sampling weight of 1, sampled or not,
+# and only the faster queries are weighted by 1 / probability.
+# To classify them, all the queries are timed,
+# as if TIME_QUERIES was True, and all the queries given
+# to POST_EXECUTION_CALLBACK have a duration.
+ALWAYS_SAMPLE_QUERIES_ABOVE_SECONDS = None
+# Measure the time spent in the query wrapper itself,
+# outside of execute(), so that you can subtract
+# the cost of the profiling from the profiled durations.
+# Only the wrappers built by get_specialized_query_wrapper_v1()
+# take this constant into account.
+MEASURE_WRAPPER_OVERHEAD = False
+# With a manager, a query_list with a query_list_max_length
+# is trimmed every this ratio of it queries, and at the synthesis:
+# it holds up to 10% more queries meanwhile,
+# but most queries cost no round-trip for the trim.
+MANAGED_QUERY_LIST_TRIM_RATIO = 0.1
+
+# Why you may want to use context variables?
+# Because with ASGI and async views, many concurrent requests
+# share the same process and the same connections,
+# and their stats would be mixed together.
+# When USE_CONTEXT_VARS is True, the dicts, stash stacks
+# and sampling weights of this patch are held in a context variable
+# that is copied to the threads of sync_to_async(),
+# and init_connections_extra_data() gives new ones
+# to the current context (request).
+# Set it before any init, and do not change it during execution.
+USE_CONTEXT_VARS = False
 
 # All functions below are suffixed with _v1.
 # Beware, that I may not use the strictest interpretation
@@ -101,6 +172,7 @@ POST_EXECUTION_CALLBACK = None
 SN1 = "django_monkey_patches_reference_pids"
 SN2 = "django_monkey_patches_dicts"
 SN3 = "django_monkey_patches_stash_stacks"
+SN4 = "django_monkey_patches_sampling_weights"
 
 
 def short_structure_names():
@@ -172,9 +244,71 @@ def short_structure_names():
     global SN2
     # pylint: disable-next=global-statement
     global SN3
+    # pylint: disable-next=global-statement
+    global SN4
     SN1 = "dmp_rp"
     SN2 = "dmp_d"
     SN3 = "dmp_ss"
+    SN4 = "dmp_sw"
+
+
+_dmp_context_structures = contextvars.ContextVar(
+    "django_monkey_patches_context_structures"
+)
+
+
+def _get_dmp_context_structure(connection, structure_name):
+    """
+    With USE_CONTEXT_VARS,
+    the structures are keyed by name and connection alias.
+    """
+    return _dmp_context_structures.get()[
+        (structure_name, getattr(connection, "alias", None))
+    ]
+
+
+def _has_dmp_structure(connection, structure_name):
+    """Replaces hasattr() for structures SN2 to SN4."""
+    if USE_CONTEXT_VARS:
+        structures = _dmp_context_structures.get(None)
+        return structures is not None and (
+            (structure_name, getattr(connection, "alias", None))
+            in structures
+        )
+    return hasattr(connection, structure_name)
+
+
+def _set_dmp_structure(connection, structure_name, value):
+    """Replaces setattr() for structures SN2 to SN4."""
+    if USE_CONTEXT_VARS:
+        structures = _dmp_context_structures.get(None)
+        if structures is None:
+            structures = {}
+            _dmp_context_structures.set(structures)
+        structures[
+            (structure_name, getattr(connection, "alias", None))
+        ] = value
+    else:
+        setattr(connection, structure_name, value)
+
+
+def init_context_structures(empty_stash_stack=False):
+    """
+    With USE_CONTEXT_VARS, give new structures to the current context,
+    so that it does not share them with the context
+    it was copied from (another request, the startup code, etc.).
+    The stash stacks are copied, unless empty_stash_stack is True.
+    """
+    previous_structures = _dmp_context_structures.get(None)
+    structures = {}
+    if previous_structures is not None and not empty_stash_stack:
+        for key, value in previous_structures.items():
+            if key[0] == SN3:
+                structures[key] = {
+                    pid: list(stash_stack)
+                    for pid, stash_stack in value.items()
+                }
+    _dmp_context_structures.set(structures)
 
 
 def _get_dmp_rp(connection):
@@ -184,21 +318,110 @@ def _get_dmp_rp(connection):
 
 def _get_dmp_d(connection):
     """A function that would be interesting to inline."""
+    if USE_CONTEXT_VARS:
+        return _get_dmp_context_structure(connection, SN2)
     return getattr(connection, SN2)
 
 
 def _get_dmp_ss(connection):
     """A function that would be interesting to inline."""
+    if USE_CONTEXT_VARS:
+        return _get_dmp_context_structure(connection, SN3)
     return getattr(connection, SN3)
 
 
+def _get_dmp_sw(connection):
+    """A function that would be interesting to inline."""
+    if USE_CONTEXT_VARS:
+        return _get_dmp_context_structure(connection, SN4)
+    return getattr(connection, SN4)
+
+
+# The reference pid of the current process, cached by
+# get_reference_pid() and forgotten in a child process after a fork.
+# "parent_reference_pid" is the reference pid of the parent process
+# before the last fork, see follow_parent_reference_pid_v1().
+_reference_pid_cache = {
+    "reference_pid": None,
+    "parent_reference_pid": None,
+}
+
+
 def get_reference_pid():
     """
     A central function needed because Django connections can be shared
     between multiple processes.
+    The result is cached, without a syscall per query:
+    use set_reference_pid_v1() and clear_reference_pid_v1()
+    to change the reference pid of a process.
+    """
+    reference_pid = _reference_pid_cache["reference_pid"]
+    if reference_pid is None:
+        pid = os.getpid()
+        reference_pid = _get_dmp_rp(connections).get(pid, pid)
+        _reference_pid_cache["reference_pid"] = reference_pid
+    return reference_pid
+
+
+def set_reference_pid_v1(reference_pid):
+    """
+    Use the dicts of reference_pid in the current process,
+    usually the reference pid of its parent process.
+    """
+    _get_dmp_rp(connections)[os.getpid()] = reference_pid
+    _reference_pid_cache["reference_pid"] = reference_pid
+
+
+def clear_reference_pid_v1():
+    """
+    Use the dicts of the pid of the current process again.
+    """
+    if hasattr(connections, SN1):
+        _get_dmp_rp(connections).pop(os.getpid(), None)
+    _reference_pid_cache["reference_pid"] = None
+
+
+def before_fork_v1():
+    """
+    Registered with os.register_at_fork(),
+    keep the reference pid of the parent for the child.
+    """
+    parent_reference_pid = None
+    if hasattr(connections, SN1):
+        parent_reference_pid = get_reference_pid()
+    _reference_pid_cache["parent_reference_pid"] = (
+        parent_reference_pid
+    )
+
+
+def after_fork_in_child_v1():
+    """
+    Registered with os.register_at_fork(),
+    the child has a new pid, and the reference pids inherited
+    from the parent are stale: they are dropped.
+    """
+    _reference_pid_cache["reference_pid"] = None
+    if hasattr(connections, SN1):
+        _get_dmp_rp(connections).clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(
+        before=before_fork_v1,
+        after_in_child=after_fork_in_child_v1,
+    )
+
+
+def follow_parent_reference_pid_v1():
+    """
+    In a child process, use the dicts of the parent process
+    before the fork, if it had some.
     """
-    pid = os.getpid()
-    return _get_dmp_rp(connections).get(pid, pid)
+    parent_reference_pid = _reference_pid_cache[
+        "parent_reference_pid"
+    ]
+    if parent_reference_pid is not None and hasattr(connections, SN1):
+        set_reference_pid_v1(parent_reference_pid)
 
 
 def get_connection_dict(connection):
@@ -217,6 +440,11 @@ def custom_query_wrapper_v1(execute, sql, params, many, context):
     Below, are given data structures and a POST_EXECUTION_CALLBACK
     that should handle most of your use cases.
 
+    The middleware, the command and the job decorator of
+    django__query_wrapper__integrations are ready to use,
+    with a settings-driven configuration.
+    The examples below are kept to explain how they work.
+
     Here is an example of how to use it with a middleware:
 
     class CustomQueryWrapperMiddleware:
@@ -261,9 +489,20 @@ def custom_query_wrapper_v1(execute, sql, params, many, context):
     if THROTTLE_QUERIES:
         time.sleep(QUERY_PENALTY_MILLISECONDS / 1000)
 
+    if SAMPLE_QUERIES:
+        sampling_weight = get_query_sampling_weight_v1()
+        if sampling_weight == 0:
+            return execute_unsampled_query_v1(
+                execute, sql, params, many, context
+            )
+        context["sampling_weight"] = sampling_weight
+
     call_stack = None
     if COMPUTE_CALL_STACK:
-        call_stack = traceback.format_stack()
+        if LAZY_CALL_STACK:
+            call_stack = get_lazy_call_stack_v1()
+        else:
+            call_stack = traceback.format_stack()
 
     if PRE_EXECUTION_CALLBACK is not None:
         (
@@ -277,17 +516,28 @@ def custom_query_wrapper_v1(execute, sql, params, many, context):
             execute, sql, params, many, context, call_stack
         )
 
+    always_sample_slow_queries = (
+        SAMPLE_QUERIES
+        and ALWAYS_SAMPLE_QUERIES_ABOVE_SECONDS is not None
+    )
     start_time = None
-    if TIME_QUERIES:
+    if TIME_QUERIES or always_sample_slow_queries:
         start_time = time.time()
 
     result = execute(sql, params, many, context)
 
     end_time = None
     duration = None
-    if TIME_QUERIES:
+    if TIME_QUERIES or always_sample_slow_queries:
         end_time = time.time()
         duration = end_time - start_time
+        if (
+            always_sample_slow_queries
+            and duration >= ALWAYS_SAMPLE_QUERIES_ABOVE_SECONDS
+        ):
+            # This query would have been captured anyway:
+            # it is not an estimate of the unsampled slow queries.
+            context["sampling_weight"] = 1
 
     if COUNT_QUERIES:
         # Micro-optimization on pid and less function calls
@@ -315,6 +565,599 @@ def custom_query_wrapper_v1(execute, sql, params, many, context):
     return result
 
 
+def execute_unsampled_query_v1(execute, sql, params, many, context):
+    """
+    The part of custom_query_wrapper_v1() applied to a query
+    that is not sampled:
+    COUNT_QUERIES and ALWAYS_SAMPLE_QUERIES_ABOVE_SECONDS.
+    """
+    threshold = ALWAYS_SAMPLE_QUERIES_ABOVE_SECONDS
+    if threshold is None:
+        result = execute(sql, params, many, context)
+        duration = None
+    else:
+        start_time = time.time()
+        result = execute(sql, params, many, context)
+        end_time = time.time()
+        duration = end_time - start_time
+
+    if COUNT_QUERIES:
+        pid = get_reference_pid()
+        _get_dmp_d(connections)[pid]["query_count"] += 1
+        _get_dmp_d(context["connection"])[pid]["query_count"] += 1
+
+    post_execution_callback = POST_EXECUTION_CALLBACK
+    if (
+        duration is not None
+        and duration >= threshold
+        and post_execution_callback is not None
+    ):
+        context["sampling_weight"] = 1
+        # pylint: disable-next=not-callable
+        result = post_execution_callback(
+            execute,
+            sql,
+            params,
+            many,
+            context,
+            None,
+            start_time,
+            result,
+            end_time,
+            duration,
+        )
+
+    return result
+
+
+def get_query_sampling_weight_v1():
+    """
+    Returns 0 if the current query is not sampled,
+    and otherwise the inverse of the probability it had
+    to be sampled.
+    The request part of the weight comes from sample_request_v1(),
+    and defaults to 1 if it was not called.
+    """
+    weight = _get_dmp_sw(connections).get(get_reference_pid(), 1)
+    if weight == 0:
+        return 0
+    probability = QUERY_SAMPLING_PROBABILITY
+    if probability >= 1:
+        return weight
+    if random.random() >= probability:
+        return 0
+    return weight / probability
+
+
+_sampling_token_bucket = {"tokens": 0.0, "time": None}
+
+
+def take_sampling_token_v1():
+    """
+    A token bucket enforcing MAX_SAMPLED_REQUESTS_PER_SECOND
+    in the current process.
+    The bucket is full after one second without sampled requests.
+    """
+    rate = MAX_SAMPLED_REQUESTS_PER_SECOND
+    capacity = max(rate, 1)
+    now = time.monotonic()
+    if _sampling_token_bucket["time"] is None:
+        tokens = capacity
+    else:
+        tokens = min(
+            capacity,
+            _sampling_token_bucket["tokens"]
+            + (now - _sampling_token_bucket["time"]) * rate,
+        )
+    _sampling_token_bucket["time"] = now
+    if tokens < 1:
+        _sampling_token_bucket["tokens"] = tokens
+        return False
+    _sampling_token_bucket["tokens"] = tokens - 1
+    return True
+
+
+def sample_request_v1():
+    """
+    Decide if the current request (or command, job, etc.) is sampled
+    according to REQUEST_SAMPLING_PROBABILITY
+    and MAX_SAMPLED_REQUESTS_PER_SECOND.
+    Call it at the beginning of each request, for example just after
+    init_connections_extra_data_v1() in your middleware.
+    It returns the sampling weight of the request, 0 if not sampled.
+    """
+    weight = 1
+    probability = REQUEST_SAMPLING_PROBABILITY
+    if probability < 1:
+        if random.random() >= probability:
+            weight = 0
+        else:
+            weight = 1 / probability
+    if (
+        weight != 0
+        and MAX_SAMPLED_REQUESTS_PER_SECOND is not None
+        and not take_sampling_token_v1()
+    ):
+        weight = 0
+    if not _has_dmp_structure(connections, SN4):
+        _set_dmp_structure(connections, SN4, {})
+    _get_dmp_sw(connections)[get_reference_pid()] = weight
+    return weight
+
+
+# The constants above that are frozen in a specialized query wrapper.
+QUERY_WRAPPER_CONFIGURATION_NAMES = (
+    "THROTTLE_QUERIES",
+    "QUERY_PENALTY_MILLISECONDS",
+    "COUNT_QUERIES",
+    "TIME_QUERIES",
+    "COMPUTE_CALL_STACK",
+    "LAZY_CALL_STACK",
+    "PRE_EXECUTION_CALLBACK",
+    "POST_EXECUTION_CALLBACK",
+    "SAMPLE_QUERIES",
+    "ALWAYS_SAMPLE_QUERIES_ABOVE_SECONDS",
+    "MEASURE_WRAPPER_OVERHEAD",
+)
+# The max number of wrappers kept by
+# get_specialized_query_wrapper_v1(),
+# the oldest ones are dropped first:
+# the configurations may hold new callbacks each time.
+MAX_SPECIALIZED_QUERY_WRAPPERS = 32
+_specialized_query_wrappers = {}
+_current_specialized_query_wrapper = [None]
+
+
+def get_query_wrapper_configuration():
+    """
+    The tuple of the current values of the constants
+    listed in QUERY_WRAPPER_CONFIGURATION_NAMES.
+    """
+    module_globals = globals()
+    return tuple(
+        module_globals[name]
+        for name in QUERY_WRAPPER_CONFIGURATION_NAMES
+    )
+
+
+def get_root_and_local_dicts_lines(config, indent):
+    """
+    The lines of the specialized query wrapper getting the root dicts
+    for COUNT_QUERIES and MEASURE_WRAPPER_OVERHEAD,
+    and counting the query.
+    """
+    lines = []
+    if config["COUNT_QUERIES"] or config["MEASURE_WRAPPER_OVERHEAD"]:
+        lines += [
+            "pid = get_reference_pid()",
+            "root_dict = _get_dmp_d(connections)[pid]",
+            'connection = context["connection"]',
+            "local_dict = _get_dmp_d(connection)[pid]",
+        ]
+    if config["COUNT_QUERIES"]:
+        lines += [
+            'root_dict["query_count"] += 1',
+            'local_dict["query_count"] += 1',
+        ]
+    return [f"{indent}{line}" for line in lines]
+
+
+def get_wrapper_overhead_lines(config, indent):
+    """
+    The lines of the specialized query wrapper
+    adding its overhead to the root dicts
+    with MEASURE_WRAPPER_OVERHEAD.
+    The root dicts of other templates may not have the fields.
+    """
+    if not config["MEASURE_WRAPPER_OVERHEAD"]:
+        return []
+    lines = [
+        "overhead = (",
+        "    perf_counter() - execute_end_time",
+        "    + execute_start_time - entry_time",
+        ")",
+        "for some_dict in (root_dict, local_dict):",
+        '  some_dict["wrapper_overhead_total_duration"] = (',
+        '      some_dict.get("wrapper_overhead_total_duration", 0)',
+        "      + overhead",
+        "  )",
+        '  some_dict["wrapper_overhead_query_count"] = (',
+        '      some_dict.get("wrapper_overhead_query_count", 0) + 1',
+        "  )",
+    ]
+    return [f"{indent}{line}" for line in lines]
+
+
+def get_unsampled_query_lines(config):
+    """
+    The lines of the specialized query wrapper
+    equivalent to execute_unsampled_query_v1().
+    """
+    measure_overhead = config["MEASURE_WRAPPER_OVERHEAD"]
+    threshold = config["ALWAYS_SAMPLE_QUERIES_ABOVE_SECONDS"]
+    lines = []
+    if threshold is not None:
+        lines.append("      start_time = time()")
+    if measure_overhead:
+        lines.append("      execute_start_time = perf_counter()")
+    lines.append("      result = execute(sql, params, many, context)")
+    if measure_overhead:
+        lines.append("      execute_end_time = perf_counter()")
+    if threshold is not None:
+        lines += [
+            "      end_time = time()",
+            "      duration = end_time - start_time",
+        ]
+    lines += get_root_and_local_dicts_lines(config, "      ")
+    if (
+        threshold is not None
+        and config["POST_EXECUTION_CALLBACK"] is not None
+    ):
+        lines += [
+            "      if duration >= always_sample_above_seconds:",
+            '        context["sampling_weight"] = 1',
+            "        result = post_execution_callback(",
+            "            execute, sql, params, many, context,",
+            "            None,",
+            "            start_time, result, end_time, duration,",
+            "        )",
+        ]
+    lines += get_wrapper_overhead_lines(config, "      ")
+    lines.append("      return result")
+    return lines
+
+
+# pylint: disable-next=too-many-branches,too-many-statements
+def get_specialized_query_wrapper_source_v1(configuration):
+    """
+    The source code of a query wrapper equivalent to
+    custom_query_wrapper_v1() for the given configuration,
+    but without the branches of the disabled features
+    and without the lookups of the constants.
+    """
+    config = dict(
+        zip(QUERY_WRAPPER_CONFIGURATION_NAMES, configuration)
+    )
+    # See ALWAYS_SAMPLE_QUERIES_ABOVE_SECONDS.
+    time_queries = config["TIME_QUERIES"] or (
+        config["SAMPLE_QUERIES"]
+        and config["ALWAYS_SAMPLE_QUERIES_ABOVE_SECONDS"] is not None
+    )
+    measure_overhead = config["MEASURE_WRAPPER_OVERHEAD"]
+    lines = [
+        "def make_specialized_query_wrapper(",
+        "    penalty_seconds,",
+        "    pre_execution_callback,",
+        "    post_execution_callback,",
+        "    always_sample_above_seconds,",
+        "):",
+        "  def specialized_query_wrapper(",
+        "      execute, sql, params, many, context",
+        "  ):",
+    ]
+    if measure_overhead:
+        lines.append("    entry_time = perf_counter()")
+    if config["THROTTLE_QUERIES"]:
+        lines.append("    sleep(penalty_seconds)")
+    if config["SAMPLE_QUERIES"]:
+        lines += [
+            "    sampling_weight = get_query_sampling_weight_v1()",
+            "    if sampling_weight == 0:",
+        ]
+        if measure_overhead:
+            # execute_unsampled_query_v1() inlined,
+            # so that its overhead is measured too.
+            lines += get_unsampled_query_lines(config)
+        else:
+            lines += [
+                "      return execute_unsampled_query_v1(",
+                "          execute, sql, params, many, context",
+                "      )",
+            ]
+        lines.append(
+            '    context["sampling_weight"] = sampling_weight'
+        )
+    has_callback = (
+        config["PRE_EXECUTION_CALLBACK"] is not None
+        or config["POST_EXECUTION_CALLBACK"] is not None
+    )
+    if config["COMPUTE_CALL_STACK"] and config["LAZY_CALL_STACK"]:
+        lines.append("    call_stack = get_lazy_call_stack_v1()")
+    elif config["COMPUTE_CALL_STACK"]:
+        lines.append("    call_stack = format_stack()")
+    elif has_callback:
+        lines.append("    call_stack = None")
+    if config["PRE_EXECUTION_CALLBACK"] is not None:
+        lines += [
+            "    (",
+            "        execute, sql, params, many, context, call_stack",
+            "    ) = pre_execution_callback(",
+            "        execute, sql, params, many, context,",
+            "        call_stack,",
+            "    )",
+        ]
+    if time_queries:
+        lines.append("    start_time = time()")
+    if measure_overhead:
+        lines.append("    execute_start_time = perf_counter()")
+    lines.append("    result = execute(sql, params, many, context)")
+    if measure_overhead:
+        lines.append("    execute_end_time = perf_counter()")
+    if time_queries:
+        lines += [
+            "    end_time = time()",
+            "    duration = end_time - start_time",
+        ]
+        if (
+            config["SAMPLE_QUERIES"]
+            and config["ALWAYS_SAMPLE_QUERIES_ABOVE_SECONDS"]
+            is not None
+        ):
+            lines += [
+                "    if duration >= always_sample_above_seconds:",
+                '      context["sampling_weight"] = 1',
+            ]
+    elif has_callback:
+        lines.append("    start_time = end_time = duration = None")
+    lines += get_root_and_local_dicts_lines(config, "    ")
+    if config["POST_EXECUTION_CALLBACK"] is not None:
+        lines += [
+            "    result = post_execution_callback(",
+            "        execute, sql, params, many, context,",
+            "        call_stack,",
+            "        start_time, result, end_time, duration,",
+            "    )",
+        ]
+    lines += get_wrapper_overhead_lines(config, "    ")
+    lines += [
+        "    return result",
+        "  return specialized_query_wrapper",
+        "",
+    ]
+    return "\n".join(lines)
+
+
+def get_specialized_query_wrapper_v1(configuration=None):
+    """
+    Build (or get from cache) a query wrapper equivalent to
+    custom_query_wrapper_v1() for the current configuration
+    (or the given one, see get_query_wrapper_configuration()).
+    Since the constants are frozen in it,
+    you need to build a new one
+    each time you change one of the constants
+    listed in QUERY_WRAPPER_CONFIGURATION_NAMES,
+    or use specialized_query_wrapper_v1()
+    and configure_query_wrapper_v1().
+    The source code is available in the attribute "source"
+    of the returned function.
+    """
+    if configuration is None:
+        configuration = get_query_wrapper_configuration()
+    specialized_query_wrapper = _specialized_query_wrappers.get(
+        configuration
+    )
+    if specialized_query_wrapper is not None:
+        return specialized_query_wrapper
+
+    source = get_specialized_query_wrapper_source_v1(configuration)
+    namespace = {
+        "connections": connections,
+        "execute_unsampled_query_v1": execute_unsampled_query_v1,
+        "format_stack": traceback.format_stack,
+        "get_lazy_call_stack_v1": get_lazy_call_stack_v1,
+        "get_query_sampling_weight_v1": get_query_sampling_weight_v1,
+        "get_reference_pid": get_reference_pid,
+        "perf_counter": time.perf_counter,
+        "sleep": time.sleep,
+        "time": time.time,
+        "_get_dmp_d": _get_dmp_d,
+    }
+    filename = "<django_monkey_patches specialized_query_wrapper>"
+    # pylint: disable-next=exec-used
+    exec(compile(source, filename, "exec"), namespace)
+    config = dict(
+        zip(QUERY_WRAPPER_CONFIGURATION_NAMES, configuration)
+    )
+    specialized_query_wrapper = namespace[
+        "make_specialized_query_wrapper"
+    ](
+        config["QUERY_PENALTY_MILLISECONDS"] / 1000,
+        config["PRE_EXECUTION_CALLBACK"],
+        config["POST_EXECUTION_CALLBACK"],
+        config["ALWAYS_SAMPLE_QUERIES_ABOVE_SECONDS"],
+    )
+    specialized_query_wrapper.source = source
+    while len(_specialized_query_wrappers) >= max(
+        1, MAX_SPECIALIZED_QUERY_WRAPPERS
+    ):
+        del _specialized_query_wrappers[
+            next(iter(_specialized_query_wrappers))
+        ]
+    _specialized_query_wrappers[configuration] = (
+        specialized_query_wrapper
+    )
+    return specialized_query_wrapper
+
+
+def refresh_specialized_query_wrapper_v1():
+    """
+    Rebuild the wrapper used by specialized_query_wrapper_v1()
+    after you changed some constants.
+    """
+    _current_specialized_query_wrapper[0] = (
+        get_specialized_query_wrapper_v1()
+    )
+    return _current_specialized_query_wrapper[0]
+
+
+def configure_query_wrapper_v1(**configuration):
+    """
+    Change some constants of this module,
+    for example configure_query_wrapper_v1(TIME_QUERIES=True),
+    and rebuild the wrapper used by specialized_query_wrapper_v1().
+    """
+    module_globals = globals()
+    for name, value in configuration.items():
+        if name not in QUERY_WRAPPER_CONFIGURATION_NAMES:
+            raise ValueError(
+                "configure_query_wrapper_v1 error:"
+                f" unknown constant {name}"
+            )
+        module_globals[name] = value
+    return refresh_specialized_query_wrapper_v1()
+
+
+def specialized_query_wrapper_v1(execute, sql, params, many, context):
+    """
+    A stable entry-point for connection.execute_wrapper()
+    delegating to the last wrapper built
+    by configure_query_wrapper_v1()
+    or refresh_specialized_query_wrapper_v1().
+    It costs one more call than the wrapper returned by
+    get_specialized_query_wrapper_v1(),
+    but you don't need to wrap the connections again
+    when the configuration changes.
+    """
+    specialized_query_wrapper = _current_specialized_query_wrapper[0]
+    if specialized_query_wrapper is None:
+        specialized_query_wrapper = (
+            refresh_specialized_query_wrapper_v1()
+        )
+    # pylint: disable-next=not-callable
+    return specialized_query_wrapper(
+        execute, sql, params, many, context
+    )
+
+
+class LazyCallStack:
+    """
+    A node of a trie of call stacks shared by all queries.
+    The path from the root to this node goes
+    from the innermost frame to the outermost frame,
+    and each frame is kept as a (code object, line number) couple.
+    Thus, a call stack already seen costs a few dict lookups
+    and no allocation, and identical call stacks are the same object,
+    which makes them cheap keys for allocated subsets.
+    Formatting, with source lines,
+    is done once per node on first demand.
+    """
+
+    __slots__ = (
+        "parent",
+        "code",
+        "lineno",
+        "children",
+        "formatted",
+        "light",
+    )
+
+    def __init__(self, parent, code, lineno):
+        self.parent = parent
+        self.code = code
+        self.lineno = lineno
+        self.children = {}
+        self.formatted = None
+        self.light = None
+
+    def get_frames(self):
+        """
+        The (code object, line number) couples,
+        from the outermost frame to the innermost frame,
+        like traceback.format_stack().
+        """
+        frames = []
+        node = self
+        while node.parent is not None:
+            frames.append((node.code, node.lineno))
+            node = node.parent
+        return frames
+
+    def format(self):
+        """
+        The same list of strings as traceback.format_stack().
+        """
+        if self.formatted is None:
+            self.formatted = traceback.StackSummary.from_list(
+                [
+                    (code.co_filename, lineno, code.co_name, None)
+                    for code, lineno in self.get_frames()
+                ]
+            ).format()
+        return self.formatted
+
+    def get_light(self, excluded_path_part="site-packages/"):
+        """
+        The LazyCallStack without the frames of files
+        whose path contains excluded_path_part.
+        """
+        if self.light is None:
+            frames = [
+                frame
+                for frame in self.get_frames()
+                if excluded_path_part not in frame[0].co_filename
+            ]
+            self.light = intern_call_stack_frames_v1(reversed(frames))
+        return self.light
+
+    def __iter__(self):
+        return iter(self.format())
+
+    def __len__(self):
+        node = self
+        length = 0
+        while node.parent is not None:
+            length += 1
+            node = node.parent
+        return length
+
+    def __str__(self):
+        return "".join(self.format())
+
+    def __reduce__(self):
+        # Code objects cannot be pickled (managers, etc.).
+        return (list, (self.format(),))
+
+
+_lazy_call_stack_root = LazyCallStack(None, None, None)
+
+
+def intern_call_stack_frames_v1(frames):
+    """
+    Get the LazyCallStack of the given (code object, line number)
+    couples, from the innermost frame to the outermost frame.
+    """
+    node = _lazy_call_stack_root
+    for key in frames:
+        child = node.children.get(key)
+        if child is None:
+            # setdefault() in case of a race between threads.
+            child = node.children.setdefault(
+                key, LazyCallStack(node, key[0], key[1])
+            )
+        node = child
+    return node
+
+
+def get_lazy_call_stack_v1(skip=1):
+    """
+    The LazyCallStack of the caller (with skip=1),
+    obtained by walking the frames.
+    """
+    # pylint: disable-next=protected-access
+    frame = sys._getframe(skip)
+    node = _lazy_call_stack_root
+    while frame is not None:
+        key = (frame.f_code, frame.f_lineno)
+        child = node.children.get(key)
+        if child is None:
+            child = node.children.setdefault(
+                key, LazyCallStack(node, key[0], key[1])
+            )
+        node = child
+        frame = frame.f_back
+    return node
+
+
 # pylint: disable-next=unused-argument
 def get_full_query_v1(extra_data_dict, data):
     """
@@ -354,17 +1197,158 @@ def get_sql_signature_v1(extra_data_dict, data):
 get_sql_signature_v1.field_name = "sql_signature_v1"
 
 
+sql_tokens_regexp = re.compile(
+    r"""
+    (?P<quoted_name>"(?:[^"]|"")*"|`(?:[^`]|``)*`)
+    |(?P<string>[EeNnXxBb]?'(?:[^']|'')*')
+    |(?P<placeholder>%s|%\(\w+\)s|\?|(?<![:\w]):\w+|\$\d+)
+    |(?P<number>(?<![\w.$])\d+(?:\.\d+)?(?:[eE][-+]?\d+)?(?!\w))
+    |(?P<comma>\s*,\s*)
+    |(?P<whitespace>\s+)
+    """,
+    re.VERBOSE,
+)
+sql_in_list_regexp = re.compile(
+    r"\bIN \(\?(?:, \?)*\)", re.IGNORECASE
+)
+sql_values_list_regexp = re.compile(
+    r"(\(\?(?:, \?)*\))(?:, \(\?(?:, \?)*\))+"
+)
+
+
+def replace_sql_token_v1(match):
+    """
+    The replacement function used with sql_tokens_regexp.
+    """
+    kind = match.lastgroup
+    if kind == "quoted_name":
+        return match.group()
+    if kind == "comma":
+        return ", "
+    if kind == "whitespace":
+        return " "
+    return "?"
+
+
+def normalize_sql_v1(sql):
+    """
+    Normalize an SQL string so that the queries that differ only by
+    their params, literals, whitespace, or the length of their lists
+    have the same result:
+    - placeholders of all backends (%s, %(name)s, ?, :name, $1),
+      literal strings and literal numbers are replaced by ?,
+      quoted names are left untouched,
+    - whitespace is collapsed,
+    - IN (?, ?, ...) becomes IN (...),
+    - VALUES (?, ?), (?, ?), ... keeps only the first row.
+    """
+    sql = sql_tokens_regexp.sub(replace_sql_token_v1, sql).strip()
+    sql = sql_in_list_regexp.sub("IN (...)", sql)
+    return sql_values_list_regexp.sub(r"\1, ...", sql)
+
+
+def get_sql_fingerprint_of_signature_v1(sql_signature):
+    """
+    A stable 64 bits integer for an SQL signature,
+    the same across processes and Python versions,
+    unlike hash().
+    """
+    return int.from_bytes(
+        hashlib.blake2b(
+            sql_signature.encode(), digest_size=8
+        ).digest(),
+        "big",
+    )
+
+
+# The initial size of the cache of the SQL signatures,
+# use set_sql_signature_cache_size_v1() to change it after import.
+SQL_SIGNATURE_CACHE_SIZE = 4096
+
+
+def compute_sql_signature_and_fingerprint_v2(sql):
+    """
+    The couple (normalize_sql_v1(sql), its fingerprint),
+    without cache.
+    """
+    sql_signature = normalize_sql_v1(sql)
+    return sql_signature, get_sql_fingerprint_of_signature_v1(
+        sql_signature
+    )
+
+
+_sql_signature_cache = {
+    "function": functools.lru_cache(maxsize=SQL_SIGNATURE_CACHE_SIZE)(
+        compute_sql_signature_and_fingerprint_v2
+    ),
+}
+
+
+def set_sql_signature_cache_size_v1(size):
+    """
+    Replace the cache of get_sql_signature_and_fingerprint_v2()
+    by an empty cache of the given size (None for no limit).
+    It also clears the cache, when called with the same size.
+    """
+    # pylint: disable-next=global-statement
+    global SQL_SIGNATURE_CACHE_SIZE
+    SQL_SIGNATURE_CACHE_SIZE = size
+    _sql_signature_cache["function"] = functools.lru_cache(
+        maxsize=size
+    )(compute_sql_signature_and_fingerprint_v2)
+
+
+def get_sql_signature_and_fingerprint_v2(sql):
+    """
+    The couple (normalize_sql_v1(sql), its fingerprint),
+    memoized since the same few hundred SQL strings
+    are executed again and again.
+    The cache is not rebound in the modules that imported
+    this function, hence it is looked up at each call.
+    """
+    return _sql_signature_cache["function"](sql)
+
+
+# pylint: disable-next=unused-argument
+def get_sql_signature_v2(extra_data_dict, data):
+    """
+    An helper function to get an SQL signature
+    where the params and the literals have no impact,
+    whatever the DB backend.
+    See normalize_sql_v1().
+    """
+    return get_sql_signature_and_fingerprint_v2(data["sql"])[0]
+
+
+get_sql_signature_v2.field_name = "sql_signature_v2"
+
+
+# pylint: disable-next=unused-argument
+def get_sql_fingerprint_v2(extra_data_dict, data):
+    """
+    An helper function to get a 64 bits integer
+    identifying the SQL signature of get_sql_signature_v2().
+    It is a cheaper key than the signature itself.
+    """
+    return get_sql_signature_and_fingerprint_v2(data["sql"])[1]
+
+
+get_sql_fingerprint_v2.field_name = "sql_fingerprint_v2"
+
+
 # pylint: disable-next=unused-argument
 def get_light_call_stack_v1(extra_data_dict, data):
     """
     An helper function to remove framework code from the call stack.
     Usually, you want to know where you generate a DB request
     in your own code.
+    With LAZY_CALL_STACK, the result is also a LazyCallStack.
     """
+    call_stack = data["call_stack"]
+    if isinstance(call_stack, LazyCallStack):
+        return call_stack.get_light()
     return [
-        line
-        for line in data["call_stack"]
-        if "site-packages/" not in line
+        line for line in call_stack if "site-packages/" not in line
     ]
 
 
@@ -447,7 +1431,7 @@ def get_managed_dict(manager):
 # }
 
 
-# pylint: disable-next=too-many-arguments
+# pylint: disable-next=too-many-arguments,too-many-locals
 def get_extra_data_template_for_set_of_queries_v1(
     query_fields=None,
     min_seconds_threshold=0,
@@ -462,6 +1446,14 @@ def get_extra_data_template_for_set_of_queries_v1(
     bottom_up_post_processing_callback=None,
     # You may need that with django-rq or other multiprocesses code:
     manager=None,
+    # None or the max number of queries kept in query_list,
+    # the oldest ones are dropped first.
+    # With a manager, they are dropped in batches,
+    # see MANAGED_QUERY_LIST_TRIM_RATIO.
+    query_list_max_length=None,
+    # None or the scale of a log-linear histogram of durations,
+    # for the percentiles (see django__query_wrapper__histogram).
+    duration_histogram_scale=None,
 ):
     """
     Obtain a default extra_data_dict with most of
@@ -491,6 +1483,20 @@ def get_extra_data_template_for_set_of_queries_v1(
     if allocated_subsets_init_callback is None:
         allocated_subsets_init_callback = get_managed_dict(manager)
 
+    duration_histogram = None
+    if duration_histogram_scale is not None:
+        duration_histogram = get_managed_dict(manager)
+        duration_histogram.update(
+            get_duration_histogram_v1(
+                duration_histogram_scale, get_managed_dict(manager)
+            )
+        )
+
+    if query_list_max_length is None or manager is not None:
+        query_list = get_managed_list(manager)
+    else:
+        query_list = deque(maxlen=query_list_max_length)
+
     result = get_managed_dict(manager)
     result_content = {
         "query_count": 0,
@@ -507,7 +1513,7 @@ def get_extra_data_template_for_set_of_queries_v1(
         #     "duration",
         #     get_full_query_v1,  # This is a function
         # ],
-        "query_list": get_managed_list(manager),  # [
+        "query_list": query_list,  # [
         # {
         #     "execute": None,
         #     "sql": None,
@@ -522,10 +1528,25 @@ def get_extra_data_template_for_set_of_queries_v1(
         #     "full_query_v1": None,
         # },
         # ],
+        # Counts and durations stay exact when query_list is bounded.
+        # For a sample per SQL signature, use it in the dicts
+        # of allocated_subsets_extra_data keyed by signature.
+        "query_list_max_length": query_list_max_length,
         "total_duration": 0,
         "average_duration": 0,
         "min_duration": float("inf"),
         "max_duration": 0,
+        # Only with duration_histogram_scale,
+        # the percentiles are set by synthetize_extra_data_dict_v1().
+        "duration_histogram": duration_histogram,
+        **dict.fromkeys(PERCENTILES),
+        # Equal to the fields above, unless SAMPLE_QUERIES is True.
+        "estimated_query_count": 0,
+        "estimated_total_duration": 0,
+        # Filled on root dicts when MEASURE_WRAPPER_OVERHEAD is True.
+        "wrapper_overhead_query_count": 0,
+        "wrapper_overhead_total_duration": 0,
+        "wrapper_overhead_average_duration": 0,
         # ------------------------------------------------------------
         # These fields could be at the top,
         # but it would be less didactic I think.
@@ -598,6 +1619,10 @@ def get_extra_data_template_for_set_of_queries_v1(
         # But clearly, in most cases,
         # the bottom-up post-processing makes more sense.
         # (Think sorting sub-results, etc.)
+        # ------------------------------------------------------------
+        # Set by compile_insertion_plan_v1(),
+        # for insert_in_connections_extra_data_v2().
+        "compiled_insertion_plan": None,
     }
     result.update(result_content)
     return result
@@ -618,7 +1643,7 @@ def is_globally_init(connection):
     tell if these connections already have the dicts linked
     to this patch.
     """
-    return hasattr(connection, SN2)
+    return _has_dmp_structure(connection, SN2)
 
 
 def is_locally_init(connection):
@@ -647,9 +1672,15 @@ def init_connection_extra_data(
     """
     if not is_globally_init(connection):
         if connection is connections:
-            setattr(connection, SN1, {})
-        setattr(connection, SN2, {})
-        setattr(connection, SN3, {})
+            if not USE_CONTEXT_VARS or not hasattr(connection, SN1):
+                # The reference pids are shared by all contexts.
+                setattr(connection, SN1, {})
+                _reference_pid_cache["reference_pid"] = None
+            if not _has_dmp_structure(connection, SN4):
+                _set_dmp_structure(connection, SN4, {})
+        _set_dmp_structure(connection, SN2, {})
+        if not _has_dmp_structure(connection, SN3):
+            _set_dmp_structure(connection, SN3, {})
 
     pid = get_reference_pid()
     _get_dmp_d(connection)[pid] = get_extra_data_template_callback()
@@ -657,7 +1688,7 @@ def init_connection_extra_data(
         _get_dmp_ss(connection)[pid] = get_managed_list(manager)
 
 
-# pylint: disable-next=too-many-arguments
+# pylint: disable-next=too-many-arguments,too-many-locals
 def init_connection_extra_data_v1(
     connection,
     manager=None,
@@ -673,6 +1704,8 @@ def init_connection_extra_data_v1(
     allocated_subsets_init_callback=None,
     top_down_post_processing_callback=None,
     bottom_up_post_processing_callback=None,
+    query_list_max_length=None,
+    duration_histogram_scale=None,
 ):
     """
     A simple default function providing the
@@ -702,6 +1735,8 @@ def init_connection_extra_data_v1(
                 bottom_up_post_processing_callback
             ),
             manager=manager,
+            query_list_max_length=query_list_max_length,
+            duration_histogram_scale=duration_histogram_scale,
         )
 
     init_connection_extra_data(
@@ -721,6 +1756,8 @@ def init_connections_extra_data(
     You should call this function or a custom one
     before using the custom query wrapper.
     """
+    if USE_CONTEXT_VARS:
+        init_context_structures(empty_stash_stack=empty_stash_stack)
     init_connection_extra_data(
         connections,
         get_extra_data_template_callback,
@@ -737,7 +1774,7 @@ def init_connections_extra_data(
         )
 
 
-# pylint: disable-next=too-many-arguments
+# pylint: disable-next=too-many-arguments,too-many-locals
 def init_connections_extra_data_v1(
     manager=None,
     empty_stash_stack=False,
@@ -752,6 +1789,8 @@ def init_connections_extra_data_v1(
     allocated_subsets_init_callback=None,
     top_down_post_processing_callback=None,
     bottom_up_post_processing_callback=None,
+    query_list_max_length=None,
+    duration_histogram_scale=None,
 ):
     """
     A simple default function providing the
@@ -781,6 +1820,8 @@ def init_connections_extra_data_v1(
                 bottom_up_post_processing_callback
             ),
             manager=manager,
+            query_list_max_length=query_list_max_length,
+            duration_histogram_scale=duration_histogram_scale,
         )
 
     init_connections_extra_data(
@@ -823,13 +1864,35 @@ def insert_in_connections_extra_data_v1(
         "result": result,
         "end_time": end_time,
         "duration": duration,
+        "sampling_weight": context.get("sampling_weight", 1),
     }
     for extra_data_dict in all_dicts:
         insert_in_extra_data_dict_v1(extra_data_dict, data)
     return result
 
 
-# pylint: disable-next=too-many-branches
+def trim_managed_query_list_v1(
+    query_list, max_length, query_count=None
+):
+    """
+    Drop the oldest queries of a managed query_list
+    above max_length, in one batch.
+    Each operation on a managed list is a round-trip
+    to the manager process, and pop(0) is O(n) there:
+    with the query_count of its dict, its length is only checked
+    every MANAGED_QUERY_LIST_TRIM_RATIO * max_length queries.
+    """
+    if query_count is not None:
+        step = max(1, int(max_length * MANAGED_QUERY_LIST_TRIM_RATIO))
+        inserted_count = query_count - max_length
+        if inserted_count <= 0 or inserted_count % step:
+            return
+    excess = len(query_list) - max_length
+    if excess > 0:
+        del query_list[:excess]
+
+
+# pylint: disable-next=too-many-branches,too-many-locals
 def insert_in_extra_data_dict_v1(extra_data_dict, data):
     """
     The recursive function used to insert the data of a query
@@ -852,7 +1915,10 @@ def insert_in_extra_data_dict_v1(extra_data_dict, data):
     # ----------------------------------------------------------------
 
     # Insertion part -------------------------------------------------
-    extra_data_dict["query_count"] += 1
+    query_count = extra_data_dict["query_count"] + 1
+    extra_data_dict["query_count"] = query_count
+    sampling_weight = data.get("sampling_weight", 1)
+    extra_data_dict["estimated_query_count"] += sampling_weight
     fields = extra_data_dict["query_fields"]
     if len(fields) > 0:
         local_data = {}
@@ -865,15 +1931,30 @@ def insert_in_extra_data_dict_v1(extra_data_dict, data):
                 local_data[field.field_name] = field(
                     extra_data_dict, data
                 )
-        extra_data_dict["query_list"].append(local_data)
+        query_list = extra_data_dict["query_list"]
+        query_list.append(local_data)
+        max_length = extra_data_dict["query_list_max_length"]
+        if max_length is not None:
+            # Only for managed lists, a deque is used otherwise.
+            trim_managed_query_list_v1(
+                query_list, max_length, query_count
+            )
     if duration is not None:
         extra_data_dict["total_duration"] += duration
+        extra_data_dict["estimated_total_duration"] += (
+            duration * sampling_weight
+        )
         extra_data_dict["min_duration"] = min(
             extra_data_dict["min_duration"], duration
         )
         extra_data_dict["max_duration"] = max(
             extra_data_dict["max_duration"], duration
         )
+        duration_histogram = extra_data_dict["duration_histogram"]
+        if duration_histogram is not None:
+            add_to_duration_histogram_v1(
+                duration_histogram, duration, sampling_weight
+            )
     insertion_callback = extra_data_dict["insertion_callback"]
     if insertion_callback is not None:
         # You can keep track of nesting
@@ -882,7 +1963,7 @@ def insert_in_extra_data_dict_v1(extra_data_dict, data):
     # ----------------------------------------------------------------
 
     # Recursion part -------------------------------------------------
-    for some_dict in extra_data_dict["subsets_extra_data"]:
+    for some_dict in extra_data_dict["subsets_extra_data"].values():
         insert_in_extra_data_dict_v1(some_dict, data)
     for (
         allocated_subset_key,
@@ -913,6 +1994,245 @@ def insert_in_extra_data_dict_v1(extra_data_dict, data):
     # ----------------------------------------------------------------
 
 
+# The positions in the tuples of the operations of the plan.
+(
+    PLAN_EXTRA_DATA_DICT,
+    PLAN_MIN_SECONDS_THRESHOLD,
+    PLAN_MAX_SECONDS_THRESHOLD,
+    PLAN_FILTER_CALLBACK,
+    PLAN_FIELD_EXTRACTORS,
+    PLAN_INSERTION_CALLBACK,
+    PLAN_SKIP_INDEX,
+    PLAN_ALLOCATED_SUBSETS,
+) = range(8)
+
+
+def get_field_extractors_v1(query_fields):
+    """
+    The prebuilt (field name, None or function) pairs of query_fields.
+    """
+    field_extractors = []
+    for field in query_fields:
+        if isinstance(field, str):
+            field_extractors.append((field, None))
+        elif callable(field) and hasattr(field, "field_name"):
+            field_extractors.append((field.field_name, field))
+        else:
+            raise ValueError(
+                "query_fields error:"
+                f" {field!r} is neither a string"
+                " nor a function with a field_name"
+            )
+    return tuple(field_extractors)
+
+
+def compile_insertion_plan_v1(extra_data_dict):
+    """
+    Validate the tree of extra_data_dict once,
+    and flatten it in a list of operations, in pre-order:
+    the operation of a dict is a tuple (see the PLAN_* positions),
+    and its skip index is the index after its subsets,
+    where to jump when the query is filtered out.
+    The allocated subsets are created during the queries,
+    hence they have their own plans, compiled at their creation.
+    The plan is stored in extra_data_dict["compiled_insertion_plan"],
+    compile it again if you change the configuration of the tree.
+    """
+    plan = []
+
+    def add_operations(some_dict):
+        allocated_subsets = []
+        for (
+            allocated_subset_key,
+            key_generator,
+        ) in some_dict["allocated_subsets_key_callback"].items():
+            if key_generator is None:
+                continue
+            sub_dict = some_dict["allocated_subsets_extra_data"].get(
+                allocated_subset_key
+            )
+            if sub_dict is None:
+                raise ValueError(
+                    "allocated_subsets error:"
+                    f" no sub_dict for {allocated_subset_key}"
+                )
+            init_callback = some_dict[
+                "allocated_subsets_init_callback"
+            ].get(allocated_subset_key)
+            if init_callback is None:
+                raise ValueError(
+                    "allocated_subsets error:"
+                    f" no init_callback for {allocated_subset_key}"
+                )
+            allocated_subsets.append(
+                (key_generator, sub_dict, init_callback)
+            )
+        index = len(plan)
+        plan.append(None)
+        for sub_dict in some_dict["subsets_extra_data"].values():
+            add_operations(sub_dict)
+        plan[index] = (
+            some_dict,
+            some_dict["min_seconds_threshold"],
+            some_dict["max_seconds_threshold"],
+            some_dict["filter_callback"],
+            get_field_extractors_v1(some_dict["query_fields"]),
+            some_dict["insertion_callback"],
+            len(plan),
+            tuple(allocated_subsets),
+        )
+
+    add_operations(extra_data_dict)
+    extra_data_dict["compiled_insertion_plan"] = plan
+    return plan
+
+
+def insert_in_extra_data_dict_v2(extra_data_dict, data):
+    """
+    The same as insert_in_extra_data_dict_v1(),
+    but with the compiled insertion plan of extra_data_dict:
+    one loop, without recursion,
+    and without reading the configuration in the dicts.
+    The allocated subsets of a dict are processed
+    after its subsets, like in insert_in_extra_data_dict_v1().
+    """
+    # pylint: disable=too-many-locals,too-many-branches
+    # pylint: disable=too-many-statements
+    plan = extra_data_dict["compiled_insertion_plan"]
+    if plan is None:
+        plan = compile_insertion_plan_v1(extra_data_dict)
+    duration = data["duration"]
+    sampling_weight = data.get("sampling_weight", 1)
+    # Items (plan, index, end index),
+    # or (None, allocated subset, its dict).
+    stack = [(plan, 0, len(plan))]
+    while stack:
+        plan, index, end_index = stack.pop()
+        if plan is None:
+            # An allocated subset, after the subsets of its dict.
+            key_generator, sub_dict, init_callback = index
+            some_key = key_generator(end_index, data)
+            some_dict = sub_dict.get(some_key)
+            if some_dict is None:
+                some_dict = sub_dict[some_key] = init_callback(
+                    end_index, data
+                )
+            sub_plan = some_dict.get("compiled_insertion_plan")
+            if sub_plan is None:
+                sub_plan = compile_insertion_plan_v1(some_dict)
+            stack.append((sub_plan, 0, len(sub_plan)))
+            continue
+        while index < end_index:
+            (
+                some_dict,
+                min_seconds_threshold,
+                max_seconds_threshold,
+                filter_callback,
+                field_extractors,
+                insertion_callback,
+                skip_index,
+                allocated_subsets,
+            ) = plan[index]
+            if duration is not None and not (
+                min_seconds_threshold
+                <= duration
+                <= max_seconds_threshold
+            ):
+                index = skip_index
+                continue
+            if filter_callback is not None and not filter_callback(
+                some_dict, data
+            ):
+                index = skip_index
+                continue
+
+            query_count = some_dict["query_count"] + 1
+            some_dict["query_count"] = query_count
+            some_dict["estimated_query_count"] += sampling_weight
+            if field_extractors:
+                local_data = {}
+                for field_name, field in field_extractors:
+                    if field is None:
+                        local_data[field_name] = data[field_name]
+                    else:
+                        local_data[field_name] = field(
+                            some_dict, data
+                        )
+                query_list = some_dict["query_list"]
+                query_list.append(local_data)
+                max_length = some_dict["query_list_max_length"]
+                if max_length is not None:
+                    # Only for managed lists.
+                    trim_managed_query_list_v1(
+                        query_list, max_length, query_count
+                    )
+            if duration is not None:
+                some_dict["total_duration"] += duration
+                some_dict["estimated_total_duration"] += (
+                    duration * sampling_weight
+                )
+                if duration < some_dict["min_duration"]:
+                    some_dict["min_duration"] = duration
+                if duration > some_dict["max_duration"]:
+                    some_dict["max_duration"] = duration
+                duration_histogram = some_dict["duration_histogram"]
+                if duration_histogram is not None:
+                    add_to_duration_histogram_v1(
+                        duration_histogram, duration, sampling_weight
+                    )
+            if insertion_callback is not None:
+                insertion_callback(some_dict, data)
+
+            if allocated_subsets:
+                # Continue after the subsets, once they and then
+                # the allocated subsets are processed.
+                stack.append((plan, skip_index, end_index))
+                for allocated_subset in reversed(allocated_subsets):
+                    stack.append((None, allocated_subset, some_dict))
+                end_index = skip_index
+            index += 1
+
+
+# pylint: disable-next=too-many-arguments
+def insert_in_connections_extra_data_v2(
+    execute,
+    sql,
+    params,
+    many,
+    context,
+    call_stack,
+    start_time,
+    result,
+    end_time,
+    duration,
+):
+    """
+    The same as insert_in_connections_extra_data_v1(),
+    but with insert_in_extra_data_dict_v2().
+    """
+    pid = get_reference_pid()
+    all_dicts = [
+        _get_dmp_d(connections)[pid],
+        _get_dmp_d(context["connection"])[pid],
+    ]
+    data = {
+        "execute": execute,
+        "sql": sql,
+        "params": params,
+        "many": many,
+        "context": context,
+        "call_stack": call_stack,
+        "start_time": start_time,
+        "result": result,
+        "end_time": end_time,
+        "duration": duration,
+        "sampling_weight": context.get("sampling_weight", 1),
+    }
+    for extra_data_dict in all_dicts:
+        insert_in_extra_data_dict_v2(extra_data_dict, data)
+    return result
+
+
 def synthetize_connections_extra_data_v1():
     """
     The entry-point function to call synthetize_extra_data_dict_v1()
@@ -933,11 +2253,22 @@ def synthetize_extra_data_dict_v1(extra_data_dict):
     The recursive function used to synthetize
     the results at the end.
     """
+    max_length = extra_data_dict.get("query_list_max_length")
+    if max_length is not None:
+        trim_managed_query_list_v1(
+            extra_data_dict["query_list"], max_length
+        )
     if extra_data_dict["query_count"] > 0:
         extra_data_dict["average_duration"] = (
             extra_data_dict["total_duration"]
             / extra_data_dict["query_count"]
         )
+    if extra_data_dict.get("wrapper_overhead_query_count", 0) > 0:
+        extra_data_dict["wrapper_overhead_average_duration"] = (
+            extra_data_dict["wrapper_overhead_total_duration"]
+            / extra_data_dict["wrapper_overhead_query_count"]
+        )
+    set_percentiles_of_extra_data_dict_v1(extra_data_dict)
 
     # Top-down
     processing_callback = extra_data_dict[
@@ -963,6 +2294,24 @@ def synthetize_extra_data_dict_v1(extra_data_dict):
         processing_callback(extra_data_dict)
 
 
+def get_chained_callbacks_v1(*callbacks):
+    """
+    Many helpers are given as filter/insertion/post-processing
+    callbacks, but there is only one slot for each in a dict.
+    This function returns a callback calling all the given callbacks
+    in order with the same arguments,
+    and returning the result of the last one.
+    """
+
+    def chained_callbacks(*args):
+        result = None
+        for callback in callbacks:
+            result = callback(*args)
+        return result
+
+    return chained_callbacks
+
+
 def reorder_dict_by_total_duration_of_sub_dicts(some_dict):
     """
     A common tool to visualize the result of profiling DB queries
@@ -1032,7 +2381,7 @@ def stash_extra_data_dict(
         reinit_after_stash(connection)
 
 
-# pylint: disable-next=too-many-arguments
+# pylint: disable-next=too-many-arguments,too-many-locals
 def stash_extra_data_dict_and_reinit_v1(
     connection,
     manager=None,
@@ -1048,6 +2397,8 @@ def stash_extra_data_dict_and_reinit_v1(
     top_down_post_processing_callback=None,
     bottom_up_post_processing_callback=None,
     init_if_non_locally_init=False,
+    query_list_max_length=None,
+    duration_histogram_scale=None,
 ):
     """
     Stash connection django_monkey_patches_dict
@@ -1079,6 +2430,8 @@ def stash_extra_data_dict_and_reinit_v1(
             bottom_up_post_processing_callback=(
                 bottom_up_post_processing_callback
             ),
+            query_list_max_length=query_list_max_length,
+            duration_histogram_scale=duration_histogram_scale,
         )
 
     stash_extra_data_dict(
@@ -1114,7 +2467,7 @@ def stash_extra_data_dicts(
         global_reinit_after_stash()
 
 
-# pylint: disable-next=too-many-arguments
+# pylint: disable-next=too-many-arguments,too-many-locals
 def stash_extra_data_dicts_and_reinit_v1(
     manager=None,
     query_fields=None,
@@ -1129,6 +2482,8 @@ def stash_extra_data_dicts_and_reinit_v1(
     top_down_post_processing_callback=None,
     bottom_up_post_processing_callback=None,
     init_if_non_locally_init=False,
+    query_list_max_length=None,
+    duration_histogram_scale=None,
 ):
     """
     Stash current django_monkey_patches_dicts
@@ -1160,6 +2515,8 @@ def stash_extra_data_dicts_and_reinit_v1(
             bottom_up_post_processing_callback=(
                 bottom_up_post_processing_callback
             ),
+            query_list_max_length=query_list_max_length,
+            duration_histogram_scale=duration_histogram_scale,
         )
 
     stash_extra_data_dicts(
@@ -1214,16 +2571,12 @@ def apply_patch_rq_v1():
         return original_fork_work_horse(self, job, queue)
 
     def patched_main_work_horse(self, job, queue):
-        _get_dmp_rp(connections)[os.getpid()] = job.reference_pid
+        set_reference_pid_v1(job.reference_pid)
         return original_main_work_horse(self, job, queue)
 
     def patched_perform_job(self, job, queue):
         result = original_perform_job(self, job, queue)
-        pid = os.getpid()
-        if hasattr(connections, SN1):
-            rp = _get_dmp_rp(connections)
-            if rp.get(pid):
-                del rp[pid]
+        clear_reference_pid_v1()
         return result
 
     Worker.fork_work_horse = patched_fork_work_horse
@@ -1238,6 +2591,60 @@ def apply_patch_rq_v1():
 
 patch_rq_v1 = apply_patch_rq_v1
 
+
+def gunicorn_post_fork_v1(server, worker):
+    """
+    The post_fork hook of gunicorn for the prefork workers,
+    in your gunicorn.conf.py:
+    post_fork = gunicorn_post_fork_v1
+    It is only useful with preload_app = True,
+    when the dicts are init in the arbiter.
+    """
+    # pylint: disable=unused-argument
+    follow_parent_reference_pid_v1()
+
+
+def apply_uwsgi_postfork_hook_v1():
+    """
+    Register follow_parent_reference_pid_v1()
+    as a postfork hook of uwsgi, for the workers
+    forked after the app is loaded in the master (no lazy-apps).
+    """
+    # pylint: disable-next=import-error,import-outside-toplevel
+    from uwsgidecorators import postfork
+
+    return postfork(follow_parent_reference_pid_v1)
+
+
+def apply_celery_prefork_hooks_v1():
+    """
+    Connect follow_parent_reference_pid_v1()
+    to the worker_process_init signal of celery,
+    for the processes of the prefork pool,
+    and clear_reference_pid_v1() to worker_process_shutdown.
+    Return the receivers.
+    """
+    # pylint: disable-next=import-error,import-outside-toplevel
+    from celery.signals import (
+        worker_process_init,
+        worker_process_shutdown,
+    )
+
+    def on_worker_process_init(**kwargs):
+        # pylint: disable=unused-argument
+        follow_parent_reference_pid_v1()
+
+    def on_worker_process_shutdown(**kwargs):
+        # pylint: disable=unused-argument
+        clear_reference_pid_v1()
+
+    worker_process_init.connect(on_worker_process_init, weak=False)
+    worker_process_shutdown.connect(
+        on_worker_process_shutdown, weak=False
+    )
+    return on_worker_process_init, on_worker_process_shutdown
+
+
 # You should extract the data to logs or files,
 # during execution or at the end,
 # using custom insertion_callback or post_processing_callback.
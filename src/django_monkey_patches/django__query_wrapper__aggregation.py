@@ -0,0 +1,340 @@
+"""
+This file is part of django-monkey-patches library.
+
+django-monkey-patches is free software:
+you can redistribute it and/or modify it under the terms
+of the GNU Lesser General Public License
+as published by the Free Software Foundation,
+either version 3 of the License,
+or (at your option) any later version.
+
+django-monkey-patches is distributed in the hope
+that it will be useful,
+but WITHOUT ANY WARRANTY;
+without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU Lesser General Public License for more details.
+
+You should have received a copy of
+the GNU Lesser General Public License
+along with django-monkey-patches.
+If not, see <http://www.gnu.org/licenses/>.
+
+©Copyright 2023-2024 Laurent Lyaudet
+----------------------------------------------------------------------
+Functions to aggregate the extra data dicts
+of the custom query wrapper across processes
+without a multiprocessing.Manager.
+With the manager argument, each counter update and each append
+is a round-trip to the manager process during the query.
+Here, each process accumulates in its own plain dicts,
+and sends compact picklable copies of them
+by batches to a multiprocessing queue (a pipe),
+then it resets its counters.
+The aggregator process merges what it receives.
+
+For example, for parallel tests or forked workers:
+queue = multiprocessing.Queue()
+# In each worker, after init_connections_extra_data_v1():
+django__query_wrapper.POST_EXECUTION_CALLBACK = (
+    get_flushing_post_execution_callback_v1(queue)
+)
+# At the end of each worker:
+flush_connections_extra_data_v1(queue)
+# In the parent process:
+aggregated = aggregate_extra_data_from_queue_v1(queue)
+for extra_data_dict in aggregated.values():
+    synthetize_extra_data_dict_v1(extra_data_dict)
+"""
+
+import os
+import queue as queue_module
+import time
+
+# pylint: disable-next=import-error
+from django.db import connections
+
+from .django__query_wrapper import (
+    get_connection_dict,
+    insert_in_connections_extra_data_v1,
+    is_locally_init,
+)
+from .django__query_wrapper__histogram import (
+    merge_duration_histograms_v1,
+)
+
+# The callbacks and other configuration fields of the dicts
+# that cannot be sent to another process.
+CALLBACK_FIELDS = (
+    "filter_callback",
+    "insertion_callback",
+    "top_down_post_processing_callback",
+    "bottom_up_post_processing_callback",
+    "compiled_insertion_plan",
+)
+# The fields of the query records that cannot be sent
+# to another process.
+UNPICKLABLE_QUERY_FIELDS = ("execute", "context", "result")
+# The fields added together by merge_extra_data_dicts_v1().
+SUMMED_FIELDS = (
+    "query_count",
+    "total_duration",
+    "estimated_query_count",
+    "estimated_total_duration",
+    "wrapper_overhead_query_count",
+    "wrapper_overhead_total_duration",
+)
+# The fields put back to 0 by reset_extra_data_dict_v1().
+RESET_FIELDS = SUMMED_FIELDS + (
+    "average_duration",
+    "max_duration",
+    "wrapper_overhead_average_duration",
+)
+
+
+def get_picklable_key(key):
+    """
+    Allocated subsets keys are often strings,
+    but they can be LazyCallStack, etc.
+    """
+    if key is None or isinstance(key, (str, int, float, bool)):
+        return key
+    return str(key)
+
+
+def get_picklable_extra_data_dict_v1(extra_data_dict):
+    """
+    A recursive copy of extra_data_dict without the callbacks,
+    with names instead of functions in query_fields,
+    and without the unpicklable fields of the query records.
+    """
+    result = {}
+    for key, value in extra_data_dict.items():
+        if key in CALLBACK_FIELDS:
+            result[key] = None
+        elif key in (
+            "allocated_subsets_key_callback",
+            "allocated_subsets_init_callback",
+        ):
+            result[key] = {}
+        elif key == "query_fields":
+            result[key] = [
+                field if isinstance(field, str) else field.field_name
+                for field in value
+            ]
+        elif key == "duration_histogram" and value is not None:
+            result[key] = {
+                "scale": value["scale"],
+                "zero_count": value["zero_count"],
+                "counts": dict(value["counts"]),
+            }
+        elif key == "query_list":
+            result[key] = [
+                {
+                    field: field_value
+                    for field, field_value in query_data.items()
+                    if field not in UNPICKLABLE_QUERY_FIELDS
+                }
+                for query_data in value
+            ]
+        elif key == "subsets_extra_data":
+            result[key] = {
+                sub_key: get_picklable_extra_data_dict_v1(sub_dict)
+                for sub_key, sub_dict in value.items()
+            }
+        elif key == "allocated_subsets_extra_data":
+            result[key] = {
+                allocated_subset_key: {
+                    get_picklable_key(
+                        some_key
+                    ): get_picklable_extra_data_dict_v1(some_dict)
+                    for some_key, some_dict in sub_dict.items()
+                }
+                for allocated_subset_key, sub_dict in value.items()
+            }
+        else:
+            result[key] = value
+    return result
+
+
+def reset_extra_data_dict_v1(extra_data_dict):
+    """
+    Put back the counters of extra_data_dict and of its sub dicts
+    to their initial values, keeping the configuration.
+    The dicts of the allocated subsets are removed,
+    they will be created again by their init callbacks.
+    """
+    for key in RESET_FIELDS:
+        if key in extra_data_dict:
+            extra_data_dict[key] = 0
+    extra_data_dict["min_duration"] = float("inf")
+    duration_histogram = extra_data_dict.get("duration_histogram")
+    if duration_histogram is not None:
+        duration_histogram["zero_count"] = 0
+        duration_histogram["counts"].clear()
+    query_list = extra_data_dict["query_list"]
+    if hasattr(query_list, "clear"):
+        query_list.clear()
+    else:
+        del query_list[:]
+    for sub_dict in extra_data_dict["subsets_extra_data"].values():
+        reset_extra_data_dict_v1(sub_dict)
+    for sub_dict in extra_data_dict[
+        "allocated_subsets_extra_data"
+    ].values():
+        sub_dict.clear()
+
+
+# pylint: disable-next=too-many-branches
+def merge_extra_data_dicts_v1(target, source):
+    """
+    Add the counters and the queries of source in target, recursively.
+    Sub dicts of source missing in target are moved to target.
+    Call synthetize_extra_data_dict_v1() on target afterwards.
+    """
+    for key in SUMMED_FIELDS:
+        if key in source:
+            target[key] = target.get(key, 0) + source[key]
+    target["min_duration"] = min(
+        target["min_duration"], source["min_duration"]
+    )
+    target["max_duration"] = max(
+        target["max_duration"], source["max_duration"]
+    )
+    if source.get("duration_histogram") is not None:
+        if target.get("duration_histogram") is None:
+            target["duration_histogram"] = source[
+                "duration_histogram"
+            ]
+        else:
+            merge_duration_histograms_v1(
+                target["duration_histogram"],
+                source["duration_histogram"],
+            )
+    query_list = target["query_list"]
+    query_list.extend(source["query_list"])
+    max_length = target.get("query_list_max_length")
+    if max_length is not None and len(query_list) > max_length:
+        del query_list[: len(query_list) - max_length]
+
+    target_subsets = target["subsets_extra_data"]
+    for key, sub_dict in source["subsets_extra_data"].items():
+        if key in target_subsets:
+            merge_extra_data_dicts_v1(target_subsets[key], sub_dict)
+        else:
+            target_subsets[key] = sub_dict
+
+    target_allocated_subsets = target["allocated_subsets_extra_data"]
+    for allocated_subset_key, sub_dict in source[
+        "allocated_subsets_extra_data"
+    ].items():
+        target_sub_dict = target_allocated_subsets.get(
+            allocated_subset_key
+        )
+        if target_sub_dict is None:
+            target_allocated_subsets[allocated_subset_key] = sub_dict
+            continue
+        for some_key, some_dict in sub_dict.items():
+            if some_key in target_sub_dict:
+                merge_extra_data_dicts_v1(
+                    target_sub_dict[some_key], some_dict
+                )
+            else:
+                target_sub_dict[some_key] = some_dict
+    return target
+
+
+def get_connections_extra_data_snapshot_v1(reset=False):
+    """
+    The picklable copies of the root extra data dicts
+    of the current reference pid, keyed by connection alias,
+    and None for the dict of connections.
+    """
+    root_dicts = {None: get_connection_dict(connections)}
+    for connection_key in connections:
+        root_dicts[connection_key] = get_connection_dict(
+            connections[connection_key]
+        )
+    snapshot = {
+        alias: get_picklable_extra_data_dict_v1(extra_data_dict)
+        for alias, extra_data_dict in root_dicts.items()
+        if extra_data_dict is not None
+    }
+    if reset:
+        for extra_data_dict in root_dicts.values():
+            if extra_data_dict is not None:
+                reset_extra_data_dict_v1(extra_data_dict)
+    return snapshot
+
+
+def flush_connections_extra_data_v1(queue, reset=True):
+    """
+    Send the root extra data dicts of this process as one batch
+    to the aggregator and reset them (by default).
+    Nothing is sent if they are not initialized.
+    """
+    if not is_locally_init(connections):
+        return
+    snapshot = get_connections_extra_data_snapshot_v1(reset=reset)
+    queue.put({"pid": os.getpid(), "extra_data_dicts": snapshot})
+
+
+def get_flushing_post_execution_callback_v1(
+    queue,
+    post_execution_callback=insert_in_connections_extra_data_v1,
+    flush_every_queries=1000,
+    flush_every_seconds=10,
+):
+    """
+    A POST_EXECUTION_CALLBACK calling post_execution_callback
+    and flushing the extra data dicts of this process
+    every flush_every_queries queries or flush_every_seconds seconds,
+    whichever comes first.
+    Remind to flush one last time at the end of the process.
+    """
+    state = {"query_count": 0, "flush_time": time.monotonic()}
+
+    def flushing_post_execution_callback(*args):
+        result = post_execution_callback(*args)
+        state["query_count"] += 1
+        if state["query_count"] >= flush_every_queries or (
+            time.monotonic() - state["flush_time"]
+            >= flush_every_seconds
+        ):
+            flush_connections_extra_data_v1(queue)
+            state["query_count"] = 0
+            state["flush_time"] = time.monotonic()
+        return result
+
+    return flushing_post_execution_callback
+
+
+def aggregate_extra_data_from_queue_v1(
+    queue,
+    aggregated=None,
+    timeout=None,
+):
+    """
+    Merge all the batches waiting in the queue into aggregated,
+    a dict of extra data dicts keyed like the snapshots,
+    and return it.
+    With a timeout, wait for the first batch at most timeout seconds.
+    """
+    if aggregated is None:
+        aggregated = {}
+    block = timeout is not None
+    while True:
+        try:
+            batch = queue.get(block=block, timeout=timeout)
+        except queue_module.Empty:
+            return aggregated
+        block = False
+        for alias, extra_data_dict in batch[
+            "extra_data_dicts"
+        ].items():
+            if alias in aggregated:
+                merge_extra_data_dicts_v1(
+                    aggregated[alias], extra_data_dict
+                )
+            else:
+                aggregated[alias] = extra_data_dict
@@ -0,0 +1,252 @@
+"""
+This file is part of django-monkey-patches library.
+
+django-monkey-patches is free software:
+you can redistribute it and/or modify it under the terms
+of the GNU Lesser General Public License
+as published by the Free Software Foundation,
+either version 3 of the License,
+or (at your option) any later version.
+
+django-monkey-patches is distributed in the hope
+that it will be useful,
+but WITHOUT ANY WARRANTY;
+without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU Lesser General Public License for more details.
+
+You should have received a copy of
+the GNU Lesser General Public License
+along with django-monkey-patches.
+If not, see <http://www.gnu.org/licenses/>.
+
+©Copyright 2023-2024 Laurent Lyaudet
+----------------------------------------------------------------------
+Budgets of queries for a view, a task or a block of code:
+max number of queries, max total DB time,
+and max duration of a single query.
+QueryBudgetV1 is a context manager and a decorator,
+and QueryBudgetMiddlewareV1 applies the budget
+of the setting DJANGO_MONKEY_PATCHES_QUERY_BUDGET to each request.
+
+Budgets nest like the stash stack: a query counts in all the
+budgets of the current scope, from the outermost to the innermost.
+The outermost budget wraps the connections with its own
+lightweight query wrapper, so that no other configuration
+of the custom query wrapper is needed.
+Hence the budgets do not read the extra data dicts,
+and they only see the queries of the connections
+of the thread that entered the outermost budget:
+the queries run in other threads (thread pools,
+sync_to_async() of an async view, etc.) are not counted.
+
+A violation is reported once per limit and per budget
+with the action of the budget:
+"log" (a warning), "raise" (QueryBudgetExceededError, in tests),
+or a callable action(budget, limit_name, value, message)
+to emit a metric.
+QueryBudgetExceededError is raised after a successful query:
+a database error is never masked, and a violation
+of a failed query is raised after the next successful query,
+or at the end of the budget.
+
+For example:
+@QueryBudgetV1(max_queries=10, max_duration=0.2, action="raise")
+def test_list_view(self):
+    ...
+
+with QueryBudgetV1(max_query_duration=1, name="nightly export"):
+    export()
+"""
+
+import contextlib
+import contextvars
+import logging
+import time
+
+# pylint: disable-next=import-error
+from django.conf import settings
+
+from .django__query_wrapper import wrap_connections
+
+logger = logging.getLogger(__name__)
+
+_active_budgets = contextvars.ContextVar(
+    "django_monkey_patches_query_budgets", default=()
+)
+
+
+class QueryBudgetExceededError(Exception):
+    """
+    Raised when a budget with the action "raise" is exceeded.
+    """
+
+
+def budget_query_wrapper_v1(execute, sql, params, many, context):
+    """
+    The query wrapper of the outermost budget:
+    it counts the query in all the active budgets.
+    """
+    budgets = _active_budgets.get()
+    if not budgets:
+        return execute(sql, params, many, context)
+    start_time = time.perf_counter()
+    try:
+        result = execute(sql, params, many, context)
+    finally:
+        # A failed query counts too.
+        duration = time.perf_counter() - start_time
+        for budget in budgets:
+            budget.add_query(duration, sql)
+    for budget in budgets:
+        budget.raise_pending_error()
+    return result
+
+
+# pylint: disable-next=too-many-instance-attributes
+class QueryBudgetV1(contextlib.ContextDecorator):
+    """
+    A budget of queries for a scope, see the module docstring.
+    The limits that are None are not checked.
+    After the scope, query_count, total_duration,
+    max_query_duration_seen and violations are available.
+    """
+
+    # pylint: disable-next=too-many-arguments
+    def __init__(
+        self,
+        max_queries=None,
+        max_duration=None,
+        max_query_duration=None,
+        action="log",
+        name=None,
+    ):
+        if action not in ("log", "raise") and not callable(action):
+            raise ValueError(
+                f"Unknown query budget action: {action!r}"
+            )
+        self.max_queries = max_queries
+        self.max_duration = max_duration
+        self.max_query_duration = max_query_duration
+        self.action = action
+        self.name = name
+        self.query_count = 0
+        self.total_duration = 0
+        self.max_query_duration_seen = 0
+        self.violations = []
+        # The QueryBudgetExceededError not raised yet.
+        self.pending_error = None
+        self.exit_stack = None
+        self.token = None
+
+    def _recreate_cm(self):
+        # Each call of a decorated function has its own counters.
+        return type(self)(
+            max_queries=self.max_queries,
+            max_duration=self.max_duration,
+            max_query_duration=self.max_query_duration,
+            action=self.action,
+            name=self.name,
+        )
+
+    def __enter__(self):
+        budgets = _active_budgets.get()
+        if not budgets:
+            self.exit_stack = contextlib.ExitStack()
+            wrap_connections(self.exit_stack, budget_query_wrapper_v1)
+        self.token = _active_budgets.set(budgets + (self,))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _active_budgets.reset(self.token)
+        self.token = None
+        if self.exit_stack is not None:
+            self.exit_stack.close()
+            self.exit_stack = None
+        if exc_type is None:
+            self.raise_pending_error()
+        return False
+
+    def raise_pending_error(self):
+        """
+        Raise the QueryBudgetExceededError not raised yet, if any.
+        """
+        error = self.pending_error
+        if error is not None:
+            self.pending_error = None
+            raise error
+
+    def add_query(self, duration, sql):
+        """
+        Count a query and check the limits.
+        """
+        self.query_count += 1
+        self.total_duration += duration
+        self.max_query_duration_seen = max(
+            self.max_query_duration_seen, duration
+        )
+        if (
+            self.max_queries is not None
+            and self.query_count == self.max_queries + 1
+        ):
+            self.report("max_queries", self.query_count, sql)
+        if (
+            self.max_duration is not None
+            # Only when the total crosses the limit.
+            and self.total_duration - duration
+            <= self.max_duration
+            < self.total_duration
+        ):
+            self.report("max_duration", self.total_duration, sql)
+        if (
+            self.max_query_duration is not None
+            and duration > self.max_query_duration
+            and "max_query_duration" not in self.violations
+        ):
+            self.report("max_query_duration", duration, sql)
+
+    def report(self, limit_name, value, sql):
+        """
+        Apply the action of the budget to a violation.
+        With the action "raise", the QueryBudgetExceededError
+        is pending until raise_pending_error().
+        """
+        self.violations.append(limit_name)
+        name = f" {self.name}" if self.name else ""
+        message = (
+            f"Query budget{name} exceeded:"
+            f" {limit_name}={getattr(self, limit_name)},"
+            f" got {value} with {sql[:200]}"
+        )
+        if self.action == "log":
+            logger.warning(message)
+        elif self.action == "raise":
+            if self.pending_error is None:
+                self.pending_error = QueryBudgetExceededError(message)
+        else:
+            self.action(self, limit_name, value, message)
+
+
+# pylint: disable-next=too-few-public-methods
+class QueryBudgetMiddlewareV1:
+    """
+    Apply a QueryBudgetV1 to each request,
+    with the keyword arguments of the setting
+    DJANGO_MONKEY_PATCHES_QUERY_BUDGET, for example:
+    DJANGO_MONKEY_PATCHES_QUERY_BUDGET = {
+        "max_queries": 50,
+        "max_duration": 0.5,
+        "action": "log",
+    }
+    The name of the budget is the path of the request.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.budget_kwargs = getattr(
+            settings, "DJANGO_MONKEY_PATCHES_QUERY_BUDGET", {}
+        )
+
+    def __call__(self, request):
+        with QueryBudgetV1(name=request.path, **self.budget_kwargs):
+            return self.get_response(request)
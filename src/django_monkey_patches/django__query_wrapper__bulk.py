@@ -0,0 +1,357 @@
+"""
+This file is part of django-monkey-patches library.
+
+django-monkey-patches is free software:
+you can redistribute it and/or modify it under the terms
+of the GNU Lesser General Public License
+as published by the Free Software Foundation,
+either version 3 of the License,
+or (at your option) any later version.
+
+django-monkey-patches is distributed in the hope
+that it will be useful,
+but WITHOUT ANY WARRANTY;
+without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU Lesser General Public License for more details.
+
+You should have received a copy of
+the GNU Lesser General Public License
+along with django-monkey-patches.
+If not, see <http://www.gnu.org/licenses/>.
+
+©Copyright 2023-2024 Laurent Lyaudet
+----------------------------------------------------------------------
+Bulk operations and big params:
+an executemany(), a bulk_create() or a bulk_update()
+is one query for the wrapper, whatever the number of rows,
+and "params" in query_fields keeps a copy of the whole batch.
+
+Field functions for query_fields:
+- get_params_summary_v1(), to use instead of "params":
+  the number of values, their types, the max length
+  of the strings and bytes, and a hash to compare params,
+- get_batch_size_v1(): the number of rows sent,
+  by an executemany(), a multi-rows INSERT,
+  an INSERT ... SELECT * FROM UNNEST() with an array per column
+  (bulk_create() on PostgreSQL with Django 5.2+)
+  or a bulk_update() (an UPDATE with CASE WHEN per row),
+- get_row_count_v1(): the number of rows affected
+  (cursor.rowcount).
+
+Insertion callbacks:
+- add_bulk_stats_v1() sums the batches of more than one row,
+  with the same batch size as get_batch_size_v1(),
+  in extra_data_dict["bulk_stats"], with the duration per row,
+- detect_params_bloat_v1() flags the huge IN lists,
+  the queries with too many params and the oversized params,
+  per SQL signature (v2) in extra_data_dict["params_bloat"],
+  with a summary of the params of the last one.
+
+For example:
+django__query_wrapper.TIME_QUERIES = True
+django__query_wrapper.POST_EXECUTION_CALLBACK = (
+    insert_in_connections_extra_data_v1
+)
+init_connections_extra_data_v1(
+    query_fields=[
+        "sql",
+        get_params_summary_v1,
+        get_batch_size_v1,
+        get_row_count_v1,
+        "duration",
+    ],
+    insertion_callback=add_bulk_stats_v1,
+)
+# Only on the root dict of connections,
+# otherwise each bloated signature would be logged twice.
+get_connection_dict(connections)["insertion_callback"] = (
+    get_chained_callbacks_v1(
+        add_bulk_stats_v1,
+        detect_params_bloat_v1,
+    )
+)
+"""
+
+import hashlib
+import logging
+import re
+
+from .django__query_wrapper import (
+    get_sql_signature_and_fingerprint_v2,
+)
+
+logger = logging.getLogger(__name__)
+
+# Above these limits, the params of a query are bloated.
+MAX_IN_LIST_LENGTH = 1000
+MAX_PARAMS_COUNT = 10000
+# In characters or bytes.
+MAX_PARAM_LENGTH = 100000
+LOG_PARAMS_BLOAT = True
+# Only the first values are hashed and typed in a summary.
+MAX_SUMMARIZED_VALUES = 100000
+
+IN_LIST_REGEXP = re.compile(
+    r"\bIN \(((?:%s|\?)(?:, (?:%s|\?))*)\)", re.IGNORECASE
+)
+SIZED_TYPES = (str, bytes, bytearray, memoryview)
+# The first CASE of the SET clause of a bulk_update().
+CASE_UPDATE_REGEXP = re.compile(
+    r"\bSET\s+\S+\s*=\s*CASE\b(.*?)\bEND\b",
+    re.IGNORECASE | re.DOTALL,
+)
+WHEN_REGEXP = re.compile(r"\bWHEN\b", re.IGNORECASE)
+UNNEST_REGEXP = re.compile(r"\bUNNEST\s*\(", re.IGNORECASE)
+ARRAY_TYPES = (list, tuple)
+
+
+def is_unnest(sql):
+    """
+    True for an INSERT with an array param per column,
+    unnested in rows.
+    """
+    return UNNEST_REGEXP.search(sql) is not None
+
+
+def iter_param_values(params, many, unnest=False):
+    """
+    The values of params, of all the rows with many,
+    and of all the arrays with unnest.
+    """
+    rows = params if many else (params,)
+    for row in rows:
+        values = row.values() if isinstance(row, dict) else row
+        if not unnest:
+            yield from values
+            continue
+        for value in values:
+            if isinstance(value, ARRAY_TYPES):
+                yield from value
+            else:
+                yield value
+
+
+def get_params_summary(params, many, unnest=False):
+    """
+    The summary of params, without a copy of the values.
+    """
+    summary = {
+        "type": type(params).__name__,
+        "length": None,
+        "value_count": None,
+        "types": None,
+        "max_value_length": None,
+        "hash": None,
+    }
+    # An iterator given to executemany() is already consumed.
+    if params is None or not hasattr(params, "__len__"):
+        return summary
+    summary["length"] = len(params)
+    value_count = 0
+    types = set()
+    max_value_length = 0
+    params_hash = hashlib.blake2b(digest_size=8)
+    for value in iter_param_values(params, many, unnest):
+        value_count += 1
+        if value_count > MAX_SUMMARIZED_VALUES:
+            continue
+        types.add(type(value).__name__)
+        if isinstance(value, SIZED_TYPES):
+            max_value_length = max(max_value_length, len(value))
+        params_hash.update(repr(value).encode())
+    summary["value_count"] = value_count
+    summary["types"] = sorted(types)
+    summary["max_value_length"] = max_value_length
+    summary["hash"] = params_hash.hexdigest()
+    return summary
+
+
+def get_params_summary_v1(extra_data_dict, data):
+    """
+    The summary of the params of the query.
+    """
+    # pylint: disable=unused-argument
+    return get_params_summary(
+        data["params"], data["many"], is_unnest(data["sql"])
+    )
+
+
+get_params_summary_v1.field_name = "params_summary_v1"
+
+
+def get_batch_size(sql, params, many):
+    """
+    The number of rows sent by the query:
+    the rows of executemany(), the VALUES of a multi-rows INSERT,
+    the length of the arrays of an INSERT with UNNEST(),
+    the WHEN of an UPDATE with CASE (bulk_update()),
+    or None with an iterator given to executemany().
+    """
+    if many:
+        if hasattr(params, "__len__"):
+            return len(params)
+        return None
+    statement = sql.lstrip()[:6].upper()
+    if statement == "INSERT":
+        if (
+            isinstance(params, ARRAY_TYPES)
+            and params
+            and isinstance(params[0], ARRAY_TYPES)
+            and is_unnest(sql)
+        ):
+            return len(params[0])
+        values_index = sql.upper().find(" VALUES ")
+        if values_index != -1:
+            return sql.count("), (", values_index) + 1
+    elif statement == "UPDATE":
+        match = CASE_UPDATE_REGEXP.search(sql)
+        if match is not None:
+            return max(1, len(WHEN_REGEXP.findall(match.group(1))))
+    return 1
+
+
+def get_batch_size_v1(extra_data_dict, data):
+    """
+    The number of rows sent by the query.
+    """
+    # pylint: disable=unused-argument
+    return get_batch_size(data["sql"], data["params"], data["many"])
+
+
+get_batch_size_v1.field_name = "batch_size_v1"
+
+
+def get_row_count_v1(extra_data_dict, data):
+    """
+    The number of rows affected by the query,
+    or None when the database does not give it.
+    """
+    # pylint: disable=unused-argument
+    cursor = data["context"].get("cursor")
+    row_count = getattr(cursor, "rowcount", -1)
+    if row_count is None or row_count < 0:
+        return None
+    return row_count
+
+
+get_row_count_v1.field_name = "row_count_v1"
+
+
+def get_bulk_stats_v1():
+    """
+    The empty "bulk_stats" of an extra data dict.
+    """
+    return {
+        "query_count": 0,
+        "batch_size_total": 0,
+        "max_batch_size": 0,
+        "row_count": 0,
+        "total_duration": 0,
+        "average_row_duration": 0,
+    }
+
+
+def add_bulk_stats_v1(extra_data_dict, data):
+    """
+    The insertion callback summing in extra_data_dict["bulk_stats"]
+    the queries sending more than one row (see get_batch_size()):
+    an UPDATE without CASE is not a bulk operation,
+    whatever the number of rows it affects.
+    The rows affected are used for the duration per row,
+    or the rows sent when the database does not give them.
+    """
+    sql = data["sql"]
+    batch_size = get_batch_size(sql, data["params"], data["many"])
+    if batch_size == 1:
+        return
+    row_count = get_row_count_v1(extra_data_dict, data)
+    statement = sql.lstrip()[:6].upper()
+    bulk_stats = extra_data_dict.get("bulk_stats")
+    if bulk_stats is None:
+        bulk_stats = extra_data_dict["bulk_stats"] = (
+            get_bulk_stats_v1()
+        )
+    if row_count is None or (not row_count and statement == "INSERT"):
+        # With RETURNING, rowcount can be 0 before the fetch.
+        row_count = batch_size or 0
+    bulk_stats["query_count"] += 1
+    if batch_size is not None:
+        bulk_stats["batch_size_total"] += batch_size
+        bulk_stats["max_batch_size"] = max(
+            bulk_stats["max_batch_size"], batch_size
+        )
+    bulk_stats["row_count"] += row_count
+    if data["duration"] is not None:
+        bulk_stats["total_duration"] += data["duration"]
+    if bulk_stats["row_count"]:
+        bulk_stats["average_row_duration"] = (
+            bulk_stats["total_duration"] / bulk_stats["row_count"]
+        )
+
+
+def get_params_bloat_issues_v1(sql, params, many):
+    """
+    The list of the bloat issues of the query:
+    "in_list", "params_count" and "param_length".
+    """
+    issues = []
+    for match in IN_LIST_REGEXP.finditer(sql):
+        if match.group(1).count(",") + 1 > MAX_IN_LIST_LENGTH:
+            issues.append("in_list")
+            break
+    if params is None or not hasattr(params, "__len__"):
+        return issues
+    params_count = 0
+    has_long_param = False
+    for value in iter_param_values(params, many, is_unnest(sql)):
+        params_count += 1
+        if (
+            not has_long_param
+            and isinstance(value, SIZED_TYPES)
+            and len(value) > MAX_PARAM_LENGTH
+        ):
+            has_long_param = True
+    if params_count > MAX_PARAMS_COUNT:
+        issues.append("params_count")
+    if has_long_param:
+        issues.append("param_length")
+    return issues
+
+
+def detect_params_bloat_v1(extra_data_dict, data):
+    """
+    The insertion callback counting the bloated queries
+    per SQL signature in extra_data_dict["params_bloat"].
+    The first one of each signature is logged with LOG_PARAMS_BLOAT.
+    """
+    sql = data["sql"]
+    issues = get_params_bloat_issues_v1(
+        sql, data["params"], data["many"]
+    )
+    if not issues:
+        return
+    params_bloat = extra_data_dict.get("params_bloat")
+    if params_bloat is None:
+        params_bloat = extra_data_dict["params_bloat"] = {}
+    sql_signature = get_sql_signature_and_fingerprint_v2(sql)[0]
+    entry = params_bloat.get(sql_signature)
+    if entry is None:
+        entry = params_bloat[sql_signature] = {
+            "count": 0,
+            "issues": [],
+            "params_summary": None,
+        }
+        if LOG_PARAMS_BLOAT:
+            logger.warning(
+                "Bloated params (%s) for %s",
+                ", ".join(issues),
+                sql_signature[:200],
+            )
+    entry["count"] += 1
+    for issue in issues:
+        if issue not in entry["issues"]:
+            entry["issues"].append(issue)
+    entry["params_summary"] = get_params_summary(
+        data["params"], data["many"], is_unnest(sql)
+    )
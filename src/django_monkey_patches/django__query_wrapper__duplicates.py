@@ -0,0 +1,346 @@
+"""
+This file is part of django-monkey-patches library.
+
+django-monkey-patches is free software:
+you can redistribute it and/or modify it under the terms
+of the GNU Lesser General Public License
+as published by the Free Software Foundation,
+either version 3 of the License,
+or (at your option) any later version.
+
+django-monkey-patches is distributed in the hope
+that it will be useful,
+but WITHOUT ANY WARRANTY;
+without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU Lesser General Public License for more details.
+
+You should have received a copy of
+the GNU Lesser General Public License
+along with django-monkey-patches.
+If not, see <http://www.gnu.org/licenses/>.
+
+©Copyright 2023-2024 Laurent Lyaudet
+----------------------------------------------------------------------
+Duplicate queries: the same SELECT with the same params
+executed more than once in the same scope.
+
+detect_duplicate_queries_v1() is an insertion callback
+for the custom query wrapper, counting the executions
+and the call sites of each (sql, params) in its extra data dict,
+and get_duplicate_queries_v1() lists the duplicates.
+
+memoize_read_queries_v1() is an opt-in context manager
+that removes the duplicates without touching your code:
+in its scope, the rows fetched by the ORM for identical
+read queries (MULTI non-chunked and SINGLE results)
+are memoized, and given again instead of querying the database.
+The memoized rows of a connection are dropped by any write
+(any SQL that is not a SELECT, raw SQL included),
+and by any transaction boundary (commit, rollback, savepoint,
+autocommit change).
+Beware that rows written meanwhile by other connections
+or other processes are not seen in the scope.
+
+For example:
+with memoize_read_queries_v1() as memoization_state:
+    response = view(request)
+print(memoization_state["hits"], memoization_state["misses"])
+"""
+
+# Django's private API of compilers and connections is needed here.
+# pylint: disable=protected-access
+
+import contextlib
+import contextvars
+import functools
+
+# pylint: disable-next=import-error
+from django.db.backends.base.base import BaseDatabaseWrapper
+
+# pylint: disable-next=import-error
+from django.db.backends.utils import CursorWrapper
+
+# pylint: disable-next=import-error
+from django.db.models.sql.compiler import (
+    SQLCompiler,
+    SQLDeleteCompiler,
+    SQLInsertCompiler,
+    SQLUpdateCompiler,
+)
+
+# pylint: disable-next=import-error
+from django.db.models.sql.constants import MULTI, SINGLE
+
+from .django__query_wrapper__n_plus_one import get_call_site_v1
+
+# The max number of distinct call sites kept per duplicate query.
+MAX_CALL_SITES_PER_DUPLICATE = 10
+
+
+def is_select(sql):
+    """
+    Only SELECT statements are read queries here.
+    """
+    return sql.lstrip()[:6].upper() == "SELECT"
+
+
+def detect_duplicate_queries_v1(extra_data_dict, data):
+    """
+    The insertion callback counting the executions
+    of each SELECT with its params
+    in extra_data_dict["duplicate_queries"].
+    """
+    sql = data["sql"]
+    if data["many"] or not is_select(sql):
+        return
+    duplicate_queries = extra_data_dict.get("duplicate_queries")
+    if duplicate_queries is None:
+        duplicate_queries = extra_data_dict["duplicate_queries"] = {}
+    # repr(), since the params can be lists.
+    key = (sql, repr(data["params"]))
+    entry = duplicate_queries.get(key)
+    if entry is None:
+        entry = duplicate_queries[key] = {
+            "sql": sql,
+            "params": data["params"],
+            "count": 0,
+            "total_duration": 0,
+            "call_sites": {},
+        }
+    entry["count"] += 1
+    if data["duration"] is not None:
+        entry["total_duration"] += data["duration"]
+    call_site = get_call_site_v1(data["call_stack"])
+    call_sites = entry["call_sites"]
+    if (
+        call_site in call_sites
+        or len(call_sites) < MAX_CALL_SITES_PER_DUPLICATE
+    ):
+        call_sites[call_site] = call_sites.get(call_site, 0) + 1
+
+
+def get_duplicate_queries_v1(extra_data_dict):
+    """
+    The entries of the queries executed more than once,
+    the most repeated first.
+    """
+    return sorted(
+        (
+            entry
+            for entry in extra_data_dict.get(
+                "duplicate_queries", {}
+            ).values()
+            if entry["count"] > 1
+        ),
+        key=lambda x: x["count"],
+        reverse=True,
+    )
+
+
+# None outside of memoize_read_queries_v1(),
+# else {"caches": {alias: {key: rows}}, "hits": 0, "misses": 0}.
+_memoization_state = contextvars.ContextVar(
+    "django_monkey_patches_read_memoization", default=None
+)
+_original_methods = {}
+
+
+def invalidate_memoized_reads_v1(connection):
+    """
+    Drop the memoized rows of connection in the current scope.
+    """
+    memoization_state = _memoization_state.get()
+    if memoization_state is not None:
+        memoization_state["caches"].pop(connection.alias, None)
+
+
+def is_memoizable(compiler, result_type, chunked_fetch):
+    """
+    Only the reads of the ORM fully fetched in memory.
+    """
+    return (
+        result_type in (MULTI, SINGLE)
+        and not chunked_fetch
+        and not isinstance(
+            compiler,
+            (SQLInsertCompiler, SQLUpdateCompiler, SQLDeleteCompiler),
+        )
+        and not compiler.query.select_for_update
+        and compiler.query.explain_info is None
+    )
+
+
+def execute_compiled_sql(
+    original_execute_sql, compiler, sql, params, *args, **kwargs
+):
+    """
+    Call the original execute_sql() with the SQL already compiled,
+    instead of compiling it a second time.
+    """
+    original_as_sql = compiler.as_sql
+
+    def as_sql(*as_sql_args, **as_sql_kwargs):
+        if as_sql_args or as_sql_kwargs:
+            return original_as_sql(*as_sql_args, **as_sql_kwargs)
+        return sql, params
+
+    compiler.as_sql = as_sql
+    try:
+        return original_execute_sql(compiler, *args, **kwargs)
+    finally:
+        del compiler.as_sql
+
+
+def get_memoizing_execute_sql(original_execute_sql):
+    """
+    The patched SQLCompiler.execute_sql().
+    """
+
+    def execute_sql(
+        self, result_type=MULTI, chunked_fetch=False, **kwargs
+    ):
+        memoization_state = _memoization_state.get()
+        if memoization_state is None or not is_memoizable(
+            self, result_type, chunked_fetch
+        ):
+            return original_execute_sql(
+                self, result_type, chunked_fetch, **kwargs
+            )
+        # as_sql() also sets up the compiler for the caller.
+        try:
+            sql, params = self.as_sql()
+        # pylint: disable-next=broad-exception-caught
+        except Exception:
+            # EmptyResultSet, etc.
+            return original_execute_sql(
+                self, result_type, chunked_fetch, **kwargs
+            )
+        if not is_select(sql):
+            return execute_compiled_sql(
+                original_execute_sql,
+                self,
+                sql,
+                params,
+                result_type,
+                chunked_fetch,
+                **kwargs,
+            )
+        key = (result_type, sql, repr(params))
+        cache = memoization_state["caches"].setdefault(
+            self.connection.alias, {}
+        )
+        if key in cache:
+            memoization_state["hits"] += 1
+            rows = cache[key]
+        else:
+            memoization_state["misses"] += 1
+            rows = execute_compiled_sql(
+                original_execute_sql,
+                self,
+                sql,
+                params,
+                result_type,
+                chunked_fetch,
+                **kwargs,
+            )
+            # The cache may have been invalidated meanwhile.
+            memoization_state["caches"].setdefault(
+                self.connection.alias, {}
+            )[key] = rows
+        if result_type == MULTI:
+            # The chunks are lists, they must not be shared.
+            return [list(chunk) for chunk in rows]
+        return rows
+
+    return functools.wraps(original_execute_sql)(execute_sql)
+
+
+def get_invalidating_cursor_method(original_method):
+    """
+    The patched CursorWrapper.execute() and executemany():
+    any SQL that is not a SELECT drops the memoized rows.
+    """
+
+    def cursor_method(self, sql, *args, **kwargs):
+        if _memoization_state.get() is not None and not (
+            isinstance(sql, str) and is_select(sql)
+        ):
+            invalidate_memoized_reads_v1(self.db)
+        return original_method(self, sql, *args, **kwargs)
+
+    return functools.wraps(original_method)(cursor_method)
+
+
+def get_invalidating_connection_method(original_method):
+    """
+    The patched transaction methods of BaseDatabaseWrapper.
+    """
+
+    def connection_method(self, *args, **kwargs):
+        invalidate_memoized_reads_v1(self)
+        return original_method(self, *args, **kwargs)
+
+    return functools.wraps(original_method)(connection_method)
+
+
+def apply_read_memoization_patch_v1():
+    """
+    Patch the compiler, the cursors and the connections
+    for memoize_read_queries_v1(), once,
+    and return the original methods.
+    Outside of the scopes, the patches only check a context variable.
+    """
+    if _original_methods:
+        return dict(_original_methods)
+    _original_methods["SQLCompiler.execute_sql"] = (
+        SQLCompiler.execute_sql
+    )
+    SQLCompiler.execute_sql = get_memoizing_execute_sql(
+        SQLCompiler.execute_sql
+    )
+    for method_name in ("execute", "executemany"):
+        original_method = getattr(CursorWrapper, method_name)
+        _original_methods[f"CursorWrapper.{method_name}"] = (
+            original_method
+        )
+        setattr(
+            CursorWrapper,
+            method_name,
+            get_invalidating_cursor_method(original_method),
+        )
+    for method_name in (
+        "commit",
+        "rollback",
+        "set_autocommit",
+        "_savepoint",
+        "_savepoint_rollback",
+        "_savepoint_commit",
+    ):
+        original_method = getattr(BaseDatabaseWrapper, method_name)
+        _original_methods[f"BaseDatabaseWrapper.{method_name}"] = (
+            original_method
+        )
+        setattr(
+            BaseDatabaseWrapper,
+            method_name,
+            get_invalidating_connection_method(original_method),
+        )
+    return dict(_original_methods)
+
+
+@contextlib.contextmanager
+def memoize_read_queries_v1():
+    """
+    Memoize the identical read queries of the ORM in this scope,
+    and yield the state with the hits and misses counts.
+    The patch is applied on first use.
+    """
+    apply_read_memoization_patch_v1()
+    memoization_state = {"caches": {}, "hits": 0, "misses": 0}
+    token = _memoization_state.set(memoization_state)
+    try:
+        yield memoization_state
+    finally:
+        _memoization_state.reset(token)
+        memoization_state["caches"].clear()
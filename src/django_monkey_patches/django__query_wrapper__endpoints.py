@@ -0,0 +1,418 @@
+"""
+This file is part of django-monkey-patches library.
+
+django-monkey-patches is free software:
+you can redistribute it and/or modify it under the terms
+of the GNU Lesser General Public License
+as published by the Free Software Foundation,
+either version 3 of the License,
+or (at your option) any later version.
+
+django-monkey-patches is distributed in the hope
+that it will be useful,
+but WITHOUT ANY WARRANTY;
+without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU Lesser General Public License for more details.
+
+You should have received a copy of
+the GNU Lesser General Public License
+along with django-monkey-patches.
+If not, see <http://www.gnu.org/licenses/>.
+
+©Copyright 2023-2024 Laurent Lyaudet
+----------------------------------------------------------------------
+The attribution of the queries to their endpoint:
+the HTTP method, the name of the resolved URL
+(or its route pattern without a name),
+the view class (or function) and the DRF viewset action,
+for example "GET books-detail library.views.BookViewSet.retrieve".
+
+EndpointMiddlewareV1 sets the endpoint of the current request
+in a context variable, when the view is resolved
+(the queries of the middlewares before are "unresolved"),
+and counts the queries and the DB time of each request
+with its own lightweight query wrapper.
+At the end of a request, they are added to endpoint_stats_store,
+with sliding windows per endpoint across the requests
+of the worker: EndpointStatsStoreV1.get_stats() gives
+the request count, query count, DB time,
+and the percentiles p50/p95/p99 of the queries
+(exact counts) and of the DB time (histogram) per request,
+over the last WINDOW_SECONDS.
+
+get_endpoint_key_v1() is an allocated subsets key generator,
+for the custom query wrapper, instead of writing your own.
+init_endpoints_extra_data_v1() inits each root dict
+with its own dicts per endpoint:
+init_endpoints_extra_data_v1()
+
+For example, in settings.py:
+MIDDLEWARE = (
+    "django_monkey_patches.django__query_wrapper__endpoints"
+    ".EndpointMiddlewareV1",
+    ...
+)
+and in a monitoring view:
+endpoint_stats_store.get_stats()
+"""
+
+import contextlib
+import contextvars
+import threading
+import time
+from collections import Counter
+
+from .django__query_wrapper import (
+    get_extra_data_template_for_set_of_queries_v1,
+    init_connections_extra_data,
+    wrap_connections,
+)
+from .django__query_wrapper__histogram import (
+    DEFAULT_SCALE,
+    add_to_duration_histogram_v1,
+    get_duration_histogram_v1,
+    get_duration_percentiles_v1,
+    merge_duration_histograms_v1,
+)
+
+UNRESOLVED_ROUTE = "unresolved"
+# The endpoints above this number are merged in OTHER_ENDPOINT.
+MAX_ENDPOINTS = 500
+OTHER_ENDPOINT = "__other__"
+# The sliding window is made of buckets of BUCKET_SECONDS.
+WINDOW_SECONDS = 600
+BUCKET_SECONDS = 10
+ENDPOINT_PERCENTILES = {"p50": 0.5, "p95": 0.95, "p99": 0.99}
+ENDPOINTS_SUBSET_KEY = "endpoints"
+
+_current_request = contextvars.ContextVar(
+    "django_monkey_patches_endpoint_request", default=None
+)
+
+
+def get_view_label_v1(view_func, method):
+    """
+    The view class, or the view function,
+    followed by the DRF viewset action for method.
+    """
+    view_class = getattr(view_func, "view_class", None) or getattr(
+        view_func, "cls", None
+    )
+    view = view_class if view_class is not None else view_func
+    # Callable instances and functools.partial() have no __qualname__.
+    module = getattr(view, "__module__", type(view).__module__)
+    qualname = getattr(view, "__qualname__", type(view).__qualname__)
+    label = f"{module}.{qualname}"
+    actions = getattr(view_func, "actions", None)
+    if actions and method.lower() in actions:
+        label = f"{label}.{actions[method.lower()]}"
+    return label
+
+
+# pylint: disable-next=too-few-public-methods
+class EndpointRequestV1:
+    """
+    The endpoint and the queries of the current request.
+    """
+
+    __slots__ = (
+        "method",
+        "route",
+        "view",
+        "key",
+        "query_count",
+        "duration",
+    )
+
+    def __init__(self, method):
+        self.method = method
+        self.route = UNRESOLVED_ROUTE
+        self.view = None
+        self.key = f"{method} {UNRESOLVED_ROUTE}"
+        self.query_count = 0
+        self.duration = 0
+
+    def set_view(self, resolver_match, view_func):
+        """
+        Set the endpoint with the resolved view.
+        """
+        if resolver_match is not None:
+            # Not view_name, that falls back to the dotted path
+            # of the view, and the routes without a name
+            # would not be told apart.
+            self.route = (
+                resolver_match.url_name or resolver_match.route
+            )
+        self.view = get_view_label_v1(view_func, self.method)
+        self.key = f"{self.method} {self.route} {self.view}"
+
+
+def get_current_endpoint_v1():
+    """
+    The EndpointRequestV1 of the current request, or None.
+    """
+    return _current_request.get()
+
+
+def get_endpoint_key_v1(extra_data_dict, data):
+    """
+    The allocated subsets key generator of the endpoints,
+    None outside of a request.
+    """
+    # pylint: disable=unused-argument
+    endpoint_request = _current_request.get()
+    if endpoint_request is None:
+        return None
+    return endpoint_request.key
+
+
+def get_endpoints_init_kwargs_v1(**template_kwargs):
+    """
+    The keyword arguments of
+    get_extra_data_template_for_set_of_queries_v1()
+    for a dict per endpoint, with the given template arguments.
+    The dicts are shared by the root dicts initialized with them:
+    call it again for each root dict.
+    """
+    return {
+        "allocated_subsets_extra_data": {ENDPOINTS_SUBSET_KEY: {}},
+        "allocated_subsets_key_callback": {
+            ENDPOINTS_SUBSET_KEY: get_endpoint_key_v1,
+        },
+        "allocated_subsets_init_callback": {
+            ENDPOINTS_SUBSET_KEY: lambda x, y: (
+                get_extra_data_template_for_set_of_queries_v1(
+                    **template_kwargs
+                )
+            ),
+        },
+    }
+
+
+def init_endpoints_extra_data_v1(
+    manager=None, empty_stash_stack=False, **template_kwargs
+):
+    """
+    init_connections_extra_data() with a dict per endpoint,
+    new ones for each root dict.
+    """
+    init_connections_extra_data(
+        lambda: get_extra_data_template_for_set_of_queries_v1(
+            manager=manager,
+            **get_endpoints_init_kwargs_v1(**template_kwargs),
+        ),
+        manager=manager,
+        empty_stash_stack=empty_stash_stack,
+    )
+
+
+def endpoint_query_wrapper_v1(execute, sql, params, many, context):
+    """
+    The query wrapper of EndpointMiddlewareV1.
+    """
+    endpoint_request = _current_request.get()
+    if endpoint_request is None:
+        return execute(sql, params, many, context)
+    endpoint_request.query_count += 1
+    start_time = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        endpoint_request.duration += time.perf_counter() - start_time
+
+
+def get_bucket_v1(scale):
+    """
+    An empty bucket of the sliding window of an endpoint.
+    """
+    return {
+        "request_count": 0,
+        "query_count": 0,
+        "duration": 0,
+        # {query_count: request_count}
+        "query_count_counter": Counter(),
+        "duration_histogram": get_duration_histogram_v1(scale),
+    }
+
+
+def get_query_count_percentiles_v1(query_count_counter, quantiles):
+    """
+    The exact query counts at the given quantiles (between 0 and 1),
+    in the same order, or None values without requests,
+    with the ranks of get_duration_percentiles_v1().
+    """
+    total_count = sum(query_count_counter.values())
+    if total_count == 0:
+        return [None] * len(quantiles)
+    sorted_counts = sorted(query_count_counter.items())
+    result = []
+    for quantile in quantiles:
+        rank = quantile * total_count
+        cumulative_count = 0
+        value = None
+        for query_count, count in sorted_counts:
+            cumulative_count += count
+            value = query_count
+            if cumulative_count >= rank:
+                break
+        result.append(value)
+    return result
+
+
+class EndpointStatsStoreV1:
+    """
+    The sliding windows of the endpoints of a worker:
+    {endpoint_key: {bucket_index: bucket}}.
+    """
+
+    def __init__(
+        self,
+        window_seconds=WINDOW_SECONDS,
+        bucket_seconds=BUCKET_SECONDS,
+        scale=DEFAULT_SCALE,
+    ):
+        self.lock = threading.Lock()
+        self.bucket_seconds = bucket_seconds
+        self.bucket_count = max(
+            1, int(window_seconds // bucket_seconds)
+        )
+        self.scale = scale
+        self.endpoints = {}
+
+    def get_min_bucket_index(self, now):
+        """
+        The oldest bucket index in the window.
+        """
+        return int(now // self.bucket_seconds) - self.bucket_count + 1
+
+    def add_request(self, key, query_count, duration, now=None):
+        """
+        Add the queries of a request of the endpoint key.
+        """
+        if now is None:
+            now = time.time()
+        bucket_index = int(now // self.bucket_seconds)
+        with self.lock:
+            buckets = self.endpoints.get(key)
+            if buckets is None:
+                if len(self.endpoints) >= MAX_ENDPOINTS:
+                    key = OTHER_ENDPOINT
+                buckets = self.endpoints.setdefault(key, {})
+            bucket = buckets.get(bucket_index)
+            if bucket is None:
+                bucket = buckets[bucket_index] = get_bucket_v1(
+                    self.scale
+                )
+                min_bucket_index = self.get_min_bucket_index(now)
+                for old_index in [
+                    index
+                    for index in buckets
+                    if index < min_bucket_index
+                ]:
+                    del buckets[old_index]
+            bucket["request_count"] += 1
+            bucket["query_count"] += query_count
+            bucket["duration"] += duration
+            bucket["query_count_counter"][query_count] += 1
+            add_to_duration_histogram_v1(
+                bucket["duration_histogram"], duration
+            )
+
+    def get_endpoint_stats(self, buckets, min_bucket_index):
+        """
+        The stats of the buckets of an endpoint in the window.
+        """
+        result = get_bucket_v1(self.scale)
+        for bucket_index, bucket in buckets.items():
+            if bucket_index < min_bucket_index:
+                continue
+            for field in ("request_count", "query_count", "duration"):
+                result[field] += bucket[field]
+            result["query_count_counter"].update(
+                bucket["query_count_counter"]
+            )
+            merge_duration_histograms_v1(
+                result["duration_histogram"],
+                bucket["duration_histogram"],
+            )
+        quantiles = list(ENDPOINT_PERCENTILES.values())
+        query_count_percentiles = get_query_count_percentiles_v1(
+            result.pop("query_count_counter"), quantiles
+        )
+        duration_percentiles = get_duration_percentiles_v1(
+            result.pop("duration_histogram"), quantiles
+        )
+        for name, query_count, duration in zip(
+            ENDPOINT_PERCENTILES,
+            query_count_percentiles,
+            duration_percentiles,
+        ):
+            result[f"{name}_query_count"] = query_count
+            result[f"{name}_duration"] = duration
+        return result
+
+    def get_stats(self, now=None):
+        """
+        The stats of the endpoints with requests in the window,
+        keyed by endpoint.
+        The endpoints without requests in the window are dropped.
+        """
+        if now is None:
+            now = time.time()
+        min_bucket_index = self.get_min_bucket_index(now)
+        result = {}
+        with self.lock:
+            for key, buckets in list(self.endpoints.items()):
+                if all(index < min_bucket_index for index in buckets):
+                    del self.endpoints[key]
+                    continue
+                result[key] = self.get_endpoint_stats(
+                    buckets, min_bucket_index
+                )
+        return result
+
+
+endpoint_stats_store = EndpointStatsStoreV1()
+
+
+class EndpointMiddlewareV1:
+    """
+    Attribute the queries of each request to its endpoint,
+    and add them to endpoint_stats_store,
+    see the module docstring.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.store = endpoint_stats_store
+
+    def __call__(self, request):
+        endpoint_request = EndpointRequestV1(request.method)
+        token = _current_request.set(endpoint_request)
+        try:
+            with contextlib.ExitStack() as exit_stack:
+                wrap_connections(
+                    exit_stack, endpoint_query_wrapper_v1
+                )
+                return self.get_response(request)
+        finally:
+            _current_request.reset(token)
+            self.store.add_request(
+                endpoint_request.key,
+                endpoint_request.query_count,
+                endpoint_request.duration,
+            )
+
+    def process_view(
+        self, request, view_func, view_args, view_kwargs
+    ):
+        """
+        The view is resolved: set the endpoint.
+        """
+        # pylint: disable=unused-argument
+        endpoint_request = _current_request.get()
+        if endpoint_request is not None:
+            endpoint_request.set_view(
+                getattr(request, "resolver_match", None), view_func
+            )
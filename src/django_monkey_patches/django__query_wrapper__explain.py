@@ -0,0 +1,267 @@
+"""
+This file is part of django-monkey-patches library.
+
+django-monkey-patches is free software:
+you can redistribute it and/or modify it under the terms
+of the GNU Lesser General Public License
+as published by the Free Software Foundation,
+either version 3 of the License,
+or (at your option) any later version.
+
+django-monkey-patches is distributed in the hope
+that it will be useful,
+but WITHOUT ANY WARRANTY;
+without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU Lesser General Public License for more details.
+
+You should have received a copy of
+the GNU Lesser General Public License
+along with django-monkey-patches.
+If not, see <http://www.gnu.org/licenses/>.
+
+©Copyright 2023-2024 Laurent Lyaudet
+----------------------------------------------------------------------
+Capture the execution plan of the slow queries
+when the slowness happens:
+a SELECT slower than EXPLAIN_THRESHOLD_SECONDS is run again
+with the EXPLAIN prefix of its database backend
+(EXPLAIN QUERY PLAN with SQLite, EXPLAIN (FORMAT JSON)
+with PostgreSQL, optionally with ANALYZE),
+at most once per SQL signature every EXPLAIN_WINDOW_SECONDS.
+The plans are cached by SQL fingerprint (v2),
+and the insertion callback store_explain_plan_v1()
+puts the plan next to the aggregate of the signature.
+
+The EXPLAIN is executed on a cursor of the database backend,
+not on a Django cursor wrapper,
+hence it is not seen by the query wrappers.
+Inside a transaction (an atomic block, or autocommit off),
+it is run in a savepoint rolled back after,
+so that a failing EXPLAIN does not break your transaction.
+With ANALYZE, the query is executed again,
+in a READ ONLY transaction when autocommit is on
+outside of an atomic block.
+
+For example:
+django__query_wrapper.TIME_QUERIES = True
+django__query_wrapper.POST_EXECUTION_CALLBACK = (
+    get_explaining_post_execution_callback_v1()
+)
+init_connections_extra_data_v1(
+    allocated_subsets_extra_data={"signatures": {}},
+    allocated_subsets_key_callback={
+        "signatures": get_sql_signature_v2,
+    },
+    allocated_subsets_init_callback={
+        "signatures": lambda x, y: (
+            get_extra_data_template_for_set_of_queries_v1(
+                insertion_callback=store_explain_plan_v1,
+            )
+        ),
+    },
+)
+"""
+
+import logging
+import threading
+import time
+
+from .django__query_wrapper import (
+    get_full_query_v1,
+    get_sql_signature_and_fingerprint_v2,
+    insert_in_connections_extra_data_v1,
+)
+
+logger = logging.getLogger(__name__)
+
+EXPLAIN_THRESHOLD_SECONDS = 0.5
+# A signature is explained again after this delay.
+EXPLAIN_WINDOW_SECONDS = 3600
+# EXPLAIN ANALYZE executes the query again, PostgreSQL only.
+EXPLAIN_ANALYZE = False
+# The oldest plans are dropped above this size.
+EXPLAIN_CACHE_MAX_SIZE = 1000
+EXPLAIN_SAVEPOINT_NAME = "django_monkey_patches_explain"
+
+# The captured plans keyed by SQL fingerprint (v2).
+explain_plans_cache = {}
+# For the updates of explain_plans_cache, not for the reads.
+explain_plans_cache_lock = threading.Lock()
+
+
+def get_explain_prefix_v1(connection, analyze=False):
+    """
+    The EXPLAIN prefix of the database backend of connection,
+    in JSON format when it is supported.
+    """
+    options = {}
+    if analyze and connection.vendor == "postgresql":
+        options["analyze"] = True
+    explain_format = None
+    if "JSON" in connection.features.supported_explain_formats:
+        explain_format = "JSON"
+    return connection.ops.explain_query_prefix(
+        explain_format, **options
+    )
+
+
+def get_plan_from_rows(rows):
+    """
+    The JSON plan, or the rows of the plan as text.
+    """
+    if len(rows) == 1 and len(rows[0]) == 1:
+        return rows[0][0]
+    return "\n".join("\t".join(str(x) for x in row) for row in rows)
+
+
+def explain_query_v1(connection, sql, params, analyze=False):
+    """
+    Execute the EXPLAIN of the query on a backend cursor,
+    bypassing the query wrappers,
+    and return the plan.
+    """
+    analyze = analyze and connection.vendor == "postgresql"
+    explain_sql = (
+        f"{get_explain_prefix_v1(connection, analyze)} {sql}"
+    )
+    # With autocommit off, a transaction of the caller may be open:
+    # ROLLBACK would end it, and a failing EXPLAIN would abort it.
+    in_transaction = (
+        connection.in_atomic_block or not connection.get_autocommit()
+    )
+    cursor = connection.create_cursor()
+    try:
+        if in_transaction:
+            cursor.execute(f"SAVEPOINT {EXPLAIN_SAVEPOINT_NAME}")
+        elif analyze:
+            cursor.execute("BEGIN READ ONLY")
+        try:
+            cursor.execute(explain_sql, params)
+            return get_plan_from_rows(cursor.fetchall())
+        finally:
+            if in_transaction:
+                cursor.execute(
+                    f"ROLLBACK TO SAVEPOINT {EXPLAIN_SAVEPOINT_NAME}"
+                )
+                cursor.execute(
+                    f"RELEASE SAVEPOINT {EXPLAIN_SAVEPOINT_NAME}"
+                )
+            elif analyze:
+                cursor.execute("ROLLBACK")
+    finally:
+        cursor.close()
+
+
+def capture_explain_plan_v1(connection, sql, params, duration):
+    """
+    Capture the plan of a slow query in explain_plans_cache,
+    unless its signature was explained less than
+    EXPLAIN_WINDOW_SECONDS ago, and return the cached entry.
+    """
+    sql_signature, sql_fingerprint = (
+        get_sql_signature_and_fingerprint_v2(sql)
+    )
+    now = time.time()
+    entry = explain_plans_cache.get(sql_fingerprint)
+    if entry is not None and (
+        now - entry["explain_time"] < EXPLAIN_WINDOW_SECONDS
+    ):
+        return entry
+    try:
+        full_query = get_full_query_v1(
+            None,
+            {
+                "sql": sql,
+                "params": params,
+                "context": {"connection": connection},
+            },
+        )
+    except AttributeError:
+        # No mogrify() with this backend.
+        full_query = None
+    entry = {
+        "sql_signature": sql_signature,
+        "full_query": full_query,
+        "duration": duration,
+        "explain_time": now,
+        "analyze": EXPLAIN_ANALYZE,
+        "plan": None,
+        "error": None,
+    }
+    try:
+        entry["plan"] = explain_query_v1(
+            connection, sql, params, EXPLAIN_ANALYZE
+        )
+    # pylint: disable-next=broad-exception-caught
+    except Exception as exception:
+        # Profiling must not break the application.
+        entry["error"] = repr(exception)
+        logger.warning("EXPLAIN failed for %s: %r", sql, exception)
+    with explain_plans_cache_lock:
+        # The latest plan is the last one in the insertion order.
+        explain_plans_cache.pop(sql_fingerprint, None)
+        explain_plans_cache[sql_fingerprint] = entry
+        while len(explain_plans_cache) > EXPLAIN_CACHE_MAX_SIZE:
+            del explain_plans_cache[next(iter(explain_plans_cache))]
+    return entry
+
+
+def is_explainable(sql, many):
+    """
+    Only single SELECT statements are explained.
+    """
+    if many:
+        return False
+    start = sql.lstrip()[:6].upper()
+    return start == "SELECT" or start[:4] == "WITH"
+
+
+def get_explaining_post_execution_callback_v1(
+    post_execution_callback=insert_in_connections_extra_data_v1,
+):
+    """
+    A POST_EXECUTION_CALLBACK capturing the plans of slow queries
+    before calling post_execution_callback,
+    so that insertion callbacks see the fresh plan.
+    """
+
+    def explaining_post_execution_callback(*args):
+        # args are execute, sql, params, many, context, call_stack,
+        # start_time, result, end_time, duration.
+        duration = args[9]
+        if (
+            duration is not None
+            and duration >= EXPLAIN_THRESHOLD_SECONDS
+            and is_explainable(args[1], args[3])
+        ):
+            capture_explain_plan_v1(
+                args[4]["connection"], args[1], args[2], duration
+            )
+        return post_execution_callback(*args)
+
+    return explaining_post_execution_callback
+
+
+def get_explain_plan_v1(extra_data_dict, data):
+    """
+    The cached plan entry of the query, or None.
+    """
+    # pylint: disable=unused-argument
+    return explain_plans_cache.get(
+        get_sql_signature_and_fingerprint_v2(data["sql"])[1]
+    )
+
+
+get_explain_plan_v1.field_name = "explain_plan"
+
+
+def store_explain_plan_v1(extra_data_dict, data):
+    """
+    An insertion callback keeping in extra_data_dict["explain_plan"]
+    the latest plan captured for the queries of this dict,
+    for the dicts of allocated subsets keyed by signature.
+    """
+    entry = get_explain_plan_v1(extra_data_dict, data)
+    if entry is not None:
+        extra_data_dict["explain_plan"] = entry
@@ -0,0 +1,259 @@
+"""
+This file is part of django-monkey-patches library.
+
+django-monkey-patches is free software:
+you can redistribute it and/or modify it under the terms
+of the GNU Lesser General Public License
+as published by the Free Software Foundation,
+either version 3 of the License,
+or (at your option) any later version.
+
+django-monkey-patches is distributed in the hope
+that it will be useful,
+but WITHOUT ANY WARRANTY;
+without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU Lesser General Public License for more details.
+
+You should have received a copy of
+the GNU Lesser General Public License
+along with django-monkey-patches.
+If not, see <http://www.gnu.org/licenses/>.
+
+©Copyright 2023-2024 Laurent Lyaudet
+----------------------------------------------------------------------
+The query wrappers only time execute(),
+but with large results, and with server-side cursors,
+most of the cost is in fetchone(), fetchmany() and fetchall(),
+after the query wrapper returned.
+
+apply_fetch_timing_patch_v1() patches these methods
+of Django's CursorWrapper, and the insertion callback
+track_fetch_stats_v1() gives the query to the patched methods,
+with the extra data dicts it was inserted in.
+Each fetch then updates extra_data_dict["fetch_stats"]
+of these dicts: the number of fetches, the time spent fetching,
+the rows and, with MEASURE_FETCHED_BYTES,
+the approximate bytes fetched.
+"fetch_stats" is written back in each dict after each update,
+since the dicts of a manager only give copies of it.
+A query fetching more than LARGE_RESULT_ROW_COUNT rows
+on a client-side cursor is counted in "large_result_count",
+and logged with LOG_LARGE_RESULTS:
+it should be paginated or use .iterator().
+The cursors that are not given a query by track_fetch_stats_v1()
+only pay a dict lookup per fetch.
+
+For example:
+apply_fetch_timing_patch_v1()
+django__query_wrapper.TIME_QUERIES = True
+django__query_wrapper.POST_EXECUTION_CALLBACK = (
+    insert_in_connections_extra_data_v1
+)
+init_connections_extra_data_v1(
+    allocated_subsets_extra_data={"signatures": {}},
+    allocated_subsets_key_callback={
+        "signatures": get_sql_signature_v2,
+    },
+    allocated_subsets_init_callback={
+        "signatures": lambda x, y: (
+            get_extra_data_template_for_set_of_queries_v1(
+                insertion_callback=track_fetch_stats_v1,
+            )
+        ),
+    },
+)
+"""
+
+import functools
+import logging
+import time
+
+# pylint: disable-next=import-error
+from django.db.backends.utils import CursorWrapper
+
+logger = logging.getLogger(__name__)
+
+# Above this number of rows, a query is a large result.
+LARGE_RESULT_ROW_COUNT = 1000
+LOG_LARGE_RESULTS = True
+# Measuring the bytes costs a loop on the values of each row.
+MEASURE_FETCHED_BYTES = False
+# The approximate size of a value that is not a string or bytes.
+SCALAR_VALUE_BYTES = 8
+# The attribute of the CursorWrapper holding the query.
+CURSOR_ATTRIBUTE_NAME = "django_monkey_patches_fetch_query"
+
+_original_methods = {}
+
+
+def get_fetch_stats_v1():
+    """
+    The empty "fetch_stats" of an extra data dict.
+    """
+    return {
+        "query_count": 0,
+        "fetch_count": 0,
+        "fetch_duration": 0,
+        "row_count": 0,
+        "byte_count": 0,
+        "max_row_count": 0,
+        "large_result_count": 0,
+    }
+
+
+def get_approximate_row_bytes_v1(row):
+    """
+    The length of the strings and bytes of a row,
+    and SCALAR_VALUE_BYTES for the other values.
+    """
+    byte_count = 0
+    for value in row:
+        if isinstance(value, (str, bytes, bytearray, memoryview)):
+            byte_count += len(value)
+        else:
+            byte_count += SCALAR_VALUE_BYTES
+    return byte_count
+
+
+# pylint: disable-next=too-few-public-methods
+class FetchedQueryV1:
+    """
+    The fetches of a query,
+    and the extra data dicts whose "fetch_stats" it must update.
+    """
+
+    __slots__ = ("sql", "extra_data_dicts", "row_count")
+
+    def __init__(self, sql):
+        self.sql = sql
+        self.extra_data_dicts = []
+        self.row_count = 0
+
+    def add_fetch(self, cursor, duration, rows):
+        """
+        Update the "fetch_stats" dicts with a fetch of rows.
+        """
+        previous_row_count = self.row_count
+        row_count = len(rows)
+        self.row_count += row_count
+        byte_count = 0
+        if MEASURE_FETCHED_BYTES:
+            byte_count = sum(
+                get_approximate_row_bytes_v1(row) for row in rows
+            )
+        is_large_result = (
+            previous_row_count
+            <= LARGE_RESULT_ROW_COUNT
+            < self.row_count
+            # Server-side cursors have a name.
+            and getattr(cursor.cursor, "name", None) is None
+        )
+        for extra_data_dict in self.extra_data_dicts:
+            # A copy with the dicts of a manager.
+            fetch_stats = extra_data_dict["fetch_stats"]
+            fetch_stats["fetch_count"] += 1
+            fetch_stats["fetch_duration"] += duration
+            fetch_stats["row_count"] += row_count
+            fetch_stats["byte_count"] += byte_count
+            fetch_stats["max_row_count"] = max(
+                fetch_stats["max_row_count"], self.row_count
+            )
+            if is_large_result:
+                fetch_stats["large_result_count"] += 1
+            extra_data_dict["fetch_stats"] = fetch_stats
+        if is_large_result and LOG_LARGE_RESULTS:
+            logger.warning(
+                "More than %d rows fetched by %s,"
+                " paginate it or use .iterator().",
+                LARGE_RESULT_ROW_COUNT,
+                self.sql[:200],
+            )
+
+
+def track_fetch_stats_v1(extra_data_dict, data):
+    """
+    The insertion callback giving the query to its cursor,
+    so that its fetches update extra_data_dict["fetch_stats"].
+    """
+    cursor = data["context"].get("cursor")
+    if cursor is None:
+        return
+    fetched_query = cursor.__dict__.get(CURSOR_ATTRIBUTE_NAME)
+    if fetched_query is None:
+        fetched_query = FetchedQueryV1(data["sql"])
+        cursor.__dict__[CURSOR_ATTRIBUTE_NAME] = fetched_query
+    fetch_stats = extra_data_dict.get("fetch_stats")
+    if fetch_stats is None:
+        fetch_stats = extra_data_dict["fetch_stats"] = (
+            get_fetch_stats_v1()
+        )
+    fetch_stats["query_count"] += 1
+    extra_data_dict["fetch_stats"] = fetch_stats
+    fetched_query.extra_data_dicts.append(extra_data_dict)
+
+
+def get_forgetting_execute(original_method):
+    """
+    The patched CursorWrapper.execute() and executemany():
+    a new query forgets the fetches of the previous one.
+    """
+
+    def execute(self, *args, **kwargs):
+        self.__dict__.pop(CURSOR_ATTRIBUTE_NAME, None)
+        return original_method(self, *args, **kwargs)
+
+    return functools.wraps(original_method)(execute)
+
+
+def get_timed_fetch_method(method_name):
+    """
+    The patched fetch method,
+    instead of CursorWrapper.__getattr__().
+    """
+
+    def fetch_method(self, *args):
+        fetched_query = self.__dict__.get(CURSOR_ATTRIBUTE_NAME)
+        with self.db.wrap_database_errors:
+            if fetched_query is None:
+                return getattr(self.cursor, method_name)(*args)
+            start_time = time.perf_counter()
+            result = getattr(self.cursor, method_name)(*args)
+        duration = time.perf_counter() - start_time
+        if method_name == "fetchone":
+            rows = () if result is None else (result,)
+        else:
+            rows = result
+        fetched_query.add_fetch(self, duration, rows)
+        return result
+
+    fetch_method.__name__ = method_name
+    return fetch_method
+
+
+def apply_fetch_timing_patch_v1():
+    """
+    Patch the fetch methods of CursorWrapper, once,
+    and return the original methods.
+    """
+    if _original_methods:
+        return dict(_original_methods)
+    for method_name in ("execute", "executemany"):
+        original_method = getattr(CursorWrapper, method_name)
+        _original_methods[method_name] = original_method
+        setattr(
+            CursorWrapper,
+            method_name,
+            get_forgetting_execute(original_method),
+        )
+    for method_name in ("fetchone", "fetchmany", "fetchall"):
+        # None: CursorWrapper.__getattr__() was used.
+        _original_methods[method_name] = CursorWrapper.__dict__.get(
+            method_name
+        )
+        setattr(
+            CursorWrapper,
+            method_name,
+            get_timed_fetch_method(method_name),
+        )
+    return dict(_original_methods)
@@ -0,0 +1,185 @@
+"""
+This file is part of django-monkey-patches library.
+
+django-monkey-patches is free software:
+you can redistribute it and/or modify it under the terms
+of the GNU Lesser General Public License
+as published by the Free Software Foundation,
+either version 3 of the License,
+or (at your option) any later version.
+
+django-monkey-patches is distributed in the hope
+that it will be useful,
+but WITHOUT ANY WARRANTY;
+without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU Lesser General Public License for more details.
+
+You should have received a copy of
+the GNU Lesser General Public License
+along with django-monkey-patches.
+If not, see <http://www.gnu.org/licenses/>.
+
+©Copyright 2023-2024 Laurent Lyaudet
+----------------------------------------------------------------------
+Log-linear histograms of durations, like HDR histograms:
+each power of 2 is split in 2**scale linear sub-buckets,
+hence the relative error of a percentile is at most 2**-scale
+(about 3% with the default scale 5).
+Only the non-empty buckets are stored, in a dict,
+and durations from 1 microsecond to 1000 seconds
+need at most 30 * 2**scale buckets: the memory is bounded.
+Two histograms with the same scale are merged
+by adding their counts, whatever the process that filled them.
+
+A histogram is a plain dict, so that it can be pickled
+or be a managed dict:
+{"scale": 5, "zero_count": 0, "counts": {bucket_index: count}}
+"""
+
+import bisect
+import math
+
+DEFAULT_SCALE = 5
+# The percentiles computed by synthetize_extra_data_dict_v1(),
+# with the name of their field.
+PERCENTILES = {
+    "p50_duration": 0.5,
+    "p90_duration": 0.9,
+    "p99_duration": 0.99,
+    "p999_duration": 0.999,
+}
+
+
+def get_duration_histogram_v1(scale=DEFAULT_SCALE, counts=None):
+    """
+    An empty histogram; counts can be a managed dict.
+    """
+    if counts is None:
+        counts = {}
+    return {"scale": scale, "zero_count": 0, "counts": counts}
+
+
+def get_bucket_index_v1(value, scale):
+    """
+    The index of the bucket of a positive value.
+    """
+    mantissa, exponent = math.frexp(value)
+    # mantissa is in [0.5, 1[.
+    sub_bucket_count = 1 << scale
+    return exponent * sub_bucket_count + int(
+        (mantissa * 2 - 1) * sub_bucket_count
+    )
+
+
+def get_bucket_value_v1(index, scale):
+    """
+    The middle of the bucket of the given index.
+    """
+    sub_bucket_count = 1 << scale
+    exponent, sub_bucket = divmod(index, sub_bucket_count)
+    return math.ldexp(
+        1 + (sub_bucket + 0.5) / sub_bucket_count, exponent - 1
+    )
+
+
+def get_bucket_upper_bound_v1(index, scale):
+    """
+    The (exclusive) upper bound of the bucket of the given index.
+    """
+    sub_bucket_count = 1 << scale
+    exponent, sub_bucket = divmod(index, sub_bucket_count)
+    return math.ldexp(
+        1 + (sub_bucket + 1) / sub_bucket_count, exponent - 1
+    )
+
+
+def add_to_duration_histogram_v1(histogram, duration, weight=1):
+    """
+    Count a duration weight times (see SAMPLE_QUERIES).
+    """
+    if duration <= 0:
+        histogram["zero_count"] += weight
+        return
+    counts = histogram["counts"]
+    index = get_bucket_index_v1(duration, histogram["scale"])
+    counts[index] = counts.get(index, 0) + weight
+
+
+def merge_duration_histograms_v1(target, source):
+    """
+    Add the counts of source in target.
+    """
+    if target["scale"] != source["scale"]:
+        raise ValueError(
+            "Histograms with different scales cannot be merged:"
+            f" {target['scale']} and {source['scale']}"
+        )
+    target["zero_count"] += source["zero_count"]
+    counts = target["counts"]
+    for index, count in source["counts"].items():
+        counts[index] = counts.get(index, 0) + count
+    return target
+
+
+def get_duration_percentiles_v1(histogram, quantiles):
+    """
+    The durations at the given quantiles (between 0 and 1),
+    in the same order, or None values for an empty histogram.
+    """
+    counts = histogram["counts"]
+    total_count = histogram["zero_count"] + sum(counts.values())
+    if total_count == 0:
+        return [None] * len(quantiles)
+    scale = histogram["scale"]
+    sorted_buckets = sorted(counts.items())
+    result = []
+    for quantile in quantiles:
+        rank = quantile * total_count
+        cumulative_count = histogram["zero_count"]
+        value = 0
+        if cumulative_count < rank:
+            for index, count in sorted_buckets:
+                cumulative_count += count
+                value = get_bucket_value_v1(index, scale)
+                if cumulative_count >= rank:
+                    break
+        result.append(value)
+    return result
+
+
+def get_cumulative_counts_v1(histogram, upper_bounds):
+    """
+    The cumulative counts of the histogram at the sorted upper bounds,
+    for fixed buckets like the ones of Prometheus,
+    followed by the total count (+Inf).
+    The powers of 2 are bounds of the buckets at any scale,
+    and give exact counts,
+    a bucket across another bound is counted above it.
+    """
+    counts = [0] * (len(upper_bounds) + 1)
+    counts[0] = histogram["zero_count"]
+    scale = histogram["scale"]
+    for index, count in histogram["counts"].items():
+        counts[
+            bisect.bisect_left(
+                upper_bounds, get_bucket_upper_bound_v1(index, scale)
+            )
+        ] += count
+    for position in range(1, len(counts)):
+        counts[position] += counts[position - 1]
+    return counts
+
+
+def set_percentiles_of_extra_data_dict_v1(extra_data_dict):
+    """
+    Fill the fields of PERCENTILES with the duration histogram.
+    """
+    histogram = extra_data_dict.get("duration_histogram")
+    if histogram is None:
+        return
+    values = get_duration_percentiles_v1(
+        histogram, list(PERCENTILES.values())
+    )
+    for field, value in zip(PERCENTILES, values):
+        extra_data_dict[field] = value
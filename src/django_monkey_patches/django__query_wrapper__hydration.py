@@ -0,0 +1,255 @@
+"""
+This file is part of django-monkey-patches library.
+
+django-monkey-patches is free software:
+you can redistribute it and/or modify it under the terms
+of the GNU Lesser General Public License
+as published by the Free Software Foundation,
+either version 3 of the License,
+or (at your option) any later version.
+
+django-monkey-patches is distributed in the hope
+that it will be useful,
+but WITHOUT ANY WARRANTY;
+without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU Lesser General Public License for more details.
+
+You should have received a copy of
+the GNU Lesser General Public License
+along with django-monkey-patches.
+If not, see <http://www.gnu.org/licenses/>.
+
+©Copyright 2023-2024 Laurent Lyaudet
+----------------------------------------------------------------------
+The time spent building model instances from the rows
+(from_db(), select_related() populators, annotations,
+known related objects) in ModelIterable,
+that the query wrappers cannot see.
+With big list endpoints, it is often more than the SQL time,
+and values(), only() or a cache would help.
+
+apply_hydration_timing_patch_v1() patches ModelIterable.__iter__()
+and SQLCompiler.execute_sql().
+Each step of the iteration is timed,
+minus the time of the SQL and of the fetches done in it,
+and minus the time of the nested iterations
+(queries done while building an instance).
+The insertion callback track_hydration_v1() attributes
+the hydration of a queryset to the dicts its query is inserted in,
+in extra_data_dict["hydration_stats"], per model label:
+{"iteration_count": 0, "instance_count": 0, "duration": 0}.
+For example, on the root dict of connections you get
+the hydration per model, next to "total_duration",
+and on the dicts per SQL signature,
+the hydration of each signature.
+When no dict tracks the query of an iteration,
+the rest of the iteration is not timed.
+
+For example:
+apply_hydration_timing_patch_v1()
+django__query_wrapper.TIME_QUERIES = True
+django__query_wrapper.POST_EXECUTION_CALLBACK = (
+    insert_in_connections_extra_data_v1
+)
+init_connections_extra_data_v1()
+get_connection_dict(connections)["insertion_callback"] = (
+    track_hydration_v1
+)
+"""
+
+# Django's _meta API is public.
+# pylint: disable=protected-access
+
+import contextvars
+import functools
+import time
+
+# pylint: disable-next=import-error
+from django.db.models.query import ModelIterable
+
+# pylint: disable-next=import-error
+from django.db.models.sql.compiler import SQLCompiler
+
+# pylint: disable-next=import-error
+from django.db.models.sql.constants import MULTI
+
+_current_iteration = contextvars.ContextVar(
+    "django_monkey_patches_hydration", default=None
+)
+_original_methods = {}
+
+
+# pylint: disable-next=too-few-public-methods
+class HydrationV1:
+    """
+    The iteration of a ModelIterable being timed.
+    """
+
+    __slots__ = ("excluded_duration", "collecting", "stats_list")
+
+    def __init__(self):
+        # The time of SQL, fetches and nested iterations.
+        self.excluded_duration = 0
+        # True until the query of the iteration is executed.
+        self.collecting = True
+        self.stats_list = []
+
+
+def get_hydration_stats_v1():
+    """
+    The empty stats of a model in "hydration_stats".
+    """
+    return {"iteration_count": 0, "instance_count": 0, "duration": 0}
+
+
+def track_hydration_v1(extra_data_dict, data):
+    """
+    The insertion callback attributing the hydration
+    of the instances of the query to extra_data_dict.
+    """
+    # pylint: disable=unused-argument
+    iteration = _current_iteration.get()
+    if iteration is None or not iteration.collecting:
+        return
+    hydration_stats = extra_data_dict.get("hydration_stats")
+    if hydration_stats is None:
+        hydration_stats = extra_data_dict["hydration_stats"] = {}
+    iteration.stats_list.append(hydration_stats)
+
+
+def add_excluded_duration(duration):
+    """
+    Exclude a duration from the current step of the iteration.
+    """
+    iteration = _current_iteration.get()
+    if iteration is not None:
+        iteration.excluded_duration += duration
+
+
+def get_timed_chunks(chunks):
+    """
+    The chunks of a chunked fetch,
+    fetched in the steps of the iteration.
+    """
+    iterator = iter(chunks)
+    while True:
+        start_time = time.perf_counter()
+        try:
+            chunk = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            add_excluded_duration(time.perf_counter() - start_time)
+        yield chunk
+
+
+def get_timed_execute_sql(original_execute_sql):
+    """
+    The patched SQLCompiler.execute_sql().
+    """
+
+    def execute_sql(self, *args, **kwargs):
+        iteration = _current_iteration.get()
+        if iteration is None:
+            return original_execute_sql(self, *args, **kwargs)
+        start_time = time.perf_counter()
+        try:
+            result = original_execute_sql(self, *args, **kwargs)
+        finally:
+            iteration.excluded_duration += (
+                time.perf_counter() - start_time
+            )
+            # The first query of the iteration is its own.
+            iteration.collecting = False
+        result_type = args[0] if args else kwargs.get("result_type")
+        chunked_fetch = kwargs.get("chunked_fetch")
+        if len(args) > 1:
+            chunked_fetch = args[1]
+        if result_type in (None, MULTI) and chunked_fetch:
+            return get_timed_chunks(result)
+        return result
+
+    return functools.wraps(original_execute_sql)(execute_sql)
+
+
+def add_hydration(stats_list, model_label, instance_count, duration):
+    """
+    Add the hydration of an iteration to the "hydration_stats".
+    """
+    for hydration_stats in stats_list:
+        model_stats = hydration_stats.get(model_label)
+        if model_stats is None:
+            model_stats = hydration_stats[model_label] = (
+                get_hydration_stats_v1()
+            )
+        model_stats["iteration_count"] += 1
+        model_stats["instance_count"] += instance_count
+        model_stats["duration"] += duration
+
+
+def get_timed_iter(original_iter):
+    """
+    The patched ModelIterable.__iter__().
+    """
+
+    def timed_iter(self):
+        iterator = original_iter(self)
+        iteration = HydrationV1()
+        instance_count = 0
+        duration = 0
+        try:
+            while True:
+                token = _current_iteration.set(iteration)
+                excluded_duration = iteration.excluded_duration
+                start_time = time.perf_counter()
+                try:
+                    instance = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    step_duration = time.perf_counter() - start_time
+                    _current_iteration.reset(token)
+                    # A nested iteration excludes all its steps.
+                    add_excluded_duration(step_duration)
+                    duration += step_duration - (
+                        iteration.excluded_duration
+                        - excluded_duration
+                    )
+                instance_count += 1
+                if not iteration.stats_list:
+                    # Nobody tracks this query.
+                    yield instance
+                    yield from iterator
+                    return
+                yield instance
+        finally:
+            if iteration.stats_list:
+                add_hydration(
+                    iteration.stats_list,
+                    self.queryset.model._meta.label,
+                    instance_count,
+                    duration,
+                )
+
+    return functools.wraps(original_iter)(timed_iter)
+
+
+def apply_hydration_timing_patch_v1():
+    """
+    Patch ModelIterable and SQLCompiler, once,
+    and return the original methods.
+    """
+    if _original_methods:
+        return dict(_original_methods)
+    _original_methods["ModelIterable.__iter__"] = (
+        ModelIterable.__iter__
+    )
+    ModelIterable.__iter__ = get_timed_iter(ModelIterable.__iter__)
+    _original_methods["SQLCompiler.execute_sql"] = (
+        SQLCompiler.execute_sql
+    )
+    SQLCompiler.execute_sql = get_timed_execute_sql(
+        SQLCompiler.execute_sql
+    )
+    return dict(_original_methods)
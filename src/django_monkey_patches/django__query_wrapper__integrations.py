@@ -0,0 +1,495 @@
+"""
+This file is part of django-monkey-patches library.
+
+django-monkey-patches is free software:
+you can redistribute it and/or modify it under the terms
+of the GNU Lesser General Public License
+as published by the Free Software Foundation,
+either version 3 of the License,
+or (at your option) any later version.
+
+django-monkey-patches is distributed in the hope
+that it will be useful,
+but WITHOUT ANY WARRANTY;
+without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU Lesser General Public License for more details.
+
+You should have received a copy of
+the GNU Lesser General Public License
+along with django-monkey-patches.
+If not, see <http://www.gnu.org/licenses/>.
+
+©Copyright 2023-2024 Laurent Lyaudet
+----------------------------------------------------------------------
+Ready-made integrations of the custom query wrapper,
+instead of copying the middleware and the command
+of the docstring of custom_query_wrapper_v1():
+- QueryWrapperScopeV1 is a context manager and a decorator
+  for your jobs (rq, celery, cron, etc.),
+- QueryWrapperMiddlewareV1 opens a scope for each request,
+- QueryWrapperBaseCommandV1 opens a scope for each command.
+
+A scope inits the extra data dicts,
+wraps all the connections with specialized_query_wrapper_v1(),
+synthetizes the dicts at the end, and gives itself
+to the report callback, even if an exception is raised.
+The connections are always unwrapped at the end of the scope.
+A scope inside a scope stashes the dicts of the outer scope,
+and pops them at its end, without wrapping the connections again:
+its queries are only counted in its own dicts.
+The root dict of connections and the root dict of each connection
+get their own subsets (signatures, etc.),
+so that a query is counted once in each of them.
+With SAMPLE_QUERIES (the feature "sampling"),
+each outermost scope calls sample_request_v1(),
+see REQUEST_SAMPLING_PROBABILITY
+and QUERY_SAMPLING_PROBABILITY of django__query_wrapper.
+The first scope sets USE_CONTEXT_VARS of django__query_wrapper,
+so that the concurrent requests of a threaded (gthread,
+runserver) or ASGI server each have their own dicts
+and stash stacks: your own inits of the extra data dicts
+must use context variables too, or come after the first scope.
+
+The setting DJANGO_MONKEY_PATCHES_QUERY_WRAPPER selects
+the features of QUERY_WRAPPER_FEATURES, for example:
+DJANGO_MONKEY_PATCHES_QUERY_WRAPPER = {
+    # The default is ["count"], only COUNT_QUERIES,
+    # the cheapest configuration.
+    "FEATURES": ["histogram", "signatures", "n_plus_one"],
+    # Optional, given to configure_query_wrapper_v1() after
+    # the configuration of the features,
+    # callbacks can be dotted paths.
+    "CONFIGURATION": {"SAMPLE_QUERIES": True},
+    # Optional, a callable or a dotted path,
+    # called with the scope when it ends,
+    # the default logs the counts at the debug level.
+    "REPORT_CALLBACK": "path_to.reports.report_queries",
+    # Optional, False to disable all the scopes.
+    "ENABLED": True,
+}
+The configuration is applied on the first scope,
+and again after a change of the setting in your tests.
+
+For example, in settings.py:
+MIDDLEWARE = (
+    ...
+    "django_monkey_patches.django__query_wrapper__integrations"
+    ".QueryWrapperMiddlewareV1",
+    ...
+)
+
+class Command(QueryWrapperBaseCommandV1):
+    ...
+
+@QueryWrapperScopeV1(name="send_newsletter")
+def send_newsletter():
+    ...
+"""
+
+import contextlib
+import contextvars
+import logging
+
+# pylint: disable-next=import-error
+from django.conf import settings
+
+# pylint: disable-next=import-error
+from django.core.management.base import BaseCommand
+
+# pylint: disable-next=import-error
+from django.db import connections
+
+# pylint: disable-next=import-error
+from django.dispatch import receiver
+
+# pylint: disable-next=import-error
+from django.test.signals import setting_changed
+
+# pylint: disable-next=import-error
+from django.utils.module_loading import import_string
+
+from . import django__query_wrapper
+from .django__query_wrapper import (
+    configure_query_wrapper_v1,
+    get_chained_callbacks_v1,
+    get_connection_dict,
+    get_extra_data_template_for_set_of_queries_v1,
+    get_sql_signature_v2,
+    init_connection_extra_data,
+    init_connections_extra_data,
+    insert_in_connections_extra_data_v2,
+    pop_extra_data_dicts,
+    sample_request_v1,
+    specialized_query_wrapper_v1,
+    stash_extra_data_dicts,
+    synthetize_connections_extra_data_v1,
+    wrap_connections,
+)
+from .django__query_wrapper__duplicates import (
+    detect_duplicate_queries_v1,
+)
+from .django__query_wrapper__histogram import DEFAULT_SCALE
+from .django__query_wrapper__n_plus_one import detect_n_plus_one_v1
+
+logger = logging.getLogger(__name__)
+
+SETTING_NAME = "DJANGO_MONKEY_PATCHES_QUERY_WRAPPER"
+DEFAULT_FEATURES = ("count",)
+# The keys of the setting and of the configuration
+# that can be dotted paths.
+CALLBACK_NAMES = (
+    "PRE_EXECUTION_CALLBACK",
+    "POST_EXECUTION_CALLBACK",
+    "REPORT_CALLBACK",
+)
+
+# The constants set by the features, reset before applying them,
+# so that the features removed from the setting are disabled.
+BASE_CONFIGURATION = {
+    "COUNT_QUERIES": False,
+    "TIME_QUERIES": False,
+    "COMPUTE_CALL_STACK": False,
+    "LAZY_CALL_STACK": False,
+    "POST_EXECUTION_CALLBACK": None,
+    "SAMPLE_QUERIES": False,
+}
+INSERTING_CONFIGURATION = {
+    "TIME_QUERIES": True,
+    "POST_EXECUTION_CALLBACK": insert_in_connections_extra_data_v2,
+}
+CALL_STACK_CONFIGURATION = {
+    "COMPUTE_CALL_STACK": True,
+    "LAZY_CALL_STACK": True,
+}
+
+
+def get_signatures_init_kwargs_v1():
+    """
+    The dicts per SQL signature (v2) of the feature "signatures",
+    new ones for each root dict of each scope.
+    """
+    return {
+        "allocated_subsets_extra_data": {"signatures": {}},
+        "allocated_subsets_key_callback": {
+            "signatures": get_sql_signature_v2,
+        },
+        "allocated_subsets_init_callback": {
+            "signatures": lambda x, y: (
+                get_extra_data_template_for_set_of_queries_v1()
+            ),
+        },
+    }
+
+
+# A feature can have:
+# - "configuration" for configure_query_wrapper_v1(),
+# - "get_init_kwargs" returning new keyword arguments
+#   of get_extra_data_template_for_set_of_queries_v1()
+#   for each root dict of each scope,
+# - "root_insertion_callback" for the root dict of connections only,
+#   so that a query is not seen twice.
+# You can add your own features to this dict.
+QUERY_WRAPPER_FEATURES = {
+    "count": {
+        "configuration": {"COUNT_QUERIES": True},
+    },
+    "time": {
+        "configuration": INSERTING_CONFIGURATION,
+    },
+    "histogram": {
+        "configuration": INSERTING_CONFIGURATION,
+        "get_init_kwargs": lambda: {
+            "duration_histogram_scale": DEFAULT_SCALE,
+        },
+    },
+    "signatures": {
+        "configuration": INSERTING_CONFIGURATION,
+        "get_init_kwargs": get_signatures_init_kwargs_v1,
+    },
+    "call_stack": {
+        "configuration": CALL_STACK_CONFIGURATION,
+    },
+    "n_plus_one": {
+        "configuration": {
+            **INSERTING_CONFIGURATION,
+            **CALL_STACK_CONFIGURATION,
+        },
+        "root_insertion_callback": detect_n_plus_one_v1,
+    },
+    "duplicates": {
+        "configuration": {
+            **INSERTING_CONFIGURATION,
+            **CALL_STACK_CONFIGURATION,
+        },
+        "root_insertion_callback": detect_duplicate_queries_v1,
+    },
+    "sampling": {
+        "configuration": {"SAMPLE_QUERIES": True},
+    },
+}
+
+# The applied setup, see apply_query_wrapper_setup_v1().
+_applied_setup = {}
+_active_scopes = contextvars.ContextVar(
+    "django_monkey_patches_query_wrapper_scopes", default=()
+)
+
+
+def get_callback(callback):
+    """
+    Import the callbacks given as dotted paths.
+    """
+    if isinstance(callback, str):
+        return import_string(callback)
+    return callback
+
+
+def log_query_wrapper_scope_v1(scope):
+    """
+    The default report callback.
+    """
+    extra_data_dict = scope.extra_data_dict
+    if extra_data_dict is None:
+        return
+    logger.debug(
+        "%s: %d queries in %.6f s",
+        scope.name,
+        extra_data_dict["query_count"],
+        extra_data_dict["total_duration"],
+    )
+
+
+def get_query_wrapper_setup_v1(query_wrapper_settings=None):
+    """
+    The setup of the scopes for the given settings,
+    or the setting DJANGO_MONKEY_PATCHES_QUERY_WRAPPER:
+    a dict with the configuration of the query wrapper,
+    the init_kwargs getters, the root insertion callback
+    and the report callback.
+    """
+    if query_wrapper_settings is None:
+        query_wrapper_settings = getattr(settings, SETTING_NAME, {})
+    configuration = dict(BASE_CONFIGURATION)
+    get_init_kwargs_callbacks = []
+    root_insertion_callbacks = []
+    for feature_name in query_wrapper_settings.get(
+        "FEATURES", DEFAULT_FEATURES
+    ):
+        feature = QUERY_WRAPPER_FEATURES.get(feature_name)
+        if feature is None:
+            raise ValueError(
+                f"{SETTING_NAME} error:"
+                f" unknown feature {feature_name}"
+            )
+        configuration.update(feature.get("configuration", {}))
+        if feature.get("get_init_kwargs") is not None:
+            get_init_kwargs_callbacks.append(
+                feature["get_init_kwargs"]
+            )
+        if feature.get("root_insertion_callback") is not None:
+            root_insertion_callbacks.append(
+                feature["root_insertion_callback"]
+            )
+    if configuration.get("POST_EXECUTION_CALLBACK") is not None:
+        # The insertion already counts the queries.
+        configuration["COUNT_QUERIES"] = False
+    configuration.update(
+        query_wrapper_settings.get("CONFIGURATION", {})
+    )
+    for name in CALLBACK_NAMES:
+        if name in configuration:
+            configuration[name] = get_callback(configuration[name])
+    root_insertion_callback = None
+    if len(root_insertion_callbacks) == 1:
+        root_insertion_callback = root_insertion_callbacks[0]
+    elif root_insertion_callbacks:
+        root_insertion_callback = get_chained_callbacks_v1(
+            *root_insertion_callbacks
+        )
+    return {
+        "enabled": query_wrapper_settings.get("ENABLED", True),
+        "configuration": configuration,
+        "get_init_kwargs_callbacks": get_init_kwargs_callbacks,
+        "root_insertion_callback": root_insertion_callback,
+        "report_callback": get_callback(
+            query_wrapper_settings.get(
+                "REPORT_CALLBACK", log_query_wrapper_scope_v1
+            )
+        ),
+    }
+
+
+def apply_query_wrapper_setup_v1(query_wrapper_settings=None):
+    """
+    Configure the query wrapper for the scopes,
+    and return the setup.
+    """
+    query_wrapper_setup = get_query_wrapper_setup_v1(
+        query_wrapper_settings
+    )
+    if query_wrapper_setup["enabled"]:
+        # The scopes of concurrent requests must not share the dicts
+        # of the process-global connections.
+        django__query_wrapper.USE_CONTEXT_VARS = True
+        configure_query_wrapper_v1(
+            **query_wrapper_setup["configuration"]
+        )
+    _applied_setup["setup"] = query_wrapper_setup
+    return query_wrapper_setup
+
+
+@receiver(setting_changed)
+def reset_query_wrapper_setup_v1(setting=None, **kwargs):
+    """
+    Forget the setup, it is applied again on the next scope.
+    It is also a receiver of setting_changed for your tests.
+    """
+    # pylint: disable=unused-argument
+    if setting in (None, SETTING_NAME):
+        _applied_setup.clear()
+
+
+def get_init_kwargs(query_wrapper_setup):
+    """
+    New keyword arguments of
+    get_extra_data_template_for_set_of_queries_v1()
+    for a root dict of a scope.
+    """
+    init_kwargs = {}
+    for get_init_kwargs_callback in query_wrapper_setup[
+        "get_init_kwargs_callbacks"
+    ]:
+        init_kwargs.update(get_init_kwargs_callback())
+    return init_kwargs
+
+
+def get_extra_data_template_callback(query_wrapper_setup):
+    """
+    The template callback of init_connections_extra_data(),
+    with new init_kwargs for each root dict,
+    instead of sharing their subsets.
+    """
+
+    def get_extra_data_template():
+        return get_extra_data_template_for_set_of_queries_v1(
+            **get_init_kwargs(query_wrapper_setup)
+        )
+
+    return get_extra_data_template
+
+
+class QueryWrapperScopeV1(contextlib.ContextDecorator):
+    """
+    A scope of the query wrapper, see the module docstring.
+    After the scope, extra_data_dict is the root dict
+    of connections, and connections_extra_data_dicts
+    the root dicts of each connection by alias.
+    """
+
+    def __init__(self, name=None):
+        self.name = name
+        self.extra_data_dict = None
+        self.connections_extra_data_dicts = None
+        self.query_wrapper_setup = None
+        # The weight of sample_request_v1() with SAMPLE_QUERIES.
+        self.sampling_weight = None
+        self.exit_stack = None
+        self.token = None
+
+    def _recreate_cm(self):
+        # Each call of a decorated function has its own dicts.
+        return type(self)(name=self.name)
+
+    def __enter__(self):
+        query_wrapper_setup = _applied_setup.get("setup")
+        if query_wrapper_setup is None:
+            query_wrapper_setup = apply_query_wrapper_setup_v1()
+        if not query_wrapper_setup["enabled"]:
+            return self
+        self.query_wrapper_setup = query_wrapper_setup
+        scopes = _active_scopes.get()
+        get_extra_data_template = get_extra_data_template_callback(
+            query_wrapper_setup
+        )
+        if scopes:
+            stash_extra_data_dicts(
+                local_reinit_after_stash=lambda x: (
+                    init_connection_extra_data(
+                        x, get_extra_data_template
+                    )
+                ),
+            )
+        else:
+            init_connections_extra_data(get_extra_data_template)
+            if query_wrapper_setup["configuration"].get(
+                "SAMPLE_QUERIES"
+            ):
+                self.sampling_weight = sample_request_v1()
+        root_insertion_callback = query_wrapper_setup[
+            "root_insertion_callback"
+        ]
+        if root_insertion_callback is not None:
+            get_connection_dict(connections)[
+                "insertion_callback"
+            ] = root_insertion_callback
+        self.token = _active_scopes.set(scopes + (self,))
+        if not scopes:
+            self.exit_stack = contextlib.ExitStack()
+            wrap_connections(
+                self.exit_stack, specialized_query_wrapper_v1
+            )
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.query_wrapper_setup is None:
+            return False
+        try:
+            if self.exit_stack is not None:
+                self.exit_stack.close()
+                self.exit_stack = None
+            synthetize_connections_extra_data_v1()
+            self.extra_data_dict = get_connection_dict(connections)
+            self.connections_extra_data_dicts = {
+                connection_key: get_connection_dict(
+                    connections[connection_key]
+                )
+                for connection_key in connections
+            }
+            self.query_wrapper_setup["report_callback"](self)
+        finally:
+            _active_scopes.reset(self.token)
+            self.token = None
+            if _active_scopes.get():
+                pop_extra_data_dicts()
+        return False
+
+
+# pylint: disable-next=too-few-public-methods
+class QueryWrapperMiddlewareV1:
+    """
+    Open a QueryWrapperScopeV1 for each request,
+    named with its method and path.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with QueryWrapperScopeV1(
+            name=f"{request.method} {request.path}"
+        ):
+            return self.get_response(request)
+
+
+# pylint: disable-next=abstract-method
+class QueryWrapperBaseCommandV1(BaseCommand):
+    """
+    A BaseCommand opening a QueryWrapperScopeV1
+    around its execution, named with the module of the command.
+    """
+
+    def execute(self, *args, **options):
+        name = type(self).__module__.rsplit(".", 1)[-1]
+        with QueryWrapperScopeV1(name=f"command {name}"):
+            return super().execute(*args, **options)
@@ -0,0 +1,311 @@
+"""
+This file is part of django-monkey-patches library.
+
+django-monkey-patches is free software:
+you can redistribute it and/or modify it under the terms
+of the GNU Lesser General Public License
+as published by the Free Software Foundation,
+either version 3 of the License,
+or (at your option) any later version.
+
+django-monkey-patches is distributed in the hope
+that it will be useful,
+but WITHOUT ANY WARRANTY;
+without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU Lesser General Public License for more details.
+
+You should have received a copy of
+the GNU Lesser General Public License
+along with django-monkey-patches.
+If not, see <http://www.gnu.org/licenses/>.
+
+©Copyright 2023-2024 Laurent Lyaudet
+----------------------------------------------------------------------
+An insertion callback for the custom query wrapper
+that detects N+1 queries:
+the same SQL signature executed again and again
+from the same call site in the same extra data dict (scope).
+When it happens, it tries to map the table and the filtered column
+of the query back to a model relation,
+and it suggests the missing select_related()/prefetch_related().
+
+For example:
+from django.db import connections
+from django_monkey_patches import (
+    django__query_wrapper,
+    django__query_wrapper__n_plus_one,
+)
+from django_monkey_patches.django__query_wrapper import (
+    get_connection_dict,
+    init_connections_extra_data_v1,
+    insert_in_connections_extra_data_v1,
+)
+from django_monkey_patches.django__query_wrapper__n_plus_one import (
+    detect_n_plus_one_v1,
+)
+
+django__query_wrapper.TIME_QUERIES = True
+django__query_wrapper.COMPUTE_CALL_STACK = True
+django__query_wrapper.LAZY_CALL_STACK = True
+django__query_wrapper.POST_EXECUTION_CALLBACK = (
+    insert_in_connections_extra_data_v1
+)
+# In your tests settings:
+django__query_wrapper__n_plus_one.RAISE_ON_N_PLUS_ONE = True
+...
+init_connections_extra_data_v1()
+# Only on the root dict of connections,
+# otherwise each N+1 would be reported twice.
+get_connection_dict(connections)["insertion_callback"] = (
+    detect_n_plus_one_v1
+)
+"""
+
+# Django's _meta API is public.
+# pylint: disable=protected-access
+
+import functools
+import logging
+import re
+
+# pylint: disable-next=import-error
+from django.apps import apps
+
+from .django__query_wrapper import (
+    LazyCallStack,
+    get_sql_signature_and_fingerprint_v2,
+)
+
+logger = logging.getLogger(__name__)
+
+# A signature is an N+1 when it is repeated more than this number
+# of times from the same call site in the same scope.
+N_PLUS_ONE_THRESHOLD = 5
+# Raise NPlusOneError instead of logging a warning, for your tests.
+RAISE_ON_N_PLUS_ONE = False
+# The frames of the files whose path contains one of these strings
+# are not call sites.
+EXCLUDED_CALL_SITE_PATH_PARTS = (
+    "site-packages/",
+    "django_monkey_patches",
+)
+
+
+class NPlusOneError(Exception):
+    """
+    Raised by detect_n_plus_one_v1() when RAISE_ON_N_PLUS_ONE is True.
+    """
+
+
+_lazy_call_sites = {}
+# A frame of traceback.format_stack().
+formatted_frame_regexp = re.compile(
+    r'File "(.*)", line (\d+), in (.*)'
+)
+
+
+def get_call_site_v1(call_stack):
+    """
+    The innermost frame of the call stack that is in your own code,
+    as a string "path/to/file.py:line in function",
+    or None if there is no call stack.
+    """
+    if call_stack is None:
+        return None
+    if isinstance(call_stack, LazyCallStack):
+        call_site = _lazy_call_sites.get(call_stack)
+        if call_site is None:
+            node = call_stack
+            # From the outermost frame to the innermost frame.
+            while node.parent is not None:
+                filename = node.code.co_filename
+                if not any(
+                    part in filename
+                    for part in EXCLUDED_CALL_SITE_PATH_PARTS
+                ):
+                    call_site = (
+                        f"{filename}:{node.lineno}"
+                        f" in {node.code.co_name}"
+                    )
+                node = node.parent
+            _lazy_call_sites[call_stack] = call_site
+        return call_site
+    for line in reversed(call_stack):
+        if not any(
+            part in line for part in EXCLUDED_CALL_SITE_PATH_PARTS
+        ):
+            line = line.strip().split("\n")[0]
+            match = formatted_frame_regexp.match(line)
+            if match is None:
+                return line
+            return f"{match[1]}:{match[2]} in {match[3]}"
+    return None
+
+
+def get_query_call_site_v1(extra_data_dict, data):
+    """
+    An helper function to get the call site of the query,
+    see get_call_site_v1(), with COMPUTE_CALL_STACK.
+    """
+    # pylint: disable=unused-argument
+    return get_call_site_v1(data["call_stack"])
+
+
+get_query_call_site_v1.field_name = "call_site"
+
+
+from_table_regexp = re.compile(r'\bFROM\s+"?`?(\w+)', re.IGNORECASE)
+where_column_regexp = re.compile(
+    r"\bWHERE\s+\(?\s*"
+    r'(?:["`]?(\w+)["`]?\.)?'
+    r'["`]?(\w+)["`]?\s*(?:=|IN\b)',
+    re.IGNORECASE,
+)
+
+
+@functools.lru_cache(maxsize=None)
+def get_models_per_db_table():
+    """
+    All models, including auto-created M2M through models,
+    keyed by db_table.
+    """
+    return {
+        model._meta.db_table: model
+        for model in apps.get_models(include_auto_created=True)
+    }
+
+
+def get_field_by_column(model, column):
+    """
+    The concrete field of model stored in column, or None.
+    """
+    for field in model._meta.concrete_fields:
+        if field.column == column:
+            return field
+    return None
+
+
+def get_m2m_suggestions(through_model, field):
+    """
+    Suggestions when the filter is on a foreign key
+    of an auto-created M2M through model.
+    """
+    suggestions = []
+    owner_model = through_model._meta.auto_created
+    for m2m_field in owner_model._meta.many_to_many:
+        if m2m_field.remote_field.through is not through_model:
+            continue
+        if field.name == m2m_field.m2m_field_name():
+            suggestions.append(
+                f"{owner_model._meta.label}.objects"
+                f'.prefetch_related("{m2m_field.name}")'
+            )
+        else:
+            accessor_name = m2m_field.remote_field.get_accessor_name()
+            suggestions.append(
+                f"{m2m_field.related_model._meta.label}.objects"
+                f'.prefetch_related("{accessor_name}")'
+            )
+    return suggestions
+
+
+# pylint: disable-next=too-many-return-statements
+def get_n_plus_one_suggestions_v1(sql):
+    """
+    Map the table and the filtered column of a repeated SELECT
+    back to model relations,
+    and return the list of the select_related()/prefetch_related()
+    that would avoid it.
+    The list is empty if the query is not recognized,
+    and it may have many elements if many relations are possible.
+    """
+    where_match = where_column_regexp.search(sql)
+    if where_match is None:
+        return []
+    table, column = where_match.groups()
+    if table is None:
+        from_match = from_table_regexp.search(sql)
+        if from_match is None:
+            return []
+        table = from_match.group(1)
+    model = get_models_per_db_table().get(table)
+    if model is None:
+        return []
+    field = get_field_by_column(model, column)
+    if field is None:
+        return []
+
+    if field.primary_key:
+        # A forward foreign key or one-to-one accessed in a loop.
+        return [
+            f"{some_field.model._meta.label}.objects"
+            f'.select_related("{some_field.name}")'
+            for some_model in get_models_per_db_table().values()
+            for some_field in some_model._meta.concrete_fields
+            if (some_field.many_to_one or some_field.one_to_one)
+            and some_field.related_model is model
+        ]
+
+    if not (field.many_to_one or field.one_to_one):
+        return []
+    if model._meta.auto_created:
+        return get_m2m_suggestions(model, field)
+    # A reverse relation accessed in a loop.
+    accessor_name = field.remote_field.get_accessor_name()
+    method = (
+        "select_related" if field.one_to_one else "prefetch_related"
+    )
+    return [
+        f"{field.related_model._meta.label}.objects"
+        f'.{method}("{accessor_name}")'
+    ]
+
+
+def detect_n_plus_one_v1(extra_data_dict, data):
+    """
+    The insertion callback that detects N+1 queries in the scope
+    of extra_data_dict.
+    The detected N+1 are stored in extra_data_dict["n_plus_one_list"],
+    and logged or raised when detected.
+    The count of each report is updated until the end of the scope.
+    """
+    sql = data["sql"]
+    if sql.lstrip()[:6].upper() != "SELECT":
+        return
+    sql_signature, sql_fingerprint = (
+        get_sql_signature_and_fingerprint_v2(sql)
+    )
+    call_site = get_call_site_v1(data["call_stack"])
+    counters = extra_data_dict.get("n_plus_one_counters")
+    if counters is None:
+        counters = extra_data_dict["n_plus_one_counters"] = {}
+    key = (sql_fingerprint, call_site)
+    counter = counters.get(key)
+    if counter is None:
+        counter = counters[key] = {"count": 0}
+    counter["count"] += 1
+    if counter["count"] != N_PLUS_ONE_THRESHOLD + 1:
+        return
+
+    # The counter becomes the report.
+    counter["sql_signature"] = sql_signature
+    counter["sql_fingerprint"] = sql_fingerprint
+    counter["call_site"] = call_site
+    counter["alias"] = data["context"]["connection"].alias
+    counter["suggestions"] = get_n_plus_one_suggestions_v1(sql)
+    n_plus_one_list = extra_data_dict.get("n_plus_one_list")
+    if n_plus_one_list is None:
+        n_plus_one_list = extra_data_dict["n_plus_one_list"] = []
+    n_plus_one_list.append(counter)
+
+    message = (
+        f"N+1 queries on {counter['alias']} from {call_site}:"
+        f" {sql_signature}"
+        f" (more than {N_PLUS_ONE_THRESHOLD} times)."
+    )
+    if counter["suggestions"]:
+        message += " Try: " + " or ".join(counter["suggestions"])
+    if RAISE_ON_N_PLUS_ONE:
+        raise NPlusOneError(message)
+    logger.warning(message)
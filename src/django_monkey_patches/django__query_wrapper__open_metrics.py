@@ -0,0 +1,459 @@
+"""
+This file is part of django-monkey-patches library.
+
+django-monkey-patches is free software:
+you can redistribute it and/or modify it under the terms
+of the GNU Lesser General Public License
+as published by the Free Software Foundation,
+either version 3 of the License,
+or (at your option) any later version.
+
+django-monkey-patches is distributed in the hope
+that it will be useful,
+but WITHOUT ANY WARRANTY;
+without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU Lesser General Public License for more details.
+
+You should have received a copy of
+the GNU Lesser General Public License
+along with django-monkey-patches.
+If not, see <http://www.gnu.org/licenses/>.
+
+©Copyright 2023-2024 Laurent Lyaudet
+----------------------------------------------------------------------
+OpenMetrics exposition of the statistics
+of the custom query wrapper, per worker,
+as a file or as a tiny HTTP endpoint using only the stdlib.
+The metric families are:
+- django_db_queries: counter of queries,
+- django_db_estimated_queries: the same counter
+  estimated from the sampling weights (see SAMPLE_QUERIES),
+- django_db_query_duration_seconds: histogram of durations,
+  from the log-linear histograms of
+  django__query_wrapper__histogram, at DURATION_BUCKET_BOUNDS,
+labelled by connection alias and SQL signature (v2).
+At most MAX_SIGNATURES_PER_ALIAS signatures are labelled per alias,
+OTHER_SIGNATURE included: the other queries are labelled with it.
+
+The statistics are moved periodically from the dicts
+of the connections of each thread to a cumulative store,
+because the server thread does not see the connections
+of the other threads, and because stashed dicts are reset.
+The store can be used as the queue of
+django__query_wrapper__aggregation.
+
+For example:
+django__query_wrapper.TIME_QUERIES = True
+django__query_wrapper.POST_EXECUTION_CALLBACK = (
+    get_flushing_post_execution_callback_v1(
+        open_metrics_store, flush_every_seconds=5
+    )
+)
+init_connections_extra_data_v1(duration_histogram_scale=DEFAULT_SCALE)
+add_open_metrics_subsets_to_connections_v1()
+# Once per worker process, after the fork:
+start_open_metrics_http_server_v1(port=9100 + worker_number)
+# Or, at the end of each job:
+flush_connections_extra_data_v1(open_metrics_store)
+write_open_metrics_file_v1("/var/lib/node_exporter/django.prom")
+"""
+
+import os
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# pylint: disable-next=import-error
+from django.db import connections
+
+from .django__query_wrapper import (
+    get_connection_dict,
+    get_extra_data_template_for_set_of_queries_v1,
+    get_sql_signature_and_fingerprint_v2,
+)
+from .django__query_wrapper__aggregation import (
+    merge_extra_data_dicts_v1,
+)
+from .django__query_wrapper__histogram import (
+    DEFAULT_SCALE,
+    get_cumulative_counts_v1,
+)
+
+# Upper bounds in seconds of the exported buckets of the histograms,
+# from about 61 microseconds to 16 seconds.
+# Powers of 2 are bounds of the log-linear buckets at any scale,
+# hence the exported counts are exact.
+DURATION_BUCKET_BOUNDS = tuple(2.0**x for x in range(-14, 5))
+# The scale of the histograms of the signatures.
+HISTOGRAM_SCALE = DEFAULT_SCALE
+MAX_SIGNATURES_PER_ALIAS = 200
+OTHER_SIGNATURE = "__other__"
+# The key of the allocated subsets keyed by SQL signature.
+SIGNATURES_SUBSET_KEY = "open_metrics_sql_signatures"
+CONTENT_TYPE = (
+    "application/openmetrics-text; version=1.0.0; charset=utf-8"
+)
+
+
+def is_capped_signature_v1(sql_signature, signatures):
+    """
+    True when a new signature must be merged into OTHER_SIGNATURE:
+    at most MAX_SIGNATURES_PER_ALIAS signatures,
+    OTHER_SIGNATURE included.
+    """
+    if (
+        sql_signature == OTHER_SIGNATURE
+        or sql_signature in signatures
+    ):
+        return False
+    real_signature_count = len(signatures) - (
+        OTHER_SIGNATURE in signatures
+    )
+    return real_signature_count >= MAX_SIGNATURES_PER_ALIAS - 1
+
+
+def get_capped_sql_signature_v1(extra_data_dict, data):
+    """
+    The key callback of the allocated subsets keyed by SQL signature,
+    OTHER_SIGNATURE when there are already too many signatures.
+    """
+    sql_signature = get_sql_signature_and_fingerprint_v2(data["sql"])[
+        0
+    ]
+    signatures = extra_data_dict["allocated_subsets_extra_data"][
+        SIGNATURES_SUBSET_KEY
+    ]
+    if is_capped_signature_v1(sql_signature, signatures):
+        return OTHER_SIGNATURE
+    return sql_signature
+
+
+def get_signature_extra_data_dict_v1(extra_data_dict, data):
+    """
+    The init callback of the allocated subsets keyed by SQL signature:
+    no query list, only the counters and the histogram.
+    """
+    # pylint: disable=unused-argument
+    return get_extra_data_template_for_set_of_queries_v1(
+        query_fields=[],
+        duration_histogram_scale=HISTOGRAM_SCALE,
+    )
+
+
+def add_open_metrics_subsets_v1(extra_data_dict):
+    """
+    Add the allocated subsets keyed by SQL signature
+    to a root extra data dict of a connection.
+    """
+    extra_data_dict["allocated_subsets_extra_data"][
+        SIGNATURES_SUBSET_KEY
+    ] = {}
+    extra_data_dict["allocated_subsets_key_callback"][
+        SIGNATURES_SUBSET_KEY
+    ] = get_capped_sql_signature_v1
+    extra_data_dict["allocated_subsets_init_callback"][
+        SIGNATURES_SUBSET_KEY
+    ] = get_signature_extra_data_dict_v1
+    # The tree changed.
+    extra_data_dict["compiled_insertion_plan"] = None
+
+
+def add_open_metrics_subsets_to_connections_v1():
+    """
+    Call add_open_metrics_subsets_v1() on the root extra data dicts
+    of all connections, after init_connections_extra_data_v1().
+    Not on the root dict of connections,
+    where the queries of all aliases are counted again.
+    """
+    for connection_key in connections:
+        add_open_metrics_subsets_v1(
+            get_connection_dict(connections[connection_key])
+        )
+
+
+def drop_query_lists(extra_data_dict):
+    """
+    The store does not keep the queries, only the counters.
+    """
+    extra_data_dict["query_list"] = []
+    for sub_dict in extra_data_dict["subsets_extra_data"].values():
+        drop_query_lists(sub_dict)
+    for sub_dict in extra_data_dict[
+        "allocated_subsets_extra_data"
+    ].values():
+        for some_dict in sub_dict.values():
+            drop_query_lists(some_dict)
+
+
+class OpenMetricsStoreV1:
+    """
+    The cumulative extra data dicts of a worker, keyed by alias.
+    It has the put() method of a queue,
+    for flush_connections_extra_data_v1().
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.extra_data_dicts = {}
+
+    def cap_signatures(self, alias, extra_data_dict):
+        """
+        Merge the new signatures above MAX_SIGNATURES_PER_ALIAS
+        into OTHER_SIGNATURE, since the processes and the flushes
+        do not see the same signatures.
+        """
+        signatures = extra_data_dict[
+            "allocated_subsets_extra_data"
+        ].get(SIGNATURES_SUBSET_KEY)
+        if not signatures:
+            return
+        stored_signatures = set()
+        stored_dict = self.extra_data_dicts.get(alias)
+        if stored_dict is not None:
+            stored_signatures = set(
+                stored_dict["allocated_subsets_extra_data"].get(
+                    SIGNATURES_SUBSET_KEY, ()
+                )
+            )
+        capped_signatures = {}
+        for sql_signature, sub_dict in signatures.items():
+            if is_capped_signature_v1(
+                sql_signature, stored_signatures
+            ):
+                sql_signature = OTHER_SIGNATURE
+            stored_signatures.add(sql_signature)
+            if sql_signature in capped_signatures:
+                merge_extra_data_dicts_v1(
+                    capped_signatures[sql_signature], sub_dict
+                )
+            else:
+                capped_signatures[sql_signature] = sub_dict
+        extra_data_dict["allocated_subsets_extra_data"][
+            SIGNATURES_SUBSET_KEY
+        ] = capped_signatures
+
+    # pylint: disable-next=unused-argument
+    def put(self, batch, block=True, timeout=None):
+        """
+        Merge a batch of flush_connections_extra_data_v1().
+        The dict of connections (alias None) is ignored.
+        """
+        with self.lock:
+            for alias, extra_data_dict in batch[
+                "extra_data_dicts"
+            ].items():
+                if alias is None:
+                    continue
+                drop_query_lists(extra_data_dict)
+                self.cap_signatures(alias, extra_data_dict)
+                if alias in self.extra_data_dicts:
+                    merge_extra_data_dicts_v1(
+                        self.extra_data_dicts[alias], extra_data_dict
+                    )
+                else:
+                    self.extra_data_dicts[alias] = extra_data_dict
+
+    def get_text(self):
+        """
+        The OpenMetrics text of the store.
+        """
+        with self.lock:
+            return get_open_metrics_text_v1(self.extra_data_dicts)
+
+
+open_metrics_store = OpenMetricsStoreV1()
+
+
+def escape_label_value(value):
+    """
+    Escape a label value for the text format.
+    """
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace('"', '\\"')
+        .replace("\n", "\\n")
+    )
+
+
+def get_labels(alias, sql_signature=None, le=None):
+    """
+    The labels of a sample, between braces.
+    """
+    labels = [f'alias="{escape_label_value(alias)}"']
+    if sql_signature is not None:
+        labels.append(
+            f'signature="{escape_label_value(sql_signature)}"'
+        )
+    if le is not None:
+        labels.append(f'le="{le}"')
+    return "{" + ",".join(labels) + "}"
+
+
+def get_histogram_lines(alias, sql_signature, extra_data_dict):
+    """
+    The samples of the histogram of durations of extra_data_dict,
+    if it has a "duration_histogram".
+    The counts are estimated from the sampling weights,
+    like "estimated_total_duration" (see SAMPLE_QUERIES).
+    """
+    duration_histogram = extra_data_dict.get("duration_histogram")
+    if duration_histogram is None:
+        return []
+    lines = []
+    cumulative_counts = get_cumulative_counts_v1(
+        duration_histogram, DURATION_BUCKET_BOUNDS
+    )
+    bounds = [repr(float(x)) for x in DURATION_BUCKET_BOUNDS]
+    bounds.append("+Inf")
+    for bound, cumulative_count in zip(bounds, cumulative_counts):
+        labels = get_labels(alias, sql_signature, bound)
+        lines.append(
+            f"django_db_query_duration_seconds_bucket{labels}"
+            f" {cumulative_count}"
+        )
+    labels = get_labels(alias, sql_signature)
+    lines.append(
+        f"django_db_query_duration_seconds_count{labels}"
+        f" {cumulative_counts[-1]}"
+    )
+    total_duration = extra_data_dict.get(
+        "estimated_total_duration", extra_data_dict["total_duration"]
+    )
+    lines.append(
+        f"django_db_query_duration_seconds_sum{labels}"
+        f" {total_duration}"
+    )
+    return lines
+
+
+def get_open_metrics_text_v1(extra_data_dicts):
+    """
+    The OpenMetrics text of extra data dicts keyed by alias,
+    with the signatures of add_open_metrics_subsets_v1(),
+    or only one sample per alias without them.
+    """
+    queries_lines = []
+    estimated_queries_lines = []
+    histogram_lines = []
+    for alias, extra_data_dict in sorted(
+        extra_data_dicts.items(), key=lambda x: str(x[0])
+    ):
+        if alias is None:
+            continue
+        signatures = extra_data_dict[
+            "allocated_subsets_extra_data"
+        ].get(SIGNATURES_SUBSET_KEY)
+        if signatures:
+            samples = sorted(signatures.items())
+        else:
+            samples = [(None, extra_data_dict)]
+        for sql_signature, sub_dict in samples:
+            labels = get_labels(alias, sql_signature)
+            queries_lines.append(
+                f"django_db_queries_total{labels}"
+                f" {sub_dict['query_count']}"
+            )
+            estimated_queries_lines.append(
+                f"django_db_estimated_queries_total{labels}"
+                f" {sub_dict.get('estimated_query_count', 0)}"
+            )
+            histogram_lines.extend(
+                get_histogram_lines(alias, sql_signature, sub_dict)
+            )
+    lines = [
+        "# TYPE django_db_queries counter",
+        "# HELP django_db_queries Queries executed.",
+        *queries_lines,
+        "# TYPE django_db_estimated_queries counter",
+        "# HELP django_db_estimated_queries"
+        " Queries executed, estimated from the sampled queries.",
+        *estimated_queries_lines,
+        "# TYPE django_db_query_duration_seconds histogram",
+        "# UNIT django_db_query_duration_seconds seconds",
+        "# HELP django_db_query_duration_seconds"
+        " Duration of queries.",
+        *histogram_lines,
+        "# EOF",
+    ]
+    return "\n".join(lines) + "\n"
+
+
+def write_open_metrics_file_v1(file_path, store=None):
+    """
+    Write the OpenMetrics text of the store (the default store)
+    atomically, for a textfile collector.
+    """
+    if store is None:
+        store = open_metrics_store
+    text = store.get_text()
+    file_descriptor, temporary_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(file_path)),
+        prefix=".open_metrics_",
+    )
+    try:
+        with os.fdopen(
+            file_descriptor, "w", encoding="utf-8"
+        ) as file:
+            file.write(text)
+        os.replace(temporary_path, file_path)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
+
+
+def start_open_metrics_http_server_v1(
+    port=0,
+    address="127.0.0.1",
+    store=None,
+):
+    """
+    Serve the OpenMetrics text of the store (the default store)
+    on http://address:port/metrics from a daemon thread,
+    and return the server.
+    With port 0, the port is chosen by the system:
+    see server.server_address.
+    Call it in each worker after the fork.
+    """
+    if store is None:
+        store = open_metrics_store
+
+    class OpenMetricsRequestHandler(BaseHTTPRequestHandler):
+        """
+        GET /metrics only.
+        """
+
+        # The names of BaseHTTPRequestHandler.
+        # pylint: disable=invalid-name,redefined-builtin
+
+        def log_message(self, format, *args):
+            """
+            No logging of each scrape.
+            """
+
+        def do_GET(self):
+            """
+            The OpenMetrics text of the store.
+            """
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = store.get_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(
+        (address, port), OpenMetricsRequestHandler
+    )
+    server.daemon_threads = True
+    thread = threading.Thread(
+        target=server.serve_forever,
+        name="django_monkey_patches_open_metrics",
+        daemon=True,
+    )
+    thread.start()
+    return server
@@ -0,0 +1,488 @@
+"""
+This file is part of django-monkey-patches library.
+
+django-monkey-patches is free software:
+you can redistribute it and/or modify it under the terms
+of the GNU Lesser General Public License
+as published by the Free Software Foundation,
+either version 3 of the License,
+or (at your option) any later version.
+
+django-monkey-patches is distributed in the hope
+that it will be useful,
+but WITHOUT ANY WARRANTY;
+without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU Lesser General Public License for more details.
+
+You should have received a copy of
+the GNU Lesser General Public License
+along with django-monkey-patches.
+If not, see <http://www.gnu.org/licenses/>.
+
+©Copyright 2023-2024 Laurent Lyaudet
+----------------------------------------------------------------------
+Offline analysis of the query records of the custom query wrapper.
+The records are ingested in a SQLite file,
+with indexes on signature, call site, alias, scope and endpoint,
+so that the reports do not load all the queries in RAM.
+The inputs are the segment files of django__query_wrapper__stream
+(*.seg) and JSON lines files written by dump_query_records_v1().
+The records should have "duration", and "sql" or "sql_signature_v2";
+"alias", "scope", "endpoint" and "call_site" are optional.
+The call site is the field of get_query_call_site_v1(),
+or it is computed at ingestion from "light_call_stack_v1"
+or "call_stack", when they are lists of formatted frames.
+
+python -m django_monkey_patches.django__query_wrapper__query_report \\
+    ingest report.sqlite3 /tmp/stream/*.seg dump.jsonl
+... top report.sqlite3 --by total -n 20
+... percentiles report.sqlite3 -n 20
+... endpoints report.sqlite3
+... call-sites report.sqlite3 -n 20
+"""
+
+import argparse
+import json
+import sqlite3
+import sys
+
+from .django__query_wrapper import (
+    get_connection_dict,
+    get_sql_signature_and_fingerprint_v2,
+)
+from .django__query_wrapper__n_plus_one import get_call_site_v1
+from .django__query_wrapper__stream import (
+    SEGMENT_SUFFIX,
+    read_segment_records_v1,
+)
+
+INGEST_BATCH_SIZE = 10000
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS signatures (
+    id INTEGER PRIMARY KEY,
+    signature TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS queries (
+    id INTEGER PRIMARY KEY,
+    signature_id INTEGER NOT NULL REFERENCES signatures (id),
+    alias TEXT,
+    scope TEXT,
+    endpoint TEXT,
+    call_site TEXT,
+    start_time REAL,
+    duration REAL NOT NULL
+);
+"""
+INDEXES = """
+CREATE INDEX IF NOT EXISTS queries_signature_duration
+    ON queries (signature_id, duration);
+CREATE INDEX IF NOT EXISTS queries_call_site ON queries (call_site);
+CREATE INDEX IF NOT EXISTS queries_alias ON queries (alias);
+CREATE INDEX IF NOT EXISTS queries_scope ON queries (scope);
+CREATE INDEX IF NOT EXISTS queries_endpoint
+    ON queries (endpoint, duration);
+"""
+TOP_ORDERS = {
+    "total": "total_duration",
+    "count": "query_count",
+    "average": "average_duration",
+}
+
+
+def dump_query_records_v1(file_path, extra_data_dicts, **labels):
+    """
+    Append the query records of the root extra data dicts
+    keyed by alias (see get_connections_extra_data_snapshot_v1())
+    to a JSON lines file, with the alias and the given labels
+    (scope, endpoint, etc.).
+    The dict of connections (alias None) is skipped,
+    since it has the queries of all aliases.
+    """
+    with open(file_path, "a", encoding="utf-8") as dump_file:
+        for alias, extra_data_dict in extra_data_dicts.items():
+            if alias is None:
+                continue
+            for record in extra_data_dict["query_list"]:
+                dump_file.write(
+                    json.dumps(
+                        {"alias": alias, **labels, **record},
+                        separators=(",", ":"),
+                        default=str,
+                    )
+                )
+                dump_file.write("\n")
+
+
+def dump_connections_query_records_v1(file_path, **labels):
+    """
+    dump_query_records_v1() on the current root extra data dicts.
+    """
+    # pylint: disable-next=import-error,import-outside-toplevel
+    from django.db import connections
+
+    dump_query_records_v1(
+        file_path,
+        {
+            connection_key: get_connection_dict(
+                connections[connection_key]
+            )
+            for connection_key in connections
+        },
+        **labels,
+    )
+
+
+def read_json_lines_records_v1(file_path):
+    """
+    Iterate on the records of a JSON lines file.
+    """
+    with open(file_path, encoding="utf-8") as json_lines_file:
+        for line in json_lines_file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def get_signature_id(database, signature_ids, signature):
+    """
+    The id of the signature, inserted if needed.
+    """
+    signature_id = signature_ids.get(signature)
+    if signature_id is None:
+        database.execute(
+            "INSERT OR IGNORE INTO signatures (signature) VALUES (?)",
+            (signature,),
+        )
+        signature_id = signature_ids[signature] = database.execute(
+            "SELECT id FROM signatures WHERE signature = ?",
+            (signature,),
+        ).fetchone()[0]
+    return signature_id
+
+
+def get_record_call_site_v1(record):
+    """
+    The call site of a record, from its "call_site",
+    or from its formatted call stack, or None.
+    """
+    call_site = record.get("call_site")
+    if call_site is not None:
+        return call_site
+    for key in ("light_call_stack_v1", "call_stack"):
+        call_stack = record.get(key)
+        # A LazyCallStack that was not formatted is a string.
+        if isinstance(call_stack, list):
+            return get_call_site_v1(call_stack)
+    return None
+
+
+def ingest_records_v1(database, records, **default_labels):
+    """
+    Insert the records in the database by batches,
+    and return the number of inserted records.
+    The records without duration are skipped.
+    """
+    signature_ids = {}
+    batch = []
+    count = 0
+    for record in records:
+        duration = record.get("duration")
+        if duration is None:
+            continue
+        signature = record.get("sql_signature_v2")
+        if signature is None:
+            signature = get_sql_signature_and_fingerprint_v2(
+                record.get("sql", "")
+            )[0]
+        batch.append(
+            (
+                get_signature_id(database, signature_ids, signature),
+                record.get("alias", default_labels.get("alias")),
+                record.get("scope", default_labels.get("scope")),
+                record.get(
+                    "endpoint", default_labels.get("endpoint")
+                ),
+                get_record_call_site_v1(record),
+                record.get("start_time"),
+                duration,
+            )
+        )
+        if len(batch) >= INGEST_BATCH_SIZE:
+            count += insert_batch(database, batch)
+    count += insert_batch(database, batch)
+    return count
+
+
+def insert_batch(database, batch):
+    """
+    Insert and empty the batch.
+    """
+    database.executemany(
+        "INSERT INTO queries (signature_id, alias, scope, endpoint,"
+        " call_site, start_time, duration)"
+        " VALUES (?, ?, ?, ?, ?, ?, ?)",
+        batch,
+    )
+    count = len(batch)
+    batch.clear()
+    return count
+
+
+def open_database_v1(database_path):
+    """
+    Open the report database and create its tables.
+    """
+    database = sqlite3.connect(database_path)
+    database.executescript(SCHEMA)
+    return database
+
+
+def ingest_files_v1(database_path, file_paths, **default_labels):
+    """
+    Ingest the segment files and JSON lines files,
+    then create the indexes,
+    and return the number of inserted records.
+    """
+    database = open_database_v1(database_path)
+    # The indexes are created after the bulk insertion.
+    database.execute("PRAGMA synchronous = OFF")
+    database.execute("PRAGMA journal_mode = WAL")
+    count = 0
+    with database:
+        for file_path in file_paths:
+            if file_path.endswith(SEGMENT_SUFFIX):
+                records = read_segment_records_v1(file_path)
+            else:
+                records = read_json_lines_records_v1(file_path)
+            count += ingest_records_v1(
+                database, records, **default_labels
+            )
+    database.executescript(INDEXES)
+    database.execute("ANALYZE")
+    database.close()
+    return count
+
+
+def get_filters(alias=None, scope=None):
+    """
+    The WHERE clause and parameters of the optional filters.
+    """
+    clauses = []
+    params = []
+    if alias is not None:
+        clauses.append("alias = ?")
+        params.append(alias)
+    if scope is not None:
+        clauses.append("scope = ?")
+        params.append(scope)
+    if not clauses:
+        return "", params
+    return " WHERE " + " AND ".join(clauses), params
+
+
+def get_top_signatures_v1(
+    database,
+    order_by="total",
+    limit=20,
+    alias=None,
+    scope=None,
+):
+    """
+    The signatures with the biggest total duration, count
+    or average duration, as tuples (signature, signature_id,
+    query_count, total_duration, average_duration, max_duration).
+    """
+    where, params = get_filters(alias, scope)
+    return database.execute(
+        "SELECT signatures.signature, grouped.* FROM ("
+        " SELECT signature_id, COUNT(*) AS query_count,"
+        " SUM(duration) AS total_duration,"
+        " AVG(duration) AS average_duration,"
+        " MAX(duration) AS max_duration"
+        f" FROM queries{where} GROUP BY signature_id"
+        f" ORDER BY {TOP_ORDERS[order_by]} DESC LIMIT ?"
+        ") AS grouped"
+        " JOIN signatures ON signatures.id = grouped.signature_id"
+        f" ORDER BY {TOP_ORDERS[order_by]} DESC",
+        [*params, limit],
+    ).fetchall()
+
+
+def get_signatures_percentiles_v1(
+    database,
+    limit=20,
+    alias=None,
+    scope=None,
+):
+    """
+    The p50, p90, p95 and p99 durations of the signatures
+    with the biggest total duration, as tuples (signature,
+    query_count, p50, p90, p95, p99, max_duration).
+    The ranks are computed with window functions,
+    on the index (signature_id, duration).
+    """
+    where, params = get_filters(alias, scope)
+    top_signature_ids = [
+        row[1]
+        for row in get_top_signatures_v1(
+            database, "total", limit, alias, scope
+        )
+    ]
+    if not top_signature_ids:
+        return []
+    placeholders = ", ".join("?" * len(top_signature_ids))
+    where = (
+        f"{where} AND" if where else " WHERE"
+    ) + f" signature_id IN ({placeholders})"
+    return database.execute(
+        "WITH ranked AS ("
+        " SELECT signature_id, duration,"
+        " ROW_NUMBER() OVER ("
+        " PARTITION BY signature_id ORDER BY duration"
+        " ) AS row_rank,"
+        " COUNT(*) OVER (PARTITION BY signature_id) AS query_count"
+        f" FROM queries{where}"
+        ")"
+        " SELECT signatures.signature, MAX(query_count),"
+        " MIN(CASE WHEN row_rank >= 0.50 * query_count"
+        " THEN duration END),"
+        " MIN(CASE WHEN row_rank >= 0.90 * query_count"
+        " THEN duration END),"
+        " MIN(CASE WHEN row_rank >= 0.95 * query_count"
+        " THEN duration END),"
+        " MIN(CASE WHEN row_rank >= 0.99 * query_count"
+        " THEN duration END),"
+        " MAX(duration)"
+        " FROM ranked"
+        " JOIN signatures ON signatures.id = ranked.signature_id"
+        " GROUP BY signature_id ORDER BY SUM(duration) DESC",
+        [*params, *top_signature_ids],
+    ).fetchall()
+
+
+def get_endpoints_v1(database, limit=20, alias=None, scope=None):
+    """
+    The endpoints with the biggest total duration, as tuples
+    (endpoint, query_count, total_duration, distinct signatures).
+    """
+    where, params = get_filters(alias, scope)
+    return database.execute(
+        "SELECT endpoint, COUNT(*), SUM(duration),"
+        " COUNT(DISTINCT signature_id)"
+        f" FROM queries{where} GROUP BY endpoint"
+        " ORDER BY SUM(duration) DESC LIMIT ?",
+        [*params, limit],
+    ).fetchall()
+
+
+def get_call_sites_v1(database, limit=20, alias=None, scope=None):
+    """
+    The call sites with the biggest total duration, as tuples
+    (call_site, query_count, total_duration, distinct signatures),
+    to find the loops issuing many queries.
+    """
+    where, params = get_filters(alias, scope)
+    return database.execute(
+        "SELECT call_site, COUNT(*), SUM(duration),"
+        " COUNT(DISTINCT signature_id)"
+        f" FROM queries{where} GROUP BY call_site"
+        " ORDER BY SUM(duration) DESC LIMIT ?",
+        [*params, limit],
+    ).fetchall()
+
+
+def print_rows(header, rows, signature_width=80):
+    """
+    Print rows as tab separated values,
+    the first column is truncated, the floats are in seconds.
+    """
+    print("\t".join(header))
+    for row in rows:
+        first = str(row[0])
+        if len(first) > signature_width:
+            first = first[: signature_width - 3] + "..."
+        values = [first]
+        for value in row[1:]:
+            if isinstance(value, float):
+                values.append(f"{value:.6f}")
+            else:
+                values.append(str(value))
+        print("\t".join(values))
+
+
+def get_argument_parser():
+    """
+    The parser of the command line.
+    """
+    parser = argparse.ArgumentParser(
+        prog="python -m"
+        " django_monkey_patches.django__query_wrapper__query_report",
+        description="Index and analyze captured query records.",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    ingest_parser = subparsers.add_parser("ingest")
+    ingest_parser.add_argument("database")
+    ingest_parser.add_argument("files", nargs="+")
+    for label in ("alias", "scope", "endpoint"):
+        ingest_parser.add_argument(
+            f"--{label}", help="default when missing in records"
+        )
+    for command in ("top", "percentiles", "endpoints", "call-sites"):
+        report_parser = subparsers.add_parser(command)
+        report_parser.add_argument("database")
+        report_parser.add_argument(
+            "-n", "--limit", type=int, default=20
+        )
+        report_parser.add_argument("--alias")
+        report_parser.add_argument("--scope")
+        if command == "top":
+            report_parser.add_argument(
+                "--by", choices=sorted(TOP_ORDERS), default="total"
+            )
+    return parser
+
+
+def main(argv=None):
+    """
+    The entry point of the command line.
+    """
+    arguments = get_argument_parser().parse_args(argv)
+    if arguments.command == "ingest":
+        count = ingest_files_v1(
+            arguments.database,
+            arguments.files,
+            alias=arguments.alias,
+            scope=arguments.scope,
+            endpoint=arguments.endpoint,
+        )
+        print(f"{count} queries ingested in {arguments.database}")
+        return 0
+    database = open_database_v1(arguments.database)
+    filters = (arguments.limit, arguments.alias, arguments.scope)
+    if arguments.command == "top":
+        rows = get_top_signatures_v1(database, arguments.by, *filters)
+        print_rows(
+            ("signature", "id", "count", "total", "average", "max"),
+            rows,
+        )
+    elif arguments.command == "percentiles":
+        print_rows(
+            ("signature", "count", "p50", "p90", "p95", "p99", "max"),
+            get_signatures_percentiles_v1(database, *filters),
+        )
+    elif arguments.command == "endpoints":
+        print_rows(
+            ("endpoint", "count", "total", "signatures"),
+            get_endpoints_v1(database, *filters),
+        )
+    else:
+        print_rows(
+            ("call site", "count", "total", "signatures"),
+            get_call_sites_v1(database, *filters),
+        )
+    database.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,353 @@
+"""
+This file is part of django-monkey-patches library.
+
+django-monkey-patches is free software:
+you can redistribute it and/or modify it under the terms
+of the GNU Lesser General Public License
+as published by the Free Software Foundation,
+either version 3 of the License,
+or (at your option) any later version.
+
+django-monkey-patches is distributed in the hope
+that it will be useful,
+but WITHOUT ANY WARRANTY;
+without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU Lesser General Public License for more details.
+
+You should have received a copy of
+the GNU Lesser General Public License
+along with django-monkey-patches.
+If not, see <http://www.gnu.org/licenses/>.
+
+©Copyright 2023-2024 Laurent Lyaudet
+----------------------------------------------------------------------
+Classes with __slots__ for the data of a query (QueryEventV1)
+and for the extra data dicts (ExtraDataNodeV1),
+for always-on profiling:
+a slotted object is several times smaller than a dict
+with the same keys, and it is faster to create.
+They are also mappings, hence the existing callbacks
+and functions using data["sql"], extra_data_dict["query_count"],
+.get(), .items(), etc. keep working.
+The keys that are not slots (added by your callbacks)
+are kept in a small dict created on demand.
+Extra data nodes cannot be shared with a multiprocessing.Manager.
+
+For example:
+init_connections_extra_data_nodes_v1(query_fields=["sql"])
+django__query_wrapper.POST_EXECUTION_CALLBACK = (
+    insert_in_connections_extra_data_v3
+)
+"""
+
+from collections.abc import MutableMapping
+
+# pylint: disable-next=import-error
+from django.db import connections
+
+from .django__query_wrapper import (
+    _get_dmp_d,
+    get_extra_data_template_for_set_of_queries_v1,
+    get_reference_pid,
+    init_connections_extra_data,
+    insert_in_extra_data_dict_v1,
+)
+from .django__query_wrapper__histogram import (
+    add_to_duration_histogram_v1,
+)
+
+
+class SlottedMappingV1(MutableMapping):
+    """
+    The mapping view of the slots of a subclass,
+    with a dict for the other keys.
+    """
+
+    __slots__ = ("extra_fields",)
+    fields = ()
+    fields_set = frozenset()
+
+    def __init__(self, *args, **kwargs):
+        self.extra_fields = None
+        for field, value in zip(self.fields, args):
+            setattr(self, field, value)
+        for key, value in kwargs.items():
+            self[key] = value
+
+    def __getitem__(self, key):
+        if key in self.fields_set:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                pass
+        elif (
+            self.extra_fields is not None and key in self.extra_fields
+        ):
+            return self.extra_fields[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self.fields_set:
+            setattr(self, key, value)
+            return
+        if self.extra_fields is None:
+            self.extra_fields = {}
+        self.extra_fields[key] = value
+
+    def __delitem__(self, key):
+        if key in self.fields_set:
+            try:
+                delattr(self, key)
+                return
+            except AttributeError:
+                pass
+        elif (
+            self.extra_fields is not None and key in self.extra_fields
+        ):
+            del self.extra_fields[key]
+            return
+        raise KeyError(key)
+
+    def __iter__(self):
+        for field in self.fields:
+            if hasattr(self, field):
+                yield field
+        if self.extra_fields is not None:
+            yield from self.extra_fields
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({dict(self.items())!r})"
+
+    def __reduce__(self):
+        return (rebuild_slotted_mapping_v1, (type(self), dict(self)))
+
+
+def rebuild_slotted_mapping_v1(cls, content):
+    """
+    Unpickle a slotted mapping.
+    """
+    result = cls.__new__(cls)
+    result.extra_fields = None
+    for key, value in content.items():
+        result[key] = value
+    return result
+
+
+QUERY_EVENT_FIELDS = (
+    "execute",
+    "sql",
+    "params",
+    "many",
+    "context",
+    "call_stack",
+    "start_time",
+    "result",
+    "end_time",
+    "duration",
+    "sampling_weight",
+)
+
+
+# pylint: disable-next=too-many-instance-attributes
+class QueryEventV1(SlottedMappingV1):
+    """
+    The data of a query given to the insertion functions,
+    in the order of the arguments of POST_EXECUTION_CALLBACK,
+    followed by the sampling weight.
+    """
+
+    __slots__ = QUERY_EVENT_FIELDS
+    fields = QUERY_EVENT_FIELDS
+    fields_set = frozenset(QUERY_EVENT_FIELDS)
+
+    # pylint: disable-next=too-many-arguments,super-init-not-called
+    def __init__(
+        self,
+        execute,
+        sql,
+        params,
+        many,
+        context,
+        call_stack,
+        start_time,
+        result,
+        end_time,
+        duration,
+        sampling_weight=1,
+    ):
+        """
+        Explicit, since it is called for each query.
+        """
+        self.extra_fields = None
+        self.execute = execute
+        self.sql = sql
+        self.params = params
+        self.many = many
+        self.context = context
+        self.call_stack = call_stack
+        self.start_time = start_time
+        self.result = result
+        self.end_time = end_time
+        self.duration = duration
+        self.sampling_weight = sampling_weight
+
+
+# The keys of get_extra_data_template_for_set_of_queries_v1().
+EXTRA_DATA_NODE_FIELDS = tuple(
+    get_extra_data_template_for_set_of_queries_v1()
+)
+
+
+class ExtraDataNodeV1(SlottedMappingV1):
+    """
+    An extra data dict as a slotted object.
+    """
+
+    __slots__ = EXTRA_DATA_NODE_FIELDS
+    fields = EXTRA_DATA_NODE_FIELDS
+    fields_set = frozenset(EXTRA_DATA_NODE_FIELDS)
+
+
+def get_extra_data_node_for_set_of_queries_v1(**kwargs):
+    """
+    The same as get_extra_data_template_for_set_of_queries_v1(),
+    with the same arguments except manager,
+    but it returns an ExtraDataNodeV1.
+    """
+    if kwargs.get("manager") is not None:
+        raise ValueError(
+            "ExtraDataNodeV1 cannot be shared with a manager."
+        )
+    return ExtraDataNodeV1(
+        **get_extra_data_template_for_set_of_queries_v1(**kwargs)
+    )
+
+
+def init_connections_extra_data_nodes_v1(
+    empty_stash_stack=False,
+    **kwargs,
+):
+    """
+    The same as init_connections_extra_data_v1(),
+    but with ExtraDataNodeV1 root nodes.
+    """
+
+    def lambda_get_extra_data_node_for_set_of_queries_v1():
+        return get_extra_data_node_for_set_of_queries_v1(**kwargs)
+
+    init_connections_extra_data(
+        lambda_get_extra_data_node_for_set_of_queries_v1,
+        empty_stash_stack=empty_stash_stack,
+    )
+
+
+# pylint: disable-next=too-many-branches
+def insert_in_extra_data_node_v1(node, event):
+    """
+    The same as insert_in_extra_data_dict_v1(),
+    but with the attributes of an ExtraDataNodeV1
+    and of a QueryEventV1.
+    Sub dicts that are not ExtraDataNodeV1
+    are given to insert_in_extra_data_dict_v1().
+    """
+    duration = event.duration
+    if duration is not None:
+        # /!\ check list: you did activate TIME_QUERIES?
+        if node.min_seconds_threshold > duration:
+            return
+        if node.max_seconds_threshold < duration:
+            return
+    filter_callback = node.filter_callback
+    if filter_callback is not None and not filter_callback(
+        node, event
+    ):
+        return
+
+    node.query_count += 1
+    sampling_weight = event.sampling_weight
+    node.estimated_query_count += sampling_weight
+    fields = node.query_fields
+    if fields:
+        local_data = {}
+        for field in fields:
+            # pylint: disable-next=unidiomatic-typecheck
+            if type(field) is str:
+                local_data[field] = event[field]
+            else:
+                # It is a function.
+                local_data[field.field_name] = field(node, event)
+        node.query_list.append(local_data)
+    if duration is not None:
+        node.total_duration += duration
+        node.estimated_total_duration += duration * sampling_weight
+        node.min_duration = min(node.min_duration, duration)
+        node.max_duration = max(node.max_duration, duration)
+        if node.duration_histogram is not None:
+            add_to_duration_histogram_v1(
+                node.duration_histogram, duration, sampling_weight
+            )
+    if node.insertion_callback is not None:
+        node.insertion_callback(node, event)
+
+    for sub_node in node.subsets_extra_data.values():
+        if isinstance(sub_node, ExtraDataNodeV1):
+            insert_in_extra_data_node_v1(sub_node, event)
+        else:
+            insert_in_extra_data_dict_v1(sub_node, event)
+    for (
+        allocated_subset_key,
+        key_generator,
+    ) in node.allocated_subsets_key_callback.items():
+        if key_generator is None:
+            continue
+        sub_dict = node.allocated_subsets_extra_data.get(
+            allocated_subset_key
+        )
+        if sub_dict is None:
+            raise ValueError(
+                "allocated_subsets error:"
+                f" no sub_dict for {allocated_subset_key}"
+            )
+        init_callback = node.allocated_subsets_init_callback.get(
+            allocated_subset_key
+        )
+        if init_callback is None:
+            raise ValueError(
+                "allocated_subsets error:"
+                f" no init_callback for {allocated_subset_key}"
+            )
+        some_key = key_generator(node, event)
+        sub_node = sub_dict.get(some_key)
+        if sub_node is None:
+            sub_node = sub_dict[some_key] = init_callback(node, event)
+        if isinstance(sub_node, ExtraDataNodeV1):
+            insert_in_extra_data_node_v1(sub_node, event)
+        else:
+            insert_in_extra_data_dict_v1(sub_node, event)
+
+
+def insert_in_connections_extra_data_v3(*args):
+    """
+    The same as insert_in_connections_extra_data_v1(),
+    with the same arguments,
+    but the data of the query is a QueryEventV1,
+    and the root nodes can be ExtraDataNodeV1.
+    """
+    # args are execute, sql, params, many, context, call_stack,
+    # start_time, result, end_time, duration.
+    context = args[4]
+    event = QueryEventV1(*args, context.get("sampling_weight", 1))
+    pid = get_reference_pid()
+    for extra_data_dict in (
+        _get_dmp_d(connections)[pid],
+        _get_dmp_d(context["connection"])[pid],
+    ):
+        if isinstance(extra_data_dict, ExtraDataNodeV1):
+            insert_in_extra_data_node_v1(extra_data_dict, event)
+        else:
+            insert_in_extra_data_dict_v1(extra_data_dict, event)
+    return event.result
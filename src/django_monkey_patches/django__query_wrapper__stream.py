@@ -0,0 +1,336 @@
+"""
+This file is part of django-monkey-patches library.
+
+django-monkey-patches is free software:
+you can redistribute it and/or modify it under the terms
+of the GNU Lesser General Public License
+as published by the Free Software Foundation,
+either version 3 of the License,
+or (at your option) any later version.
+
+django-monkey-patches is distributed in the hope
+that it will be useful,
+but WITHOUT ANY WARRANTY;
+without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU Lesser General Public License for more details.
+
+You should have received a copy of
+the GNU Lesser General Public License
+along with django-monkey-patches.
+If not, see <http://www.gnu.org/licenses/>.
+
+©Copyright 2023-2024 Laurent Lyaudet
+----------------------------------------------------------------------
+Stream the query records of the custom query wrapper to disk,
+instead of keeping them in query_list until the end,
+for long batch jobs or data migrations, at a fixed memory cost.
+
+A background thread takes the records from a bounded queue,
+and writes them in append-only segment files:
+each record is a 4 bytes big-endian length
+followed by compact JSON.
+The segments rotate when they reach max_segment_bytes.
+When the queue is full, the record is dropped and counted
+in dropped_count: the queries are never blocked by the disk.
+When a write fails, the next records are dropped too,
+and flush() and close() raise QueryRecordStreamError.
+
+A sink replaces the query_list of an extra data dict,
+and adds its labels to each record (alias, scope, etc.).
+For example:
+writer = QueryRecordStreamWriterV1("/tmp/migration_queries")
+init_connections_extra_data_v1(
+    query_fields=["sql", "duration", get_sql_signature_v2]
+)
+for connection_key in connections:
+    use_query_record_sink_v1(
+        get_connection_dict(connections[connection_key]),
+        writer.get_sink(alias=connection_key, scope="migration"),
+    )
+...
+writer.close()
+print(writer.written_count, writer.dropped_count)
+for record in iter_segments_records_v1("/tmp/migration_queries"):
+    ...
+"""
+
+import glob
+import json
+import os
+import queue as queue_module
+import struct
+import threading
+
+# Big-endian unsigned 32 bits length of each record.
+RECORD_HEADER = struct.Struct(">I")
+SEGMENT_SUFFIX = ".seg"
+# flush() checks every FLUSH_POLL_SECONDS that the writer is alive.
+FLUSH_POLL_SECONDS = 0.1
+
+
+class QueryRecordStreamError(Exception):
+    """
+    Raised by flush() and close() when the writer thread failed
+    or is not running (in a forked child process, for example).
+    """
+
+
+def encode_record_v1(record):
+    """
+    The length-prefixed compact JSON of a record.
+    The values that are not JSON (call stacks, etc.)
+    are written as strings.
+    """
+    payload = json.dumps(
+        record,
+        separators=(",", ":"),
+        default=str,
+    ).encode("utf-8")
+    return RECORD_HEADER.pack(len(payload)) + payload
+
+
+def read_segment_records_v1(file_path):
+    """
+    Iterate on the records of a segment file.
+    A truncated last record (killed process) is ignored.
+    """
+    with open(file_path, "rb") as segment_file:
+        while True:
+            header = segment_file.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            (length,) = RECORD_HEADER.unpack(header)
+            payload = segment_file.read(length)
+            if len(payload) < length:
+                return
+            yield json.loads(payload)
+
+
+def get_segment_paths_v1(directory, prefix="queries"):
+    """
+    The segment files of directory, in writing order for each pid.
+    """
+    return sorted(
+        glob.glob(
+            os.path.join(directory, f"{prefix}-*{SEGMENT_SUFFIX}")
+        )
+    )
+
+
+def iter_segments_records_v1(directory, prefix="queries"):
+    """
+    Iterate on the records of all the segment files of directory.
+    """
+    for file_path in get_segment_paths_v1(directory, prefix):
+        yield from read_segment_records_v1(file_path)
+
+
+class QueryRecordSinkV1:
+    """
+    A replacement of query_list that streams the records
+    to a writer with some labels.
+    Its length is the number of records appended to it
+    since the last clear(), including the dropped ones,
+    and iterating on it reads back all its records from the segments
+    (call writer.flush() before).
+    """
+
+    __slots__ = ("writer", "labels", "appended_count")
+
+    def __init__(self, writer, labels):
+        self.writer = writer
+        self.labels = labels
+        self.appended_count = 0
+
+    def append(self, record):
+        """
+        Stream the record with the labels of the sink.
+        """
+        self.appended_count += 1
+        if self.labels:
+            record = {**self.labels, **record}
+        self.writer.append(record)
+
+    def clear(self):
+        """
+        Reset the length, for reset_extra_data_dict_v1(),
+        the records already streamed stay in the segments.
+        """
+        self.appended_count = 0
+
+    def __len__(self):
+        return self.appended_count
+
+    def __iter__(self):
+        for record in iter_segments_records_v1(
+            self.writer.directory, self.writer.prefix
+        ):
+            if all(
+                record.get(key) == value
+                for key, value in self.labels.items()
+            ):
+                yield record
+
+
+# pylint: disable-next=too-many-instance-attributes
+class QueryRecordStreamWriterV1:
+    """
+    The background writer of the query records to segment files
+    named f"{prefix}-{pid}-{index:06d}.seg" in directory.
+    """
+
+    def __init__(
+        self,
+        directory,
+        prefix="queries",
+        max_segment_bytes=64 * 1024 * 1024,
+        max_queue_size=10000,
+    ):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.prefix = prefix
+        self.max_segment_bytes = max_segment_bytes
+        self.queue = queue_module.Queue(maxsize=max_queue_size)
+        self.written_count = 0
+        # Incremented by the producers and by the writer thread.
+        self.dropped_count = 0
+        self.dropped_count_lock = threading.Lock()
+        # The exception of the first failed write.
+        self.error = None
+        self.segment_index = 0
+        self.segment_file = None
+        self.segment_size = 0
+        self.thread = threading.Thread(
+            target=self.run,
+            name="django_monkey_patches_stream_writer",
+            daemon=True,
+        )
+        self.thread.start()
+
+    def get_sink(self, **labels):
+        """
+        A sink for the query_list of an extra data dict.
+        """
+        return QueryRecordSinkV1(self, labels)
+
+    def append(self, record):
+        """
+        Queue the record without blocking,
+        or drop it if the queue is full.
+        """
+        try:
+            self.queue.put_nowait(record)
+        except queue_module.Full:
+            self.count_dropped()
+
+    def count_dropped(self):
+        """
+        Count a dropped record, from any thread.
+        """
+        with self.dropped_count_lock:
+            self.dropped_count += 1
+
+    def open_next_segment(self):
+        """
+        Close the current segment and open the next one.
+        """
+        if self.segment_file is not None:
+            self.segment_file.close()
+        self.segment_index += 1
+        file_path = os.path.join(
+            self.directory,
+            f"{self.prefix}-{os.getpid()}-{self.segment_index:06d}"
+            f"{SEGMENT_SUFFIX}",
+        )
+        # pylint: disable-next=consider-using-with
+        self.segment_file = open(file_path, "ab")
+        self.segment_size = 0
+
+    def write(self, record):
+        """
+        Write an encoded record, rotating the segment if needed.
+        """
+        encoded_record = encode_record_v1(record)
+        if self.segment_file is None or (
+            self.segment_size > 0
+            and self.segment_size + len(encoded_record)
+            > self.max_segment_bytes
+        ):
+            self.open_next_segment()
+        self.segment_file.write(encoded_record)
+        self.segment_size += len(encoded_record)
+        self.written_count += 1
+
+    def run(self):
+        """
+        The loop of the writer thread, until the None record.
+        The file is flushed each time the queue is empty.
+        After a failed write, the records are dropped,
+        but the queue is still consumed.
+        """
+        while True:
+            record = self.queue.get()
+            try:
+                if record is None:
+                    if self.segment_file is not None:
+                        self.segment_file.close()
+                        self.segment_file = None
+                    return
+                if self.error is not None:
+                    self.count_dropped()
+                    continue
+                self.write(record)
+                if self.queue.empty():
+                    self.segment_file.flush()
+            # pylint: disable-next=broad-exception-caught
+            except Exception as exception:
+                self.error = exception
+                self.count_dropped()
+            finally:
+                self.queue.task_done()
+
+    def raise_error(self):
+        """
+        Raise QueryRecordStreamError if the writer thread failed,
+        or if it is stopped with records still queued.
+        """
+        if self.error is not None:
+            raise QueryRecordStreamError(
+                "The query records stream writer failed,"
+                f" {self.dropped_count} records were dropped."
+            ) from self.error
+        unfinished_count = self.queue.unfinished_tasks
+        if unfinished_count and not self.thread.is_alive():
+            raise QueryRecordStreamError(
+                "The query records stream writer is not running,"
+                f" {unfinished_count} records are not written."
+            )
+
+    def flush(self):
+        """
+        Wait until all the queued records are written.
+        """
+        queue = self.queue
+        with queue.all_tasks_done:
+            while queue.unfinished_tasks and self.thread.is_alive():
+                queue.all_tasks_done.wait(FLUSH_POLL_SECONDS)
+        self.raise_error()
+
+    def close(self):
+        """
+        Write the queued records and stop the writer thread.
+        """
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.raise_error()
+
+
+def use_query_record_sink_v1(extra_data_dict, sink):
+    """
+    Replace the query_list of extra_data_dict with the sink.
+    The counters of the dict are still updated in memory.
+    """
+    extra_data_dict["query_list"] = sink
+    extra_data_dict["query_list_max_length"] = None
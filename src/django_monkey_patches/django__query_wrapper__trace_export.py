@@ -0,0 +1,350 @@
+"""
+This file is part of django-monkey-patches library.
+
+django-monkey-patches is free software:
+you can redistribute it and/or modify it under the terms
+of the GNU Lesser General Public License
+as published by the Free Software Foundation,
+either version 3 of the License,
+or (at your option) any later version.
+
+django-monkey-patches is distributed in the hope
+that it will be useful,
+but WITHOUT ANY WARRANTY;
+without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU Lesser General Public License for more details.
+
+You should have received a copy of
+the GNU Lesser General Public License
+along with django-monkey-patches.
+If not, see <http://www.gnu.org/licenses/>.
+
+©Copyright 2023-2024 Laurent Lyaudet
+----------------------------------------------------------------------
+Export the queries captured by the custom query wrapper
+as a timeline, to see DB time against the gaps between queries:
+- Chrome Trace Event JSON (chrome://tracing, Perfetto),
+- speedscope JSON (https://www.speedscope.app/),
+- OpenTelemetry OTLP/JSON spans, one request per line,
+  like the file exporter of the OpenTelemetry collector.
+
+The queries are read in the query_list of the extra data dicts,
+hence query_fields must contain at least "sql", "start_time",
+and "end_time" or "duration"
+(and TIME_QUERIES must be True).
+Nested stash scopes are parent spans:
+give the list of the stashed dicts followed by the current dict,
+see get_stash_scopes_v1().
+A scope spans from its first query to its last query,
+unless you stored "scope_start_time" and "scope_end_time" in its dict.
+
+For example, before pop_extra_data_dicts():
+spans = get_trace_spans_v1(get_stash_scopes_v1(), ["request", "loop"])
+write_chrome_trace_v1("/tmp/request.trace.json", spans)
+"""
+
+import json
+import os
+import secrets
+
+# pylint: disable-next=import-error
+from django.db import connections
+
+from .django__query_wrapper import (
+    get_connection_dict,
+    get_connection_stack,
+    get_sql_signature_and_fingerprint_v2,
+)
+
+SPEEDSCOPE_SCHEMA = (
+    "https://www.speedscope.app/file-format-schema.json"
+)
+
+
+def get_stash_scopes_v1(connection=None):
+    """
+    The stashed extra data dicts of connection
+    (connections by default), from the outermost to the innermost,
+    followed by its current extra data dict.
+    """
+    if connection is None:
+        connection = connections
+    scopes = list(get_connection_stack(connection) or [])
+    scopes.append(get_connection_dict(connection))
+    return [scope for scope in scopes if scope is not None]
+
+
+def get_query_span(query_data):
+    """
+    The span of a query record, or None if it has no start_time.
+    """
+    start_time = query_data.get("start_time")
+    if start_time is None:
+        return None
+    end_time = query_data.get("end_time")
+    if end_time is None:
+        end_time = start_time + (query_data.get("duration") or 0)
+    sql = query_data.get("sql", "")
+    attributes = {"db.statement": sql}
+    for key in ("call_site", "light_call_stack_v1"):
+        if query_data.get(key) is not None:
+            attributes[key] = str(query_data[key])
+    return {
+        "name": get_sql_signature_and_fingerprint_v2(sql)[0],
+        "category": "query",
+        "start_time": start_time,
+        "end_time": end_time,
+        "attributes": attributes,
+        "children": [],
+    }
+
+
+def get_trace_spans_v1(scopes, scope_names=None):
+    """
+    The tree of spans of the given nested scopes:
+    each scope is the parent of the next one and of its queries.
+    It returns a list with the root span,
+    or an empty list if no query has a start_time.
+    """
+    parent_span = None
+    root_spans = []
+    scope_spans = []
+    for index, scope in enumerate(scopes):
+        name = f"scope {index}"
+        if scope_names is not None and index < len(scope_names):
+            name = scope_names[index]
+        span = {
+            "name": name,
+            "category": "scope",
+            "start_time": scope.get("scope_start_time"),
+            "end_time": scope.get("scope_end_time"),
+            "attributes": {"query_count": scope["query_count"]},
+            "children": [],
+        }
+        for query_data in scope["query_list"]:
+            query_span = get_query_span(query_data)
+            if query_span is not None:
+                span["children"].append(query_span)
+        if parent_span is None:
+            root_spans.append(span)
+        else:
+            parent_span["children"].append(span)
+        scope_spans.append(span)
+        parent_span = span
+
+    # Bounds of scopes without explicit times, innermost first.
+    for span in reversed(scope_spans):
+        # A scope without queries and without times is dropped.
+        children = [
+            x for x in span["children"] if x["start_time"] is not None
+        ]
+        children.sort(key=lambda x: x["start_time"])
+        span["children"] = children
+        if span["start_time"] is None and children:
+            span["start_time"] = children[0]["start_time"]
+        if (
+            span["end_time"] is None
+            and span["start_time"] is not None
+        ):
+            span["end_time"] = max(
+                (x["end_time"] for x in children),
+                default=span["start_time"],
+            )
+    return [x for x in root_spans if x["start_time"] is not None]
+
+
+def iter_spans(spans, parent=None, depth=0):
+    """
+    Depth-first iteration on (span, parent span, depth).
+    """
+    for span in spans:
+        yield span, parent, depth
+        yield from iter_spans(span["children"], span, depth + 1)
+
+
+def get_chrome_trace_v1(spans, pid=None, tid=0):
+    """
+    The Chrome Trace Event JSON object of the spans,
+    with complete events ("ph": "X") in microseconds.
+    """
+    if pid is None:
+        pid = os.getpid()
+    trace_events = []
+    for span, _, _ in iter_spans(spans):
+        trace_events.append(
+            {
+                "name": span["name"],
+                "cat": span["category"],
+                "ph": "X",
+                "ts": span["start_time"] * 1e6,
+                "dur": (span["end_time"] - span["start_time"]) * 1e6,
+                "pid": pid,
+                "tid": tid,
+                "args": span["attributes"],
+            }
+        )
+    return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+
+def write_chrome_trace_v1(file_path, spans, pid=None, tid=0):
+    """
+    Write the Chrome Trace Event JSON file of the spans.
+    """
+    with open(file_path, "w", encoding="utf-8") as trace_file:
+        json.dump(get_chrome_trace_v1(spans, pid, tid), trace_file)
+
+
+def get_speedscope_events(
+    span, frame_indexes, frames, events, parent
+):
+    """
+    The open and close events of a span and its children,
+    clamped into the parent span, so that they are well nested.
+    """
+    start_time = span["start_time"]
+    end_time = span["end_time"]
+    if parent is not None:
+        start_time = max(start_time, parent[0])
+        end_time = min(end_time, parent[1])
+    end_time = max(start_time, end_time)
+    frame_index = frame_indexes.get(span["name"])
+    if frame_index is None:
+        frame_index = frame_indexes[span["name"]] = len(frames)
+        frames.append({"name": span["name"]})
+    events.append(
+        {"type": "O", "frame": frame_index, "at": start_time}
+    )
+    last_time = start_time
+    for child in span["children"]:
+        last_time = get_speedscope_events(
+            child,
+            frame_indexes,
+            frames,
+            events,
+            (max(last_time, start_time), end_time),
+        )
+    events.append({"type": "C", "frame": frame_index, "at": end_time})
+    return end_time
+
+
+def get_speedscope_v1(spans, name="queries"):
+    """
+    The speedscope JSON object of the spans,
+    as an evented profile in seconds.
+    """
+    frame_indexes = {}
+    frames = []
+    events = []
+    for span in spans:
+        get_speedscope_events(
+            span, frame_indexes, frames, events, None
+        )
+    start_value = events[0]["at"] if events else 0
+    end_value = events[-1]["at"] if events else 0
+    return {
+        "$schema": SPEEDSCOPE_SCHEMA,
+        "shared": {"frames": frames},
+        "profiles": [
+            {
+                "type": "evented",
+                "name": name,
+                "unit": "seconds",
+                "startValue": start_value,
+                "endValue": end_value,
+                "events": events,
+            }
+        ],
+        "name": name,
+        "exporter": "django-monkey-patches",
+    }
+
+
+def write_speedscope_v1(file_path, spans, name="queries"):
+    """
+    Write the speedscope JSON file of the spans.
+    """
+    with open(file_path, "w", encoding="utf-8") as speedscope_file:
+        json.dump(get_speedscope_v1(spans, name), speedscope_file)
+
+
+def get_otlp_attributes(attributes):
+    """
+    OTLP/JSON key-value list of a dict.
+    """
+    result = []
+    for key, value in attributes.items():
+        if isinstance(value, bool):
+            otlp_value = {"boolValue": value}
+        elif isinstance(value, int):
+            otlp_value = {"intValue": str(value)}
+        elif isinstance(value, float):
+            otlp_value = {"doubleValue": value}
+        else:
+            otlp_value = {"stringValue": str(value)}
+        result.append({"key": key, "value": otlp_value})
+    return result
+
+
+def get_otlp_traces_request_v1(
+    spans,
+    service_name="django",
+    trace_id=None,
+):
+    """
+    The OTLP/JSON ExportTraceServiceRequest object of the spans.
+    Query spans are CLIENT spans with db.statement,
+    scope spans are INTERNAL spans.
+    """
+    if trace_id is None:
+        trace_id = secrets.token_hex(16)
+    span_ids = {}
+    otlp_spans = []
+    for span, parent, _ in iter_spans(spans):
+        span_id = span_ids[id(span)] = secrets.token_hex(8)
+        otlp_span = {
+            "traceId": trace_id,
+            "spanId": span_id,
+            "name": span["name"],
+            # SPAN_KIND_CLIENT = 3, SPAN_KIND_INTERNAL = 1
+            "kind": 3 if span["category"] == "query" else 1,
+            "startTimeUnixNano": str(int(span["start_time"] * 1e9)),
+            "endTimeUnixNano": str(int(span["end_time"] * 1e9)),
+            "attributes": get_otlp_attributes(span["attributes"]),
+        }
+        if parent is not None:
+            otlp_span["parentSpanId"] = span_ids[id(parent)]
+        otlp_spans.append(otlp_span)
+    return {
+        "resourceSpans": [
+            {
+                "resource": {
+                    "attributes": get_otlp_attributes(
+                        {
+                            "service.name": service_name,
+                            "process.pid": os.getpid(),
+                        }
+                    )
+                },
+                "scopeSpans": [
+                    {
+                        "scope": {"name": "django-monkey-patches"},
+                        "spans": otlp_spans,
+                    }
+                ],
+            }
+        ]
+    }
+
+
+def write_otlp_json_v1(file_path, spans, service_name="django"):
+    """
+    Append one line with the OTLP/JSON request of the spans
+    to the file, so that many requests or jobs
+    can be written to the same file.
+    """
+    with open(file_path, "a", encoding="utf-8") as otlp_file:
+        json.dump(
+            get_otlp_traces_request_v1(spans, service_name), otlp_file
+        )
+        otlp_file.write("\n")
@@ -0,0 +1,308 @@
+"""
+This file is part of django-monkey-patches library.
+
+django-monkey-patches is free software:
+you can redistribute it and/or modify it under the terms
+of the GNU Lesser General Public License
+as published by the Free Software Foundation,
+either version 3 of the License,
+or (at your option) any later version.
+
+django-monkey-patches is distributed in the hope
+that it will be useful,
+but WITHOUT ANY WARRANTY;
+without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU Lesser General Public License for more details.
+
+You should have received a copy of
+the GNU Lesser General Public License
+along with django-monkey-patches.
+If not, see <http://www.gnu.org/licenses/>.
+
+©Copyright 2023-2024 Laurent Lyaudet
+----------------------------------------------------------------------
+Transactions and savepoints (atomic blocks) as extra data dicts:
+long-held transactions hold their locks,
+and the dicts per query cannot show them.
+
+apply_transactions_patch_v1() patches Atomic.__enter__(),
+Atomic.__exit__()
+and BaseDatabaseWrapper.run_and_clear_commit_hooks().
+Each atomic block gets a dict from
+get_extra_data_template_for_set_of_queries_v1(), with the fields
+of get_transaction_fields_v1(): the wall time from BEGIN
+to COMMIT or ROLLBACK, the idle time (the wall time minus
+the time of its queries, with TIME_QUERIES;
+with SAMPLE_QUERIES, the unsampled queries are not inserted,
+hence their time is estimated with "estimated_total_duration"),
+the outcome, and the time of the on_commit() hooks,
+that are run after the COMMIT.
+The insertion callback insert_in_transactions_v1() inserts
+each query in the dicts of the atomic blocks it is executed in,
+hence a block also holds the queries of its savepoints.
+When a block ends, its dict is synthetized,
+and it is appended to the "savepoint_list" of the outer block,
+or to the "transaction_list" of the root dict of its connection.
+The transactions longer than LONG_TRANSACTION_SECONDS are logged.
+
+For example:
+apply_transactions_patch_v1()
+django__query_wrapper.TIME_QUERIES = True
+django__query_wrapper.POST_EXECUTION_CALLBACK = (
+    insert_in_connections_extra_data_v1
+)
+init_connections_extra_data_v1()
+# Only on the root dict of connections,
+# otherwise each query would be inserted twice.
+get_connection_dict(connections)["insertion_callback"] = (
+    insert_in_transactions_v1
+)
+...
+get_connection_dict(connection)["transaction_list"]
+"""
+
+import functools
+import logging
+import time
+from collections import deque
+
+# pylint: disable-next=import-error
+from django.db.backends.base.base import BaseDatabaseWrapper
+
+# pylint: disable-next=import-error
+from django.db.transaction import Atomic, get_connection
+
+from .django__query_wrapper import (
+    get_connection_dict,
+    get_extra_data_template_for_set_of_queries_v1,
+    insert_in_extra_data_dict_v1,
+    synthetize_extra_data_dict_v1,
+)
+
+logger = logging.getLogger(__name__)
+
+# The fields of the queries kept in the dicts of the atomic blocks.
+TRANSACTION_QUERY_FIELDS = ()
+# The max number of transactions kept per root dict,
+# the oldest ones are dropped first.
+TRANSACTION_LIST_MAX_LENGTH = 1000
+# Only the transactions longer than this are kept.
+MIN_TRANSACTION_SECONDS = 0
+# None or the duration above which a transaction is logged.
+LONG_TRANSACTION_SECONDS = 1.0
+# The attribute of a connection with the dicts of its atomic blocks.
+CONNECTION_ATTRIBUTE_NAME = "django_monkey_patches_atomic_stack"
+
+_original_methods = {}
+
+
+def get_transaction_fields_v1(using, is_savepoint):
+    """
+    The fields of the dict of an atomic block,
+    besides the fields of the template.
+    """
+    return {
+        "using": using,
+        "is_savepoint": is_savepoint,
+        "start_time": time.time(),
+        "end_time": None,
+        "wall_duration": None,
+        "idle_duration": None,
+        # "commit", "rollback" or "error".
+        "outcome": None,
+        "on_commit_count": 0,
+        "on_commit_duration": 0,
+        "savepoint_list": [],
+    }
+
+
+def get_atomic_stack(connection):
+    """
+    The dicts of the atomic blocks of connection,
+    the innermost last.
+    """
+    return connection.__dict__.setdefault(
+        CONNECTION_ATTRIBUTE_NAME, []
+    )
+
+
+def insert_in_transactions_v1(extra_data_dict, data):
+    """
+    The insertion callback inserting the query in the dicts
+    of the atomic blocks of its connection.
+    """
+    # pylint: disable=unused-argument
+    atomic_stack = data["context"]["connection"].__dict__.get(
+        CONNECTION_ATTRIBUTE_NAME
+    )
+    if atomic_stack:
+        for transaction_dict in atomic_stack:
+            insert_in_extra_data_dict_v1(transaction_dict, data)
+
+
+def end_transaction_dict(transaction_dict):
+    """
+    Set the end time of an atomic block, once,
+    before its on_commit() hooks.
+    """
+    if transaction_dict["end_time"] is None:
+        transaction_dict["end_time"] = time.time()
+        transaction_dict["wall_duration"] = (
+            transaction_dict["end_time"]
+            - transaction_dict["start_time"]
+        )
+        transaction_dict["idle_duration"] = max(
+            0,
+            transaction_dict["wall_duration"]
+            # The same as "total_duration" without SAMPLE_QUERIES.
+            - transaction_dict["estimated_total_duration"],
+        )
+
+
+def store_transaction_dict(connection, transaction_dict):
+    """
+    Synthetize the dict of an ended atomic block,
+    and append it to its outer block or to its connection.
+    """
+    end_transaction_dict(transaction_dict)
+    synthetize_extra_data_dict_v1(transaction_dict)
+    atomic_stack = get_atomic_stack(connection)
+    if atomic_stack:
+        atomic_stack[-1]["savepoint_list"].append(transaction_dict)
+        return
+    if (
+        LONG_TRANSACTION_SECONDS is not None
+        and transaction_dict["wall_duration"]
+        >= LONG_TRANSACTION_SECONDS
+    ):
+        logger.warning(
+            "Transaction of %.3f s on %s (%s):"
+            " %d queries, %.3f s idle.",
+            transaction_dict["wall_duration"],
+            connection.alias,
+            transaction_dict["outcome"],
+            transaction_dict["query_count"],
+            transaction_dict["idle_duration"],
+        )
+    if transaction_dict["wall_duration"] < MIN_TRANSACTION_SECONDS:
+        return
+    connection_dict = get_connection_dict(connection)
+    if connection_dict is None:
+        return
+    transaction_list = connection_dict.get("transaction_list")
+    if transaction_list is None:
+        transaction_list = connection_dict["transaction_list"] = (
+            deque(maxlen=TRANSACTION_LIST_MAX_LENGTH)
+        )
+    transaction_list.append(transaction_dict)
+
+
+def get_atomic_enter(original_enter):
+    """
+    The patched Atomic.__enter__(),
+    the BEGIN or SAVEPOINT is in the block.
+    """
+
+    def atomic_enter(self):
+        connection = get_connection(self.using)
+        atomic_stack = get_atomic_stack(connection)
+        transaction_dict = (
+            get_extra_data_template_for_set_of_queries_v1(
+                query_fields=list(TRANSACTION_QUERY_FIELDS),
+            )
+        )
+        transaction_dict.update(
+            get_transaction_fields_v1(
+                connection.alias, bool(atomic_stack)
+            )
+        )
+        atomic_stack.append(transaction_dict)
+        try:
+            return original_enter(self)
+        except BaseException:
+            atomic_stack.pop()
+            raise
+
+    return functools.wraps(original_enter)(atomic_enter)
+
+
+def get_atomic_exit(original_exit):
+    """
+    The patched Atomic.__exit__(),
+    the COMMIT, ROLLBACK or RELEASE is in the block.
+    """
+
+    def atomic_exit(self, exc_type, exc_value, traceback):
+        connection = get_connection(self.using)
+        atomic_stack = get_atomic_stack(connection)
+        transaction_dict = atomic_stack[-1] if atomic_stack else None
+        if transaction_dict is None:
+            return original_exit(self, exc_type, exc_value, traceback)
+        transaction_dict["outcome"] = (
+            "rollback"
+            if exc_type is not None or connection.needs_rollback
+            else "commit"
+        )
+        try:
+            return original_exit(self, exc_type, exc_value, traceback)
+        except BaseException:
+            transaction_dict["outcome"] = "error"
+            raise
+        finally:
+            # It may have been popped before the on_commit() hooks.
+            if atomic_stack and atomic_stack[-1] is transaction_dict:
+                atomic_stack.pop()
+                store_transaction_dict(connection, transaction_dict)
+
+    return functools.wraps(original_exit)(atomic_exit)
+
+
+def get_timed_run_and_clear_commit_hooks(original_method):
+    """
+    The patched BaseDatabaseWrapper.run_and_clear_commit_hooks(),
+    called after the COMMIT of the outermost block:
+    the block ends before the hooks.
+    """
+
+    def run_and_clear_commit_hooks(self):
+        atomic_stack = self.__dict__.get(CONNECTION_ATTRIBUTE_NAME)
+        if not atomic_stack or not self.run_on_commit:
+            return original_method(self)
+        transaction_dict = atomic_stack.pop()
+        end_transaction_dict(transaction_dict)
+        transaction_dict["on_commit_count"] = len(self.run_on_commit)
+        start_time = time.time()
+        try:
+            return original_method(self)
+        finally:
+            transaction_dict["on_commit_duration"] = (
+                time.time() - start_time
+            )
+            store_transaction_dict(self, transaction_dict)
+
+    return functools.wraps(original_method)(
+        run_and_clear_commit_hooks
+    )
+
+
+def apply_transactions_patch_v1():
+    """
+    Patch Atomic and BaseDatabaseWrapper, once,
+    and return the original methods.
+    """
+    if _original_methods:
+        return dict(_original_methods)
+    _original_methods["Atomic.__enter__"] = Atomic.__enter__
+    Atomic.__enter__ = get_atomic_enter(Atomic.__enter__)
+    _original_methods["Atomic.__exit__"] = Atomic.__exit__
+    Atomic.__exit__ = get_atomic_exit(Atomic.__exit__)
+    _original_methods[
+        "BaseDatabaseWrapper.run_and_clear_commit_hooks"
+    ] = BaseDatabaseWrapper.run_and_clear_commit_hooks
+    BaseDatabaseWrapper.run_and_clear_commit_hooks = (
+        get_timed_run_and_clear_commit_hooks(
+            BaseDatabaseWrapper.run_and_clear_commit_hooks
+        )
+    )
+    return dict(_original_methods)